@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests
+"""
+import datetime
+import pytest
+
+import shikin
+from shikin import suggest
+from shikin.model import AppConfig, GroupType, DocType, PubType, DocSet
+
+
+@pytest.fixture
+def app_db(tmp_path, monkeypatch):
+    """
+    The app's database, made afresh in tmp_path with a secret key, one of
+    each type and a docset.  Tests add their own groups and documents.
+    """
+    monkeypatch.setitem(shikin.app.config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % (tmp_path / 'test.db'))
+    db = shikin.app.dbobj
+    db.session.remove()
+    db.create_all()
+    db.session.add(AppConfig(key='secret_key', val=b'x' * 32))
+    db.session.add(GroupType(u'政党本部'))
+    db.session.add(DocType(u'政治資金収支報告書'))
+    db.session.add(PubType(u'定期公表'))
+    db.session.flush()
+    db.session.add(DocSet(published=datetime.date(2015, 1, 1), pubtype_id=1, doctype_id=1, path='/x'))
+    db.session.commit()
+    yield db
+    # The suggestion index may be being built from it in the background
+    suggest.wait_for_rebuild()
+    db.session.remove()
+    db.drop_all()
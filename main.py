@@ -8,7 +8,10 @@ from argparse import ArgumentParser
 
 import shikin
 import os
-from shikin.model import GroupType, DocType, PubType, User, AppConfig
+from shikin.model import GroupType, DocType, PubType, User, AppConfig, Document, DocRotation, \
+    rebuild_stats, rebuild_review_queue
+from shikin.search import rebuild_search
+from shikin.cache import DATA_VERSION_KEY
 
 
 def initdb_command(args):
@@ -64,6 +67,9 @@ def initdb_command(args):
     if configs == 0:
         db.session.add(AppConfig(key='secret_key', val=os.urandom(32)))
         db.session.commit()
+    if AppConfig.query.filter(AppConfig.key == DATA_VERSION_KEY).count() == 0:
+        db.session.add(AppConfig(key=DATA_VERSION_KEY, val=0))
+        db.session.commit()
 
     print('Seeded tables which need it.')
 
@@ -77,6 +83,54 @@ def dropdb_command(args):
     print('dropped the database.')
 
 
+def rebuildstats_command(args):
+    """Recalculate the summary stats tables from scratch."""
+    db = shikin.app.dbobj
+    # Makes the tables and triggers if this db is from before they existed
+    db.create_all()
+    rebuild_stats(db.session)
+    print('Rebuilt the stats tables.')
+
+
+def rebuildsearch_command(args):
+    """Refill the search index from scratch."""
+    db = shikin.app.dbobj
+    db.create_all()
+    rebuild_search(db.session)
+    print('Rebuilt the search index.')
+
+
+def rebuildreview_command(args):
+    """Refill the review queue from scratch."""
+    db = shikin.app.dbobj
+    db.create_all()
+    rebuild_review_queue(db.session)
+    print('Rebuilt the review queue.')
+
+
+def recordrots_command(args):
+    """Record the page rotations of documents imported before they were."""
+    from shikin.api import pdf_fullpath
+    from shikin.pdf.util import get_page_rots
+    db = shikin.app.dbobj
+    db.create_all()
+    docs = Document.query.outerjoin(DocRotation).filter(DocRotation.id.is_(None)).all()
+    recorded = 0
+    for doc in docs:
+        path = pdf_fullpath(doc)
+        if not os.path.exists(path):
+            continue
+        rots = get_page_rots(path)
+        if not rots:
+            continue
+        db.session.add(DocRotation(doc_id=doc.id, pages=[rots.get(p, 0) for p in range(1, doc.pages + 1)]))
+        recorded += 1
+        if recorded % 100 == 0:
+            db.session.commit()
+    db.session.commit()
+    print('Recorded page rotations of %d documents.' % recorded)
+
+
 def run_command(args):
     shikin.app.run(host=args.host, port=args.port, debug=not args.ndebug)
 
@@ -102,6 +156,18 @@ def main():
     drop_sub.add_argument("--yes", action="store_true", help="really drop the db")
     drop_sub.set_defaults(func=dropdb_command)
 
+    stats_sub = sub.add_parser("rebuildstats", help="recalculate the summary stats tables")
+    stats_sub.set_defaults(func=rebuildstats_command)
+
+    search_sub = sub.add_parser("rebuildsearch", help="refill the search index")
+    search_sub.set_defaults(func=rebuildsearch_command)
+
+    review_sub = sub.add_parser("rebuildreview", help="refill the review queue")
+    review_sub.set_defaults(func=rebuildreview_command)
+
+    rots_sub = sub.add_parser("recordrots", help="record page rotations of documents which lack them")
+    rots_sub.set_defaults(func=recordrots_command)
+
     run_sub = sub.add_parser("run", help="run the web app")
     run_sub.add_argument("--port", type=int, help="port to serve on", default=5000)
     run_sub.add_argument("--host", help="host to serve from (default=127.0.0.1)", default="127.0.0.1")
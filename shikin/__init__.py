@@ -13,6 +13,14 @@ def _limit(self):
 
 setattr(BaseQuery, '_limit', _limit)
 
+# Flask-Restless 0.17 search filters call inspect.getargspec, which is gone in
+# python 3.11.  getfullargspec gives the same .args.
+import inspect
+if not hasattr(inspect, 'getargspec'):
+    from types import SimpleNamespace
+    import flask_restless.search
+    flask_restless.search.inspect = SimpleNamespace(getargspec=inspect.getfullargspec)
+
 from . import config
 
 # create our little application
@@ -25,4 +33,8 @@ app.babel = Babel(app)
 from . import views
 from . import api
 from . import pageapi
+from . import search
+from . import suggest
+from . import cache
+from . import export
 from . import review
@@ -9,9 +9,11 @@ import flask_restless
 from sqlalchemy.orm.properties import ColumnProperty
 
 from . import app
-from .model import Document, Group, GroupType, DocType, PubType, DocSet, DocSegment, User
-from .pdf import pdfimages
+from .model import Document, Group, GroupType, DocType, PubType, DocSet, DocSegment, DocRotation, User
+from .pdf.pagecache import PageCache
 from .util import dologin
+from .search import matching_ids, GROUP
+from .export import keyset_preprocessor, keyset_postprocessor
 
 # Create the Flask-Restless API manager.
 manager = flask_restless.APIManager(app, flask_sqlalchemy_db=app.dbobj)
@@ -19,7 +21,8 @@ manager = flask_restless.APIManager(app, flask_sqlalchemy_db=app.dbobj)
 
 @app.after_request
 def add_no_cache(response):
-    if request.method == 'POST' or '/api/' in request.url:
+    # Views which are fine to cache say so by making the response public
+    if (request.method == 'POST' or '/api/' in request.url) and not response.cache_control.public:
         response.cache_control.no_cache = True
     return response
 
@@ -52,50 +55,138 @@ def raw_columns(table):
 
 def _make_raw_api(table):
     ALL_METHODS = ['GET', 'POST', 'PATCH', 'DELETE']
-    raw_api_preprocessors = {}
+    raw_api_preprocessors = {'GET_MANY': [keyset_preprocessor]}
     for update_method in ('POST', 'PUT_MANY', 'PUT_SINGLE', 'DELETE_SINGLE', 'DELETE_MANY'):
         raw_api_preprocessors[update_method] = [check_write_authorization]
 
     manager.create_api(table, url_prefix='/api/raw',
                        include_columns=raw_columns(table),
                        preprocessors=raw_api_preprocessors,
+                       postprocessors={'GET_MANY': [keyset_postprocessor]},
                        methods=ALL_METHODS, max_results_per_page=50000)
 
 
 def _make_ro_api(table):
     include_methods = None
+    exclude_columns = None
     if table == Document:
-        include_methods = ['size_str']
+        include_methods = ['size_str', 'page_rots']
+        # Segments come from /api/doc_segment, so OCR runs don't make cached
+        # documents stale
+        exclude_columns = ['segments']
     elif table == Group:
         include_methods = ['docs.size_str', 'stats', 'size_str']
     manager.create_api(table, methods=['GET'], max_results_per_page=100,
-                       results_per_page=100, include_methods=include_methods)
+                       results_per_page=100, include_methods=include_methods, exclude_columns=exclude_columns,
+                       preprocessors={'GET_MANY': [keyset_preprocessor]},
+                       postprocessors={'GET_MANY': [keyset_postprocessor]})
 
 
 # Make read-write "raw" APIs for backend use, and read-only apis for frontend
 # use
-for table in (Document, Group, GroupType, DocType, PubType, DocSet, DocSegment):
+for table in (Document, Group, GroupType, DocType, PubType, DocSet, DocSegment, DocRotation):
     _make_raw_api(table)
     _make_ro_api(table)
 
 
+_SEGMENT_REQUIRED = ('doc_id', 'page', 'row', 'col', 'x1', 'y1', 'x2', 'y2')
+_SEGMENT_OPTIONAL = ('parent_id', 'ocrtext')
+
+
+@app.route('/api/raw/doc_segment/bulk', methods=['POST'])
+def segment_bulk_add():
+    """
+    Add a batch of segments (eg, a page or document worth from the OCR
+    process) in one transaction.  Takes {"objects": [...]}.  Segments which
+    are already in the DB with the same doc, page and location are ignored.
+    """
+    try:
+        check_write_authorization()
+    except flask_restless.ProcessingException as e:
+        return jsonify({'status': 'error', 'msg': e.description}), e.code
+
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('objects'), list):
+        return jsonify({'status': 'error', 'msg': 'Expected {"objects": [...]}'}), 400
+
+    objs = []
+    for obj in data['objects']:
+        if not isinstance(obj, dict) or any(k not in obj for k in _SEGMENT_REQUIRED):
+            return jsonify({'status': 'error', 'msg': 'Segment missing fields: %s' % (obj,)}), 400
+        unknown = set(obj) - set(_SEGMENT_REQUIRED) - set(_SEGMENT_OPTIONAL)
+        if unknown:
+            return jsonify({'status': 'error', 'msg': 'Unknown segment fields: %s' % ', '.join(unknown)}), 400
+        objs.append(obj)
+
+    rows = []
+    for obj in objs:
+        row = dict.fromkeys(_SEGMENT_OPTIONAL)
+        row.update(obj)
+        rows.append(row)
+
+    # The doc_segment_location unique index drops segments already there,
+    # including ones another upload is adding at the same time.
+    added = 0
+    if rows:
+        result = app.dbobj.session.execute(DocSegment.__table__.insert().prefix_with('OR IGNORE'), rows)
+        added = result.rowcount
+    app.dbobj.session.commit()
+
+    return jsonify({'status': 'ok', 'added': added, 'ignored': len(rows) - added})
+
+
+_page_cache = None
+
+
+def get_page_cache():
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = PageCache(os.path.join(app.root_path, app.config['PAGE_CACHE_DIR']),
+                                app.config['PAGE_CACHE_MAX_MB'] * 1024 * 1024)
+    return _page_cache
+
+
+def pdf_fullpath(doc):
+    path = doc.path
+    if path.startswith('/'):
+        path = path[1:]
+    return os.path.join(os.path.abspath(app.config['PDF_DIR']), path)
+
+
 @app.route('/doc/cached/<int:docid>/<int:pageno>')
 @app.route('/doc/cached/<int:docid>')
 def docpdf(docid, pageno=None):
-    """Adds the current user as follower of the given user.  Pageno is 1-indexed."""
+    """
+    The pdf of a document, or an image of one page of it.  Pageno is
+    1-indexed.  Page images can be scaled down with ?w=<width>, and scaled
+    ones are WebP for browsers which take it.
+    """
     doc = Document.query.filter(Document.id == docid).first_or_404()
-    path = doc.path
-    if path.startswith('/'):
-        path = path[1:]
-    pdfdir = os.path.abspath(app.config['PDF_DIR'])
     if pageno is not None:
-        pdf_fullpath = os.path.join(pdfdir, path)
-        app.logger.debug('Returning page %d of %s' % (pageno, pdf_fullpath))
-        for img in pdfimages.pdf_images(pdf_fullpath, optimise=False, autorotate=True, firstpage=pageno, lastpage=pageno):
-            return send_file(img)
-        abort(404)
+        width = request.args.get('w', type=int)
+        if width is not None and width not in app.config['PAGE_WIDTHS']:
+            abort(400)
+        pdf_path = pdf_fullpath(doc)
+        if pageno < 1 or not os.path.exists(pdf_path):
+            abort(404)
+        app.logger.debug('Returning page %d of %s' % (pageno, pdf_path))
+        # Full size pages stay PNG, so every pixel is as scanned
+        fmt = 'webp' if width is not None and request.accept_mimetypes['image/webp'] else 'png'
+        # Rotations recorded at import, else the page cache asks pdfinfo
+        cached = get_page_cache().get(pdf_path, docid, pageno, width, rot=doc.page_rot(pageno), fmt=fmt)
+        if cached is None:
+            abort(404)
+        imgpath, key = cached
+        response = send_file(imgpath, mimetype='image/' + fmt, etag=key, conditional=True, max_age=86400)
+        response.cache_control.public = True
+        if width is not None:
+            response.vary.add('Accept')
+        return response
     else:
-        return send_from_directory(pdfdir, path, as_attachment=True)
+        path = doc.path
+        if path.startswith('/'):
+            path = path[1:]
+        return send_from_directory(os.path.abspath(app.config['PDF_DIR']), path, as_attachment=True)
 
 
 @app.route('/api/search/<query>')
@@ -103,7 +194,7 @@ def searchapi(query):
     if not query:
         return {'values': []}
     query = query.strip()
-    q = app.dbobj.session.query(Group.id, Group.name).filter(Group.name.like('%'+query+'%'))
+    q = app.dbobj.session.query(Group.id, Group.name).filter(Group.id.in_(matching_ids(GROUP, query)))
     return jsonify({'values': [{'id': x[0], 'name': x[1]} for x in q.all()]})
 
 
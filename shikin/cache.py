@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Response cache for the read-only apis.
+
+The data behind the summary and read-only apis only changes when something
+is imported, so whole responses are cached, keyed by url and arguments.  Each
+entry records the data version it was made from.  The data version is a
+counter in app_config which triggers bump on any write to the tables these
+apis show, from this app or from the import tools.
+
+Backends are pluggable: 'lru' keeps entries in each process, 'sqlite' keeps
+them in a file shared by all the WSGI processes.  Responses also get an ETag
+and Cache-Control: public, so a front end cache (eg Apache mod_cache) can
+keep them and revalidate.  Review activity (segment view counts and reviews)
+does not bump the version.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request, g, json
+from sqlalchemy import event, DDL, text
+from sqlalchemy.orm import Session
+
+from . import app
+from .model import Model
+
+DATA_VERSION_KEY = 'data_version'
+
+# Only GETs to these are cached.  Flask-Restless read-only apis are at
+# /api/<table>.
+CACHED_PREFIXES = ('/api/summary/', '/api/group', '/api/document', '/api/doc_set')
+
+# The tables the cached responses are made from.  The stats tables are only
+# written by the document triggers, so they need none of their own, and the
+# read-only document api leaves out segments, see api._make_ro_api.
+_VERSIONED_TABLES = ['"group"', 'group_type', 'document', 'doc_set', 'doc_type', 'pub_type', 'doc_rotation',
+                     'tag', 'doc_tags']
+
+_BUMP = "UPDATE app_config SET val = val + 1 WHERE key = '%s';" % DATA_VERSION_KEY
+
+_VERSION_DDL = []
+for _table in _VERSIONED_TABLES:
+    for _op in ('INSERT', 'UPDATE', 'DELETE'):
+        _VERSION_DDL.append('CREATE TRIGGER IF NOT EXISTS %s_version_%s AFTER %s ON %s BEGIN %s END' %
+                            (_table.strip('"'), _op.lower(), _op, _table, _BUMP))
+
+for ddl in _VERSION_DDL:
+    event.listen(Model.metadata, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+
+
+class LRUBackend():
+    """Entries kept in this process, least recently used thrown out first"""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class SqliteBackend():
+    """Entries kept in an SQLite file, shared between processes"""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.execute('CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, version INTEGER, '
+                        'etag TEXT, mimetype TEXT, body BLOB)')
+        self.lock = threading.Lock()
+        self.version = None
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT version, etag, mimetype, body FROM response_cache WHERE key = ?',
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        return {'version': row[0], 'etag': row[1], 'mimetype': row[2], 'body': row[3]}
+
+    def put(self, key, entry):
+        with self.lock, self.db:
+            if entry['version'] != self.version:
+                # Anything older is no use now
+                self.db.execute('DELETE FROM response_cache WHERE version < ?', (entry['version'],))
+                self.version = entry['version']
+            self.db.execute('INSERT OR REPLACE INTO response_cache (key, version, etag, mimetype, body) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (key, entry['version'], entry['etag'], entry['mimetype'], entry['body']))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """The cache backend, which starts afresh if the config or db changes"""
+    global _backend
+    kind = app.config.get('RESPONSE_CACHE')
+    setup = (kind, app.config['SQLALCHEMY_DATABASE_URI'])
+    with _backend_lock:
+        if _backend is None or _backend[0] != setup:
+            if kind == 'lru':
+                backend = LRUBackend(app.config.get('RESPONSE_CACHE_SIZE', 1000))
+            elif kind == 'sqlite':
+                backend = SqliteBackend(os.path.join(app.root_path, app.config['RESPONSE_CACHE_PATH']))
+            elif not kind:
+                backend = None
+            else:
+                raise ValueError('Unknown RESPONSE_CACHE %s' % kind)
+            _backend = (setup, backend)
+            _version[0] = None
+        return _backend[1]
+
+
+# The last data version seen, and when.  Checked again after
+# RESPONSE_CACHE_VERSION_TTL seconds, or straight away after a commit here.
+_version = [None, 0]
+
+
+def data_version():
+    now = time.time()
+    if _version[0] is not None and now - _version[1] < app.config.get('RESPONSE_CACHE_VERSION_TTL', 1):
+        return _version[0]
+    version = app.dbobj.session.execute(text('SELECT val FROM app_config WHERE key = :key'),
+                                        {'key': DATA_VERSION_KEY}).scalar()
+    if version is None:
+        # A db from before there was a version.  Not through the session, so
+        # as not to commit anything else.
+        with app.dbobj.engine.begin() as conn:
+            conn.execute(text('INSERT OR IGNORE INTO app_config (key, val) VALUES (:key, 0)'),
+                         {'key': DATA_VERSION_KEY})
+        version = 0
+    _version[:] = [int(version), now]
+    return _version[0]
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_version(session):
+    _version[1] = 0
+
+
+# DataTables numbers its requests with draw and wants the number sent back,
+# but the data doesn't depend on it.  It's left out of the key and put back
+# into cached responses.
+_UNKEYED_ARGS = ('draw',)
+
+
+def _cache_key():
+    if request.method != 'GET' or not request.path.startswith(CACHED_PREFIXES):
+        return None
+    args = '&'.join('%s=%s' % kv for kv in sorted(request.args.items(multi=True)) if kv[0] not in _UNKEYED_ARGS)
+    return request.path + '?' + args
+
+
+def _cached_body(entry):
+    body = entry['body']
+    if 'draw' in request.args and entry['mimetype'] == 'application/json':
+        data = json.loads(body)
+        if 'draw' in data:
+            data['draw'] = request.args['draw']
+            body = json.dumps(data)
+    return body
+
+
+def _finish(response, entry):
+    response.set_etag(entry['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('RESPONSE_CACHE_MAX_AGE', 60)
+    return response.make_conditional(request)
+
+
+@app.before_request
+def serve_cached():
+    key = _cache_key()
+    backend = get_backend() if key else None
+    if backend is None:
+        return None
+    version = data_version()
+    entry = backend.get(key)
+    if entry is not None and entry['version'] == version:
+        response = app.response_class(_cached_body(entry), mimetype=entry['mimetype'])
+        return _finish(response, entry)
+    g.cache_entry = {'key': key, 'version': version}
+
+
+@app.after_request
+def store_cached(response):
+    entry = g.pop('cache_entry', None)
+    if entry is None or response.status_code != 200 or response.direct_passthrough:
+        return response
+    body = response.get_data()
+    entry.update(etag='%d-%s' % (entry['version'], hashlib.md5(body).hexdigest()),
+                 mimetype=response.mimetype, body=body)
+    get_backend().put(entry.pop('key'), entry)
+    return _finish(response, entry)
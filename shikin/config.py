@@ -8,8 +8,40 @@ DEBUG = True
 APP_NAME = 'shikin'
 PDF_DIR = 'pdf'
 THUMBNAIL_DIR = '/static/thumbnails'
+# Which thumbnails tools/make_thumbnails.py has made, from the shikin package
+THUMBNAIL_MANIFEST = '../db/thumbnails.sqlite'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Cache for the read-only api responses: 'lru' keeps them in each process,
+# 'sqlite' in RESPONSE_CACHE_PATH shared by all processes, None turns it off.
+RESPONSE_CACHE = 'lru'
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_PATH = '../db/response_cache.db'
+# Seconds browsers and proxies may keep a cached response
+RESPONSE_CACHE_MAX_AGE = 60
+# Seconds between checks for imports by other processes
+RESPONSE_CACHE_VERSION_TTL = 1
+
+# Rendered page images for /doc/cached/<docid>/<pageno>.  Relative paths are
+# from the shikin package, as for the db.
+PAGE_CACHE_DIR = '../cache/pages'
+PAGE_CACHE_MAX_MB = 2000
+# Widths page images can be asked for with ?w=, besides full size
+PAGE_WIDTHS = (400, 800, 1200, 1600)
+# Width of the page images on the review page (shown 1170px wide), one of
+# PAGE_WIDTHS
+REVIEW_PAGE_WIDTH = 1200
+
+# Threads per web process rendering pages before the review page wants them
+# (0 to turn off), how many pages can wait for them, and how many pages to
+# render beyond the one being reviewed.
+PREFETCH_WORKERS = 2
+PREFETCH_QUEUE = 16
+PREFETCH_AHEAD = 2
+
+# Seconds a reviewer keeps a page to themselves
+REVIEW_LEASE = 600
+
 LANGUAGES = {
     'en': 'English',
     'ja': '日本語'
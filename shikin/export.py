@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Paging through whole tables without OFFSET.
+
+The collection apis take after=<id>, which pages by id instead of by page
+number, so every page costs the same however deep it is.  For reading whole
+tables there is also an export, which streams rows as newline delimited JSON.
+The export reads the table in chunks by id, each in its own short read, so
+neither the web worker nor the db has to hold the whole table at once, and
+writers are not locked out for the length of the download.
+"""
+
+import json
+from datetime import date
+
+from flask import request, jsonify, Response, stream_with_context
+import flask_restless
+from sqlalchemy import select
+
+from . import app
+from .model import Document, Group, GroupType, DocType, PubType, DocSet, DocSegment, DocRotation, latest_reviews
+
+EXPORT_TABLES = {t.__tablename__: t for t in (Document, Group, GroupType, DocType, PubType, DocSet, DocSegment,
+                                              DocRotation)}
+
+# Rows read from the db at a time
+CHUNK_SIZE = 2000
+
+
+def keyset_preprocessor(search_params=None, **kw):
+    """
+    GET_MANY preprocessor for paging by id.  With after=<id>, the results are
+    those with ids after it, in id order.  The next page is after the last id.
+    """
+    after = request.args.get('after')
+    if after is None or search_params is None:
+        return
+    if not after.isdigit():
+        raise flask_restless.ProcessingException(description='after must be an id', code=400)
+    search_params.setdefault('filters', []).append({'name': 'id', 'op': '>', 'val': int(after)})
+    search_params['order_by'] = [{'field': 'id', 'direction': 'asc'}]
+
+
+def keyset_postprocessor(result=None, search_params=None, **kw):
+    """Say where the next page starts, for the results of keyset_preprocessor"""
+    if result is None or request.args.get('after') is None:
+        return
+    objs = result.get('objects') or []
+    result['after'] = objs[-1]['id'] if objs and result.get('total_pages', 0) > 1 else None
+
+
+def _json_default(val):
+    if isinstance(val, date):
+        return val.isoformat()
+    raise TypeError('Can not export %r' % (val,))
+
+
+def export_columns(table):
+    """Columns which can be exported.  Segments also have text, their reviewed or else OCR text."""
+    columns = [c.key for c in table.__table__.columns]
+    if table is DocSegment:
+        columns.append('text')
+    return columns
+
+
+def export_rows(table, columns, after=0, limit=None):
+    """Yield rows of table as dicts of columns, in id order, starting after the given id"""
+    session = app.dbobj.session
+    besttext = table is DocSegment and 'text' in columns
+    cols = [table.__table__.c['ocrtext' if c == 'text' and besttext else c] for c in columns]
+    idcol = table.__table__.c.id
+    while limit is None or limit > 0:
+        chunk = CHUNK_SIZE if limit is None else min(CHUNK_SIZE, limit)
+        q = select(idcol, *cols).where(idcol > after).order_by(idcol).limit(chunk)
+        rows = session.execute(q).fetchall()
+        reviewed = {}
+        if besttext:
+            reviewed = {k: v.text for k, v in latest_reviews(row[0] for row in rows).items()}
+        # Let go of the db between chunks
+        session.close()
+        for row in rows:
+            obj = dict(zip(columns, row[1:]))
+            if row[0] in reviewed:
+                obj['text'] = reviewed[row[0]]
+            yield obj
+        if len(rows) < chunk:
+            break
+        after = rows[-1][0]
+        if limit is not None:
+            limit -= len(rows)
+
+
+@app.route('/api/export/<table>')
+def export(table):
+    """
+    All the rows of a table as newline delimited JSON, in id order.  Takes
+    after=<id> to start part way through, limit=<n> to stop after n rows and
+    columns=<a,b,..> to only send some columns.  See export_columns.
+    """
+    table = EXPORT_TABLES.get(table)
+    if table is None:
+        return jsonify({'status': 'error', 'msg': 'No such table'}), 404
+    allcols = export_columns(table)
+    columns = request.args.get('columns')
+    columns = columns.split(',') if columns else allcols
+    after = request.args.get('after', '0')
+    limit = request.args.get('limit')
+    unknown = set(columns) - set(allcols)
+    if unknown:
+        return jsonify({'status': 'error', 'msg': 'Unknown columns: %s' % ', '.join(sorted(unknown))}), 400
+    if not after.isdigit() or (limit is not None and not limit.isdigit()):
+        return jsonify({'status': 'error', 'msg': 'after and limit must be numbers'}), 400
+
+    def generate():
+        for row in export_rows(table, columns, int(after), int(limit) if limit is not None else None):
+            yield json.dumps(row, ensure_ascii=False, default=_json_default) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -2,7 +2,7 @@
 """Database model for political contributions documents"""
 
 import os
-from sqlalchemy import Column, ForeignKey, UniqueConstraint, func
+from sqlalchemy import Column, ForeignKey, UniqueConstraint, Index, func, event, DDL
 from sqlalchemy import Integer, Text, Date, DateTime, BLOB, Boolean
 from sqlalchemy.orm import relationship, backref
 
@@ -63,18 +63,19 @@ class Group(Model):
         return y[0] if y else None
 
     def stats(self):
-        q = app.dbobj.session.query(Document.year, func.count(Document.id), func.sum(Document.size), func.sum(Document.pages))\
-                             .group_by(Document.year)\
-                             .order_by(Document.year)\
-                             .filter(Document.group_id == self.id)
+        """Docs, bytes and pages by year, of the group and its sub-groups.  Undated docs are left out."""
+        q = app.dbobj.session.query(GroupYearStats.year, GroupYearStats.docs,
+                                    GroupYearStats.bytes, GroupYearStats.pages)\
+                             .filter(GroupYearStats.group_id == self.id)\
+                             .filter(GroupYearStats.year != 0)
         by_year = {y: {'year': y, 'docs': d, 'bytes': b, 'pages': p} for y, d, b, p in q.all()}
         # Docs for sub-groups
-        child_ids = [x.id for x in self.children]
-        q = app.dbobj.session.query(Document.year, func.count(Document.id), func.sum(Document.size),
-                                    func.sum(Document.pages), func.count(Document.group_id.distinct()))\
-                             .group_by(Document.year)\
-                             .order_by(Document.year)\
-                             .filter(Document.group_id.in_(child_ids))
+        q = app.dbobj.session.query(GroupYearStats.year, func.sum(GroupYearStats.docs), func.sum(GroupYearStats.bytes),
+                                    func.sum(GroupYearStats.pages), func.count(GroupYearStats.group_id))\
+                             .join(Group, Group.id == GroupYearStats.group_id)\
+                             .group_by(GroupYearStats.year)\
+                             .filter(Group.parent_id == self.id)\
+                             .filter(GroupYearStats.year != 0)
         for y, d, b, p, g in q.all():
             if y not in by_year:
                 by_year[y] = {'year': y}
@@ -83,8 +84,7 @@ class Group(Model):
             by_year[y]['child_bytes'] = b
             by_year[y]['child_pages'] = p
 
-        by_year = by_year.values()
-        by_year.sort(key=lambda x: x['year'])
+        by_year = sorted(by_year.values(), key=lambda x: x['year'])
         return {'byyear': by_year}
 
     def __repr__(self):
@@ -168,10 +168,160 @@ class Document(Model):
     def stats(self):
         return {}
 
+    @property
+    def page_rots(self):
+        """Rotation of each page, page 1 first, or None if not recorded"""
+        return self.rotation.pages if self.rotation is not None else None
+
+    def page_rot(self, pageno):
+        """Rotation of page pageno (1-indexed), or None if not recorded"""
+        rots = self.page_rots
+        if rots is None or not 0 < pageno <= len(rots):
+            return None
+        return rots[pageno - 1]
+
     def __repr__(self):
         return 'Document<%d:%s>' % (self.id, self.filename)
 
 
+class DocRotation(Model):
+    """
+    The rotation of each page of a document, as pdfinfo gives it, recorded
+    when it is imported so that showing or OCRing a page doesn't have to ask
+    pdfinfo again.  rots is a comma separated list, page 1 first.
+    """
+    id = Column('id', Integer(), primary_key=True)
+    doc_id = Column('doc_id', Integer(), ForeignKey(Document.id), nullable=False, unique=True)
+    rots = Column('rots', Text(), nullable=False)
+
+    # Loaded for a whole list of documents in one query, as the document api
+    # gives page_rots for each
+    doc = relationship(Document, uselist=False, backref=backref('rotation', uselist=False, lazy='selectin'))
+
+    def __init__(self, doc_id=None, pages=None, **kw):
+        super().__init__(doc_id=doc_id, **kw)
+        if pages is not None:
+            self.pages = pages
+
+    @property
+    def pages(self):
+        return [int(x) for x in self.rots.split(',')] if self.rots else []
+
+    @pages.setter
+    def pages(self, rots):
+        self.rots = ','.join(str(x) for x in rots)
+
+    def __repr__(self):
+        return 'DocRotation<%d>' % self.doc_id
+
+
+class GroupYearStats(Model):
+    """
+    Document totals for each group and year.  This and the other *Stats tables
+    are kept up to date by triggers on the document table, see
+    _STATS_TRIGGERS.  Documents with no group or year are counted under 0.
+    """
+    group_id = Column('group_id', Integer(), primary_key=True, autoincrement=False)
+    year = Column('year', Integer(), primary_key=True, autoincrement=False)
+    docs = Column('docs', Integer(), nullable=False, default=0)
+    pages = Column('pages', Integer(), nullable=False, default=0)
+    bytes = Column('bytes', Integer(), nullable=False, default=0)
+
+    def __repr__(self):
+        return 'GroupYearStats<%d:%d>' % (self.group_id, self.year)
+
+
+class YearStats(Model):
+    """Document totals for each year, and the number of groups with documents"""
+    year = Column('year', Integer(), primary_key=True, autoincrement=False)
+    docs = Column('docs', Integer(), nullable=False, default=0)
+    groups = Column('groups', Integer(), nullable=False, default=0)
+    pages = Column('pages', Integer(), nullable=False, default=0)
+    bytes = Column('bytes', Integer(), nullable=False, default=0)
+
+    def __repr__(self):
+        return 'YearStats<%d>' % self.year
+
+
+class DocSetYearStats(Model):
+    """Number of documents in each docset for each year"""
+    docset_id = Column('docset_id', Integer(), ForeignKey(DocSet.id), primary_key=True, autoincrement=False)
+    year = Column('year', Integer(), primary_key=True, autoincrement=False)
+    docs = Column('docs', Integer(), nullable=False, default=0)
+
+    def __repr__(self):
+        return 'DocSetYearStats<%d:%d>' % (self.docset_id, self.year)
+
+
+# Adding and removing a document from the stats tables, as trigger statements.
+# {d} is NEW or OLD.
+_STATS_ADD = """
+    INSERT OR IGNORE INTO group_year_stats (group_id, year, docs, pages, bytes)
+        VALUES (coalesce({d}.group_id, 0), coalesce({d}.year, 0), 0, 0, 0);
+    UPDATE group_year_stats SET docs = docs + 1, pages = pages + {d}.pages, bytes = bytes + {d}.size
+        WHERE group_id = coalesce({d}.group_id, 0) AND year = coalesce({d}.year, 0);
+    INSERT OR IGNORE INTO year_stats (year, docs, groups, pages, bytes)
+        VALUES (coalesce({d}.year, 0), 0, 0, 0, 0);
+    UPDATE year_stats SET docs = docs + 1, pages = pages + {d}.pages, bytes = bytes + {d}.size,
+                          groups = groups + ({d}.group_id IS NOT NULL AND
+                                             (SELECT docs FROM group_year_stats
+                                              WHERE group_id = {d}.group_id AND year = coalesce({d}.year, 0)) = 1)
+        WHERE year = coalesce({d}.year, 0);
+    INSERT OR IGNORE INTO doc_set_year_stats (docset_id, year, docs)
+        VALUES ({d}.docset_id, coalesce({d}.year, 0), 0);
+    UPDATE doc_set_year_stats SET docs = docs + 1
+        WHERE docset_id = {d}.docset_id AND year = coalesce({d}.year, 0);
+"""
+
+_STATS_REMOVE = """
+    UPDATE group_year_stats SET docs = docs - 1, pages = pages - {d}.pages, bytes = bytes - {d}.size
+        WHERE group_id = coalesce({d}.group_id, 0) AND year = coalesce({d}.year, 0);
+    UPDATE year_stats SET docs = docs - 1, pages = pages - {d}.pages, bytes = bytes - {d}.size,
+                          groups = groups - ({d}.group_id IS NOT NULL AND
+                                             (SELECT docs FROM group_year_stats
+                                              WHERE group_id = {d}.group_id AND year = coalesce({d}.year, 0)) = 0)
+        WHERE year = coalesce({d}.year, 0);
+    DELETE FROM group_year_stats WHERE group_id = coalesce({d}.group_id, 0) AND year = coalesce({d}.year, 0) AND docs <= 0;
+    DELETE FROM year_stats WHERE year = coalesce({d}.year, 0) AND docs <= 0;
+    UPDATE doc_set_year_stats SET docs = docs - 1
+        WHERE docset_id = {d}.docset_id AND year = coalesce({d}.year, 0);
+    DELETE FROM doc_set_year_stats WHERE docset_id = {d}.docset_id AND year = coalesce({d}.year, 0) AND docs <= 0;
+"""
+
+# Triggers do this rather than the ORM so that bulk inserts from the
+# importers and bulk deletes through the raw api are counted too.
+_STATS_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS document_stats_insert AFTER INSERT ON document BEGIN %s END' %
+    _STATS_ADD.format(d='NEW'),
+    'CREATE TRIGGER IF NOT EXISTS document_stats_delete AFTER DELETE ON document BEGIN %s END' %
+    _STATS_REMOVE.format(d='OLD'),
+    'CREATE TRIGGER IF NOT EXISTS document_stats_update AFTER UPDATE OF group_id, year, pages, size, docset_id '
+    'ON document BEGIN %s %s END' % (_STATS_REMOVE.format(d='OLD'), _STATS_ADD.format(d='NEW')),
+]
+
+for trigger in _STATS_TRIGGERS:
+    event.listen(Model.metadata, 'after_create', DDL(trigger).execute_if(dialect='sqlite'))
+
+
+def rebuild_stats(session):
+    """Recalculate all the stats tables from the documents"""
+    for table in (GroupYearStats, YearStats, DocSetYearStats):
+        session.query(table).delete()
+    group_id = func.coalesce(Document.group_id, 0)
+    year = func.coalesce(Document.year, 0)
+    q = session.query(group_id, year, func.count(Document.id), func.sum(Document.pages), func.sum(Document.size))\
+               .group_by(group_id, year)
+    session.execute(GroupYearStats.__table__.insert().from_select(['group_id', 'year', 'docs', 'pages', 'bytes'], q))
+    q = session.query(year, func.count(Document.id), func.count(Document.group_id.distinct()),
+                      func.sum(Document.pages), func.sum(Document.size))\
+               .group_by(year)
+    session.execute(YearStats.__table__.insert().from_select(['year', 'docs', 'groups', 'pages', 'bytes'], q))
+    q = session.query(Document.docset_id, year, func.count(Document.id))\
+               .group_by(Document.docset_id, year)
+    session.execute(DocSetYearStats.__table__.insert().from_select(['docset_id', 'year', 'docs'], q))
+    session.commit()
+
+
 class Tag(Model):
     """A tag which can be placed on a document"""
     id = Column('id', Integer(), primary_key=True)
@@ -229,6 +379,7 @@ class DocSegment(Model):
 
     @property
     def usertext(self):
+        """The latest review.  For many segments, use latest_reviews instead."""
         q = app.dbobj.session\
                      .query(DocSegmentReview)\
                      .filter(DocSegmentReview.segment_id == self.id)\
@@ -237,8 +388,9 @@ class DocSegment(Model):
 
     @property
     def besttext(self):
-        if self.usertext:
-            return self.usertext.text
+        usertext = self.usertext
+        if usertext:
+            return usertext.text
         else:
             return (self.ocrtext or '')
 
@@ -279,3 +431,104 @@ class DocSegmentReview(Model):
 
     def __repr__(self):
         return 'DocSegmentReview<%d:seg %d:no %d>' % (self.id, self.segment_id, self.rev)
+
+
+# unique_segment isn't made in the db either, and the bulk segment api
+# relies on this index to drop segments it already has.
+event.listen(Model.metadata, 'after_create',
+             DDL('CREATE UNIQUE INDEX IF NOT EXISTS doc_segment_location '
+                 'ON doc_segment (doc_id, page, x1, x2, y1, y2)')
+             .execute_if(dialect='sqlite'))
+
+# unique_review isn't made in the db, so this is what finds a segment's
+# reviews.  Made this way so that create_all adds it to older dbs.
+event.listen(Model.metadata, 'after_create',
+             DDL('CREATE INDEX IF NOT EXISTS doc_segment_review_latest ON doc_segment_review (segment_id, rev)')
+             .execute_if(dialect='sqlite'))
+
+# Segment ids per query, under SQLite's limit on query parameters
+_LATEST_CHUNK = 500
+
+
+def latest_reviews(segment_ids):
+    """
+    Map of segment id to its latest DocSegmentReview, for those of the
+    segments which have been reviewed.  Does the same as usertext, for many
+    segments at once.
+    """
+    session = app.dbobj.session
+    ids = list(set(segment_ids))
+    result = {}
+    for start in range(0, len(ids), _LATEST_CHUNK):
+        rownum = func.row_number().over(partition_by=DocSegmentReview.segment_id,
+                                        order_by=DocSegmentReview.rev.desc())
+        ranked = session.query(DocSegmentReview.id.label('id'), rownum.label('rownum'))\
+                        .filter(DocSegmentReview.segment_id.in_(ids[start:start + _LATEST_CHUNK]))\
+                        .subquery()
+        q = session.query(DocSegmentReview)\
+                   .join(ranked, ranked.c.id == DocSegmentReview.id)\
+                   .filter(ranked.c.rownum == 1)
+        result.update((r.segment_id, r) for r in q)
+    return result
+
+
+class ReviewPage(Model):
+    """
+    A page with OCR'd segments, in the queue for review.  minviews is the
+    fewest views of any segment on it, so pages most in need of review come
+    first.  A reviewer who is handed a page holds it until lease_until (unix
+    time), so nobody else gets it meanwhile.  Kept up to date by triggers on
+    doc_segment, see _REVIEW_TRIGGERS.  Pages are 0-indexed, as for segments.
+    """
+    doc_id = Column('doc_id', Integer(), ForeignKey(Document.id), primary_key=True, autoincrement=False)
+    page = Column('page', Integer(), primary_key=True, autoincrement=False)
+    minviews = Column('minviews', Integer(), nullable=False, default=0)
+    lease_until = Column('lease_until', Integer(), nullable=False, default=0)
+    lease_user = Column('lease_user', Integer(), nullable=True)
+
+    __table_args__ = (Index('review_page_queue', 'minviews', 'lease_until'),)
+
+    def __repr__(self):
+        return 'ReviewPage<%d:%d>' % (self.doc_id, self.page)
+
+
+_REVIEW_MINVIEWS = """
+    (SELECT min(viewcount) FROM doc_segment
+     WHERE doc_id = {d}.doc_id AND page = {d}.page AND ocrtext IS NOT NULL)
+"""
+
+# Look at the page a segment was or is on again.  {d} is NEW or OLD.
+_REVIEW_REFRESH = """
+    DELETE FROM review_page WHERE doc_id = {d}.doc_id AND page = {d}.page AND {minviews} IS NULL;
+    UPDATE review_page SET minviews = {minviews} WHERE doc_id = {d}.doc_id AND page = {d}.page;
+"""
+
+_REVIEW_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS segment_review_insert AFTER INSERT ON doc_segment '
+    'WHEN NEW.ocrtext IS NOT NULL BEGIN '
+    'INSERT OR IGNORE INTO review_page (doc_id, page, minviews, lease_until) '
+    'VALUES (NEW.doc_id, NEW.page, NEW.viewcount, 0); '
+    'UPDATE review_page SET minviews = min(minviews, NEW.viewcount) WHERE doc_id = NEW.doc_id AND page = NEW.page; '
+    'END',
+    'CREATE TRIGGER IF NOT EXISTS segment_review_delete AFTER DELETE ON doc_segment BEGIN %s END' %
+    _REVIEW_REFRESH.format(d='OLD', minviews=_REVIEW_MINVIEWS.format(d='OLD')),
+    'CREATE TRIGGER IF NOT EXISTS segment_review_update AFTER UPDATE OF viewcount, ocrtext, doc_id, page '
+    'ON doc_segment BEGIN '
+    'INSERT OR IGNORE INTO review_page (doc_id, page, minviews, lease_until) '
+    'SELECT NEW.doc_id, NEW.page, NEW.viewcount, 0 WHERE NEW.ocrtext IS NOT NULL; '
+    '%s %s END' % (_REVIEW_REFRESH.format(d='OLD', minviews=_REVIEW_MINVIEWS.format(d='OLD')),
+                   _REVIEW_REFRESH.format(d='NEW', minviews=_REVIEW_MINVIEWS.format(d='NEW'))),
+]
+
+for trigger in _REVIEW_TRIGGERS:
+    event.listen(Model.metadata, 'after_create', DDL(trigger).execute_if(dialect='sqlite'))
+
+
+def rebuild_review_queue(session):
+    """Refill the review queue from the segments.  Any leases are dropped."""
+    session.query(ReviewPage).delete()
+    q = session.query(DocSegment.doc_id, DocSegment.page, func.min(DocSegment.viewcount))\
+               .filter(DocSegment.ocrtext != None)\
+               .group_by(DocSegment.doc_id, DocSegment.page)
+    session.execute(ReviewPage.__table__.insert().from_select(['doc_id', 'page', 'minviews'], q))
+    session.commit()
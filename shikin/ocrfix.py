@@ -1,7 +1,9 @@
 import re
-from collections import Counter
 import editdistance
 
+from sqlalchemy import func, select, literal, union_all
+
+from . import app
 from .model import DocSegmentReview, DocSegment
 
 number_re = re.compile('(\d{1,3})(([., ]{1,2}\d\d\d)+)')
@@ -27,24 +29,43 @@ def suggestions(seg, n=5):
     Collect up to n OCR corrections which are for similar segments to the
     given one.  Similar in this context means appearing in the same column.
     """
-    q = DocSegmentReview.query.join(DocSegment)\
-                        .filter(DocSegmentReview.text != seg.ocrtext)\
-                        .filter(DocSegment.x1 >= seg.x1-50)\
-                        .filter(DocSegment.x2 <= seg.x2+50)\
-                        .order_by(DocSegmentReview.rev.desc())
-
-    currenttxt = seg.besttext
-    similar = q.all()
-    texts = []
-    seen = set()
-    for s in similar:
-        if s.segment_id in seen:
-            continue
-        texts.append(s.text)
-        seen.add(s.segment_id)
+    return suggestions_for([seg], n)[seg.id]
 
-    c = Counter(texts)
 
+def suggestions_for(segs, n=5):
+    """
+    suggestions() for many segments at once, eg all those on a page, as a map
+    of segment id to suggestions.  Segments in the same column share a band
+    of x positions, and the most common latest reviews in each band are
+    counted in one query, so only the top few of each come back.
+    """
+    if not segs:
+        return {}
+    session = app.dbobj.session
+    bands = sorted(set((s.x1, s.x2) for s in segs))
+    bands = union_all(*[select(literal(x1).label('x1'), literal(x2).label('x2'))
+                        for x1, x2 in bands]).cte('bands')
 
+    latest_rev = session.query(func.max(DocSegmentReview.rev))\
+                        .filter(DocSegmentReview.segment_id == DocSegment.id)\
+                        .correlate(DocSegment).scalar_subquery()
+    count = func.count()
+    rank = func.row_number().over(partition_by=(bands.c.x1, bands.c.x2),
+                                  order_by=(count.desc(), DocSegmentReview.text))
+    in_band = (DocSegment.x1 >= bands.c.x1 - 50) & (DocSegment.x2 <= bands.c.x2 + 50)
+    counts = session.query(bands.c.x1, bands.c.x2, DocSegmentReview.text, rank.label('rank'))\
+                    .join(DocSegment, in_band)\
+                    .join(DocSegmentReview, (DocSegmentReview.segment_id == DocSegment.id) &
+                          (DocSegmentReview.rev == latest_rev))\
+                    .group_by(bands.c.x1, bands.c.x2, DocSegmentReview.text)\
+                    .subquery()
+    # One more than needed, as a segment's own OCR text isn't suggested
+    q = session.query(counts.c.x1, counts.c.x2, counts.c.text)\
+               .filter(counts.c.rank <= n + 1)\
+               .order_by(counts.c.x1, counts.c.x2, counts.c.rank)
 
-    return [x[0] for x in c.most_common(n)]
+    common = {}
+    for x1, x2, text in q:
+        common.setdefault((x1, x2), []).append(text)
+    return {seg.id: [text for text in common.get((seg.x1, seg.x2), []) if text != seg.ocrtext][:n]
+            for seg in segs}
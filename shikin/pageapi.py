@@ -4,11 +4,13 @@ Pager API calls for use with DataTables on the frontend
 
 from flask import request, jsonify, abort
 from . import app
-from .model import Group, Document, GroupType, DocSet  # , DocType, PubType
+from .model import Group, Document, GroupType, DocSet, YearStats, DocSetYearStats  # , DocType, PubType
 
 
 from sqlalchemy import desc, func
 
+from .search import matching_ids, GROUP
+
 
 def _order_by_name(isdesc):
     return Group.name.desc() if isdesc else Group.name
@@ -19,7 +21,7 @@ def _order_by_type_name(isdesc):
 
 
 def _order_by_doccount(isdesc):
-    x = func.count(Group.docs)
+    x = func.count(Document.id)
     return desc(x) if isdesc else x
 
 
@@ -32,13 +34,9 @@ _group_order_funcs = {
 
 @app.route('/api/summary/stats')
 def all_stats():
-    q = Document.query.filter(Document.year > 2008)\
-                .group_by(Document.year)\
-                .order_by(Document.year)\
-                .add_columns(Document.year, func.count(Document.id), func.count(Document.group_id.distinct()),
-                             func.sum(Document.pages), func.sum(Document.size))
-    data = q.all()
-    data = [{'year': x[1], 'docs': x[2], 'groups': x[3], 'pages': x[4], 'bytes': x[5]} for x in data]
+    q = YearStats.query.filter(YearStats.year > 2008)\
+                 .order_by(YearStats.year)
+    data = [{'year': x.year, 'docs': x.docs, 'groups': x.groups, 'pages': x.pages, 'bytes': x.bytes} for x in q.all()]
     return jsonify({'years': data})
 
 
@@ -58,17 +56,14 @@ def group_pager(parentid=None):
     count = int(args.get('length') or '10')
     start = int(args.get('start') or '0')
 
-    allgroupquery = Group.query
-    if parentid is not None:
-        allgroupquery = allgroupquery.filter(Group.parent_id == parentid)
-    allgroupcount = allgroupquery.count()
-
-    # TODO. sorting, searching.
-    q = Group.query.join(Document).join(GroupType).add_columns(func.count(Document.id)).group_by(Group.id)  # .filter(..)
+    session = app.dbobj.session
 
+    allgroupquery = session.query(func.count(Group.id))
     if parentid is not None:
-        q = q.filter(Group.parent_id == parentid)
+        allgroupquery = allgroupquery.filter(Group.parent_id == parentid)
+    allgroupcount = allgroupquery.scalar()
 
+    orders = []
     for i in range(100):
         odir_s = 'order[%d][dir]' % i
         ocol_s = 'order[%d][column]' % i
@@ -77,37 +72,77 @@ def group_pager(parentid=None):
         isdesc = args[odir_s] == 'desc'
         cno = int(args[ocol_s])
         cname = args['columns[%d][data]' % cno]
+        orders.append((cname, isdesc))
+
+    # First find the ids of the groups on this page.  Only groups with
+    # documents are listed.  Unless we're sorting by the count that only needs
+    # an EXISTS, so with the name index sqlite can stop once it has the page.
+    q = session.query(Group.id).join(GroupType, GroupType.id == Group.type_id)
+    if any(cname == 'doccount' for cname, isdesc in orders):
+        q = q.join(Document, Document.group_id == Group.id).group_by(Group.id)
+    else:
+        q = q.filter(Group.docs.any())
+
+    # Counting the groups with documents only needs the document table,
+    # unless we have to filter on the group.
+    countq = session.query(func.count(Document.group_id.distinct()))
+
+    if parentid is not None:
+        q = q.filter(Group.parent_id == parentid)
+        countq = countq.join(Group, Document.group_id == Group.id).filter(Group.parent_id == parentid)
+
+    for cname, isdesc in orders:
         q = q.order_by(_group_order_funcs[cname](isdesc))
+    # Keep paging stable when there are ties
+    q = q.order_by(Group.id)
 
     sval = args.get('search[value]')
     if sval:
-        q = q.filter(Group.name.like('%'+sval+'%'))
-
-    q_offset = q.offset(start).limit(count)
-
-    data = list([{'id': x.id, 'name': x.name, 'typename': x.type.name,
-                  'doccount': c, 'minyear': x.minyear,
-                  'maxyear': x.maxyear} for x, c in q_offset.all()])
+        q = q.filter(Group.id.in_(matching_ids(GROUP, sval)))
+        countq = countq.filter(Document.group_id.in_(matching_ids(GROUP, sval)))
+
+    page_ids = [gid for (gid,) in q.offset(start).limit(count)]
+
+    # Then everything for the rows on the page in one go, so there are no
+    # lazy loads or aggregate queries per row.
+    rows = {}
+    if page_ids:
+        rowq = session.query(Group.id, Group.name, GroupType.name, func.count(Document.id),
+                             func.min(Document.year), func.max(Document.year))\
+                      .join(Document, Document.group_id == Group.id)\
+                      .join(GroupType, GroupType.id == Group.type_id)\
+                      .filter(Group.id.in_(page_ids))\
+                      .group_by(Group.id)
+        rows = {x[0]: x for x in rowq}
+
+    data = list([{'id': gid, 'name': name, 'typename': typename,
+                  'doccount': c, 'minyear': minyear,
+                  'maxyear': maxyear} for gid, name, typename, c, minyear, maxyear in
+                 (rows[x] for x in page_ids)])
 
     result = {'draw': args.get('draw'), 'recordsTotal': allgroupcount,
-              'recordsFiltered': q.count(), 'data': data}
+              'recordsFiltered': countq.scalar(), 'data': data}
 
     return jsonify(result)
 
 
 @app.route('/api/summary/year')
 def year_summary():
-    q = app.dbobj.session.query(Document.year.distinct(), func.count(Document.id))\
-                 .order_by(Document.year).group_by(Document.year)
+    # Undated documents are counted under year 0, which isn't a year
+    q = app.dbobj.session.query(YearStats.year, YearStats.docs)\
+                         .filter(YearStats.year != 0)\
+                         .order_by(YearStats.year)
     data = dict(q.all())
     return jsonify(data)
 
 
 @app.route('/api/summary/doc_sets')
 def docset_summary():
+    # Undated documents (year 0 in the stats) count, but don't give a year
     q = app.dbobj.session\
-           .query(DocSet, func.count(Document.id), func.min(Document.year), func.max(Document.year))\
-           .join(Document)\
+           .query(DocSet, func.sum(DocSetYearStats.docs),
+                  func.min(func.nullif(DocSetYearStats.year, 0)), func.max(func.nullif(DocSetYearStats.year, 0)))\
+           .join(DocSetYearStats, DocSetYearStats.docset_id == DocSet.id)\
            .group_by(DocSet.id)
     data = [{'id': x.id, 'pubtype_id': x.pubtype_id, 'doctype_id': x.doctype_id,
              'published': str(x.published), 'doccount': count,
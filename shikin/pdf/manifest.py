@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of the thumbnails made for each pdf.
+
+Each pdf has a row, keyed by its path under the pdf root, with the size,
+mtime and sha1 of the pdf the thumbnails were made from, the settings they
+were made with and whether the PNGs have been through optipng.  A pdf whose
+size and mtime still match needs nothing doing, so a run over a tree with
+only a few new pdfs is a stat of each.  If the size or mtime has changed the
+pdf is hashed, and only remade if its contents have.
+
+The web app reads it to find which thumbnails a document has, rather than
+looking for the files.
+"""
+
+import time
+import sqlite3
+import hashlib
+import threading
+
+from . import pdfimages
+from .thumbnails import THUMBNAIL_WIDTHS, THUMBNAIL_FORMATS, WEBP_QUALITY
+
+# What a pdf needs doing
+FRESH = 'fresh'
+OPTIMISE = 'optimise'
+RENDER = 'render'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS thumbnail (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    widths TEXT NOT NULL,
+    formats TEXT NOT NULL,
+    optimised INTEGER NOT NULL,
+    made INTEGER NOT NULL
+);
+"""
+
+
+def render_settings():
+    """Settings which change how thumbnails look, besides their sizes and formats"""
+    return 'density=%d webp_quality=%d' % (pdfimages.RENDER_DENSITY, WEBP_QUALITY)
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _join(vals):
+    return ','.join(str(x) for x in vals)
+
+
+class ThumbnailManifest():
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        The row for a pdf, as a dict with widths and formats as lists, or None
+        if it has no thumbnails.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT * FROM thumbnail WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        row['widths'] = [int(x) for x in row['widths'].split(',')]
+        row['formats'] = row['formats'].split(',')
+        return row
+
+    def status(self, path, pdf_fullpath, size, mtime, optimise):
+        """
+        What needs doing for a pdf to have up to date thumbnails: RENDER,
+        OPTIMISE if only optipng needs running, or FRESH.
+        """
+        row = self.get(path)
+        if row is None or row['settings'] != render_settings() or \
+                row['widths'] != list(THUMBNAIL_WIDTHS) or row['formats'] != list(THUMBNAIL_FORMATS):
+            return RENDER
+        if (row['size'], row['mtime']) != (size, mtime):
+            if file_sha1(pdf_fullpath) != row['sha1']:
+                return RENDER
+            # Copied or touched, but the same pdf
+            with self.lock, self.db:
+                self.db.execute('UPDATE thumbnail SET size = ?, mtime = ? WHERE path = ?', (size, mtime, path))
+        if optimise and not row['optimised']:
+            return OPTIMISE
+        return FRESH
+
+    def record(self, path, size, mtime, sha1, optimised=False):
+        """Record the thumbnails just made for a pdf with the current settings"""
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO thumbnail (path, size, mtime, sha1, settings, widths, formats, '
+                            'optimised, made) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (path, size, mtime, sha1, render_settings(), _join(THUMBNAIL_WIDTHS),
+                             _join(THUMBNAIL_FORMATS), int(optimised), int(time.time())))
+
+    def set_optimised(self, path):
+        with self.lock, self.db:
+            self.db.execute('UPDATE thumbnail SET optimised = 1 WHERE path = ?', (path,))
+
+    def forget(self, path):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM thumbnail WHERE path = ?', (path,))
+
+    def close(self):
+        self.db.close()
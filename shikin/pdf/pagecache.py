@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of rendered page images.
+
+Getting a page image out of a pdf means running pdfimages and maybe convert,
+and pdfinfo too if the page rotations weren't recorded at import, which takes
+seconds.  Rendered pages are kept in a directory, named
+by a hash of what went into them - the doc, page, rotation, width and format,
+and the size and mtime of the pdf so a replaced pdf gets new images.  Since the name
+says what's in the file, it also makes a good ETag.
+
+Only one request renders any page at once: others wanting the same page wait
+on a lock file for it and then use the result.  File mtimes are touched on
+each use, and when the cache grows past its size limit the least recently
+used files go first.
+"""
+import os
+import time
+import fcntl
+import logging
+import hashlib
+import threading
+from tempfile import mkstemp
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from PIL import Image
+
+from . import pdfimages
+from .util import get_page_rots
+from .thumbnails import scale_image, save_image
+
+# Go down to this much of the limit when evicting, so as not to evict on
+# every new page.
+EVICT_TO = 0.9
+
+# Images being rendered
+TMP_SUFFIX = '.tmp.png'
+
+# Page rotations of this many pdfs are remembered
+ROTATIONS_KEPT = 256
+
+
+class PageCache():
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total = None
+        self.rots = OrderedDict()
+
+    def rotation(self, pdf_path, pageno, stat):
+        """
+        Rotation of page pageno (1-indexed) of a pdf, for pdfs without
+        recorded rotations.  The last ROTATIONS_KEPT pdfs' are remembered so
+        pdfinfo runs once for pages read one after another.
+        """
+        key = (pdf_path, stat.st_size, stat.st_mtime)
+        with self.lock:
+            rots = self.rots.get(key)
+            if rots is not None:
+                self.rots.move_to_end(key)
+        if rots is None:
+            rots = get_page_rots(pdf_path)
+            with self.lock:
+                self.rots[key] = rots
+                while len(self.rots) > ROTATIONS_KEPT:
+                    self.rots.popitem(last=False)
+        return rots.get(pageno, 0)
+
+    def render(self, pdf_path, pageno, dest, rot, width, fmt='png'):
+        """
+        Render page pageno (1-indexed) of a pdf as a PNG (or fmt) in dest,
+        rotated by rot degrees and scaled down to width if given.  Returns
+        False if there is no such page.
+        """
+        img = None
+        for n, img in pdfimages.pdf_images(pdf_path, pageno, pageno, rotation=rot):
+            break
+        if img is None:
+            # No images in it, so render the page.  convert does the rotation.
+            pdfimages.render_page(pdf_path, pageno, dest, optimise=False)
+            if not os.path.exists(dest) or not os.path.getsize(dest):
+                return False
+            if not width and fmt == 'png':
+                return True
+            img = Image.open(dest)
+        save_image(scale_image(img, width), dest, fmt)
+        return True
+
+    def key(self, docid, pageno, rot, width, stat, fmt='png'):
+        ident = '%d:%d:%d:%d:%d:%d' % (docid, pageno, rot, width or 0, stat.st_size, int(stat.st_mtime))
+        if fmt != 'png':
+            ident += ':' + fmt
+        return hashlib.sha1(ident.encode('ascii')).hexdigest()
+
+    def path(self, key, fmt='png'):
+        return os.path.join(self.root, key[:2], key + '.' + fmt)
+
+    def get(self, pdf_path, docid, pageno, width=None, rot=None, fmt='png'):
+        """
+        Return (path, key) of the image of page pageno (1-indexed) of a pdf,
+        as a PNG or fmt, rendering it if it isn't cached yet.  rot is the
+        page's rotation if it's known.  Returns None if there's no such page.
+        """
+        stat = os.stat(pdf_path)
+        if rot is None:
+            rot = self.rotation(pdf_path, pageno, stat)
+        key = self.key(docid, pageno, rot, width, stat, fmt)
+        path = self.path(key, fmt)
+        if self._touch(path):
+            return path, key
+
+        with self._single_flight(key):
+            # Someone else may have made it while we waited
+            if self._touch(path):
+                return path, key
+            # convert goes by the extension
+            fd, tmp = mkstemp(dir=os.path.dirname(path), suffix=TMP_SUFFIX)
+            os.close(fd)
+            try:
+                start = time.time()
+                if not self.render(pdf_path, pageno, tmp, rot, width, fmt):
+                    return None
+                os.replace(tmp, path)
+                logging.debug('Rendered page %d of %s in %.1fs' % (pageno, pdf_path, time.time() - start))
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        self._added(os.path.getsize(path))
+        return path, key
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def _single_flight(self, key):
+        """Hold the lock for rendering one page, shared by all processes"""
+        lockpath = self.path(key) + '.lock'
+        os.makedirs(os.path.dirname(lockpath), exist_ok=True)
+        with open(lockpath, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                # Anyone still waiting on this lock will find the page made
+                try:
+                    os.unlink(lockpath)
+                except FileNotFoundError:
+                    pass
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _added(self, size):
+        with self.lock:
+            if self.total is None:
+                self.total = self._evict(self.max_bytes)
+            else:
+                self.total += size
+            if self.total > self.max_bytes:
+                self.total = self._evict(int(self.max_bytes * EVICT_TO))
+
+    def _evict(self, limit):
+        """Remove least recently used images until there are at most limit bytes.  Returns what's left."""
+        files = []
+        for root, dirs, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(('.png', '.webp')) and not name.endswith(TMP_SUFFIX):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(x[1] for x in files)
+        for mtime, size, path in sorted(files):
+            if total <= limit:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        return total
@@ -1,55 +1,134 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import glob
+import re
+import time
 import logging
 import shlex
 import subprocess
 from tempfile import TemporaryDirectory
-from .util import get_rot, optimise_png, rotate_png
 
+from PIL import Image
 
-def extract_images(pdf_fullpath, optimise=True, autorotate=True, firstpage=1, lastpage=1):
-    """
-    Extract images from the given pdf using pdfimages.  Optionally
-    automatically flip and rotate the images as they come out.  Yields a series
-    of PNG paths.  Pages are 1-indexed!
+from .util import get_page_rots, optimise_png
+
+
+# A line of pdfimages -list output: page, num, type, width, height, ...
+_list_re = re.compile(r'^\s*(\d+)\s+(\d+)\s+(\S+)\s+(\d+)\s+(\d+)\s', re.M)
+
+# Seconds between looks for pdfimages having finished an image
+_POLL = 0.01
 
-    PNGs are created in a temporary directory, and can be moved or copied.  The
-    directory and its contents will be deleted once the function completes.
+# Dots per inch for pages rendered by convert
+RENDER_DENSITY = 200
+
+
+def dominant_images(listing):
+    """
+    From the output of pdfimages -list, the number of the biggest image on
+    each page, as {pageno: num}.  Masks and the like are skipped.
     """
-    if autorotate:
-        rot = get_rot(pdf_fullpath)
-    else:
-        rot = 0
+    best = {}
+    for page, num, itype, width, height in _list_re.findall(listing):
+        if itype != 'image':
+            continue
+        page, num, area = int(page), int(num), int(width) * int(height)
+        if page not in best or area > best[page][1]:
+            best[page] = (num, area)
+    return {page: num for page, (num, area) in best.items()}
+
+
+def _page_args(firstpage, lastpage):
+    args = ['-f', str(firstpage)]
+    if lastpage:
+        args += ['-l', str(lastpage)]
+    return args
+
+
+def list_images(pdf_fullpath, firstpage=1, lastpage=None):
+    """The biggest image on each page of a pdf, see dominant_images"""
+    command = ['pdfimages', '-list'] + _page_args(firstpage, lastpage) + [pdf_fullpath]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return dominant_images(result.stdout.decode('utf-8', 'replace'))
 
-    with TemporaryDirectory() as tmpdirname:
-        outfile_prefix = os.path.join(tmpdirname, 'thumb')
-        lastpagestr = '-l %d' % lastpage if lastpage else ''
-        command = 'pdfimages -p -f %d %s -png "%s" "%s"' % (firstpage, lastpagestr, pdf_fullpath, outfile_prefix)
-        split = shlex.split(command)
-        subprocess.call(split)
-        outpattern = outfile_prefix + '-%03d-*.png'
 
-        pageno = firstpage
-        while glob.glob(outpattern % pageno):
-            # there could be multiple images - find the big one.
-            outfiles = glob.glob(outpattern % pageno)
-            outfile = max(outfiles, key=lambda x: os.stat(x).st_size)
-            logging.debug(" .. biggest is %s" % outfile)
-            outfile = rotate_png(outfile, rot)
+_TRANSPOSE = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
 
-            if optimise:
-                outfile = optimise_png(outfile)
 
-            yield outfile
-            pageno += 1
+def rotate_image(img, rot):
+    """Turn an image rot degrees clockwise"""
+    rot = rot % 360
+    if not rot:
+        return img
+    if rot in _TRANSPOSE:
+        return img.transpose(_TRANSPOSE[rot])
+    return img.rotate(-rot, expand=True)
+
+
+def _image_num(filename):
+    """The image number from a pdfimages -p output file name, prefix-page-num.png"""
+    try:
+        return int(os.path.splitext(filename)[0].rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return -1
+
+
+def _wait_for_image(proc, dirname, num):
+    """Wait until pdfimages has finished image num, which it has once it starts on the next"""
+    while proc.poll() is None:
+        if any(_image_num(name) > num for name in os.listdir(dirname)):
+            return
+        time.sleep(_POLL)
+
+
+def pdf_images(pdf_fullpath, firstpage=1, lastpage=None, rotation=None):
+    """
+    Yield (pageno, image) for each page of a pdf from firstpage to lastpage
+    (the end if None).  The image is the biggest one on the page, as a PIL
+    image, turned upright.  Pages without images are skipped.  Pages are
+    1-indexed!
+
+    All the pages are extracted by one run of pdfimages, and each page is
+    yielded as soon as it's out.  rotation is degrees clockwise to turn the
+    images, either for all pages or as a {pageno: rot} dict.  If None each
+    page's rotation is looked up with pdfinfo.
+    """
+    dominant = list_images(pdf_fullpath, firstpage, lastpage)
+    if not dominant:
+        return
+    if rotation is None:
+        rotation = get_page_rots(pdf_fullpath, firstpage, lastpage)
+
+    with TemporaryDirectory() as tmpdirname:
+        outfile_prefix = os.path.join(tmpdirname, 'img')
+        command = ['pdfimages', '-p', '-png'] + _page_args(firstpage, lastpage) + [pdf_fullpath, outfile_prefix]
+        proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for pageno in sorted(dominant):
+                num = dominant[pageno]
+                _wait_for_image(proc, tmpdirname, num)
+                path = '%s-%03d-%03d.png' % (outfile_prefix, pageno, num)
+                if not os.path.exists(path):
+                    logging.warning("pdfimages didn't make image %d of page %d of %s" % (num, pageno, pdf_fullpath))
+                    continue
+                img = Image.open(path)
+                img.load()
+                # Done with this page and any images before it
+                for name in os.listdir(tmpdirname):
+                    if _image_num(name) <= num:
+                        os.unlink(os.path.join(tmpdirname, name))
+                rot = rotation.get(pageno, 0) if isinstance(rotation, dict) else rotation
+                yield pageno, rotate_image(img, rot)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
 
 
 def render_page(pdf_fullpath, pageno, dest, optimise=True, autorotate=True):
     # TODO: autorotate?
     try:
-        command = 'convert -density 200 "%s"[%d] "%s"' % (pdf_fullpath, pageno - 1, dest)
+        command = 'convert -density %d "%s"[%d] "%s"' % (RENDER_DENSITY, pdf_fullpath, pageno - 1, dest)
         split = shlex.split(command)
         subprocess.call(split)
 
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Scaled down page images, as used for thumbnails and review pages.
+
+Document thumbnails come in a few widths, each as WebP and as PNG for
+browsers without WebP, next to where the single full size <pdf>_thumb.png
+used to be.  Scaled page images are mostly grey edges of text, which lossy
+WebP keeps legible in a fraction of the size of a PNG.
+"""
+import os
+
+from PIL import Image
+
+# List thumbnail and document page preview
+THUMBNAIL_WIDTHS = (240, 800)
+THUMBNAIL_FORMATS = ('webp', 'png')
+
+WEBP_QUALITY = 80
+
+
+def scale_image(img, width):
+    """img scaled down to width, keeping its shape.  Not scaled up."""
+    if not width or img.width <= width:
+        return img
+    if img.mode not in ('L', 'RGB'):
+        # Scaling a bilevel image makes grey, so do it as greyscale
+        img = img.convert('L' if img.mode == '1' else 'RGB')
+    return img.resize((width, img.height * width // img.width), Image.LANCZOS)
+
+
+def save_image(img, dest, fmt='png'):
+    if fmt == 'webp':
+        if img.mode not in ('L', 'RGB', 'RGBA'):
+            img = img.convert('L' if img.mode == '1' else 'RGB')
+        img.save(dest, 'WEBP', quality=WEBP_QUALITY, method=6)
+    else:
+        img.save(dest, 'PNG')
+
+
+def thumbnail_base(thumbnailpath):
+    """Thumbnail paths (or urls) without the _thumb.png, for thumbnail_name"""
+    return thumbnailpath[:-len('_thumb.png')] if thumbnailpath.endswith('_thumb.png') else thumbnailpath
+
+
+def thumbnail_name(base, width, fmt):
+    return '%s_thumb-%d.%s' % (base, width, fmt)
+
+
+def thumbnail_names(base):
+    """All the (width, fmt, path) thumbnails of a pdf, made by write_thumbnails"""
+    return [(width, fmt, thumbnail_name(base, width, fmt))
+            for width in THUMBNAIL_WIDTHS for fmt in THUMBNAIL_FORMATS]
+
+
+def write_thumbnails(img, base):
+    """
+    Save each size and format of thumbnail of the image.  Each file is
+    written under another name and moved into place, so a reader never sees
+    half of one.  Returns the paths written.
+    """
+    written = []
+    for width, fmt, path in thumbnail_names(base):
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            save_image(scale_image(img, width), tmppath, fmt)
+            os.replace(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+        written.append(path)
+    return written
@@ -5,38 +5,43 @@ import re
 import subprocess
 import os
 
-_rot_re = re.compile("Page rot:       (\d+)")
+_page_rot_re = re.compile(r'^Page\s+(\d+) rot:\s+(\d+)', re.M)
 
+# A last page for pdfinfo -l meaning all of them, since it stops at the real
+# last page if asked for more
+ALL_PAGES = 1000000
 
-def get_rot(pdf_fullpath):
-    # First decide if the pages are upside-down
-    p = subprocess.Popen(['pdfinfo', pdf_fullpath], stdout=subprocess.PIPE)
-    (stdoutdata, stderrdata) = p.communicate()
 
-    rot = _rot_re.search(stdoutdata)
-    if not rot:
-        logging.warn("Didn't get rot info for %s" % pdf_fullpath)
-        rot = 0
-    else:
-        rot = int(rot.groups()[0])
-    return rot
+def parse_page_rots(info):
+    """Rotation of each page from pdfinfo -f <first> -l <last> output, as {pageno: rot}"""
+    return dict((int(page), int(rot)) for page, rot in _page_rot_re.findall(info))
 
 
-def optimise_png(path):
-    logging.debug("Optimising %s" % (path,))
-    subprocess.call(['optipng', '-q', path])
-    return path
+def get_page_rots(pdf_fullpath, firstpage=1, lastpage=None):
+    """
+    Rotation of each page of a pdf from firstpage to lastpage (the end if
+    None), as {pageno: rot} with 1-indexed pages.  Pages of one pdf can each
+    be turned differently.  Empty if pdfinfo couldn't read the pdf.
+    """
+    p = subprocess.Popen(['pdfinfo', '-f', str(firstpage), '-l', str(lastpage or ALL_PAGES), pdf_fullpath],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdoutdata, stderrdata) = p.communicate()
+    if p.returncode:
+        logging.warning("Didn't get rot info for %s" % pdf_fullpath)
+        return {}
+    return parse_page_rots(stdoutdata.decode('utf-8', 'replace'))
 
 
-def rotate_png(path, rot):
-    if not rot:
-        return path
-    logging.debug("unflipping %s" % (path,))
-    path_flip = path + '-flip.png'
-    cmd = ['convert', path, '-rotate', str(rot), path_flip]
-    subprocess.call(cmd)
-    if not os.path.exists(path_flip):
-        logging.warn("%s didn't get made :(" % path_flip)
-    else:
-        path = path_flip
+def optimise_png(path):
+    """
+    Run optipng on a png.  The smaller file replaces the original in one go,
+    so anything reading it meanwhile never sees half a file.
+    """
+    logging.debug("Optimising %s" % (path,))
+    tmp = path + '.opt.png'
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    subprocess.call(['optipng', '-q', '-out', tmp, path])
+    if os.path.exists(tmp):
+        os.replace(tmp, path)
     return path
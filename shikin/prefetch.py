@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering page images ahead of the review page asking for them.
+
+A few worker threads render pages into the page cache from a short queue, at
+the size and in the format the review page asks for.
+When the queue is full new pages are dropped rather than waited for, so
+however many reviewers there are, each web process runs at most
+PREFETCH_WORKERS renders at once.
+"""
+
+import logging
+import threading
+from queue import Queue, Full
+
+from . import app
+from .api import get_page_cache
+
+
+class Prefetcher():
+    def __init__(self, workers, queue_size, render):
+        """render(pdf_path, docid, pageno, rot) makes a page image, pageno is 1-indexed"""
+        self.workers = workers
+        self.render = render
+        self.queue = Queue(queue_size)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.threads = []
+
+    def _start(self):
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._work, name='prefetch-%d' % len(self.threads))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, pdf_path, docid, pageno, rot=None):
+        """
+        Queue a page to be rendered, turned by rot if its rotation is known.
+        Returns False if it was dropped.
+        """
+        key = (docid, pageno)
+        with self.lock:
+            if key in self.pending:
+                return True
+            try:
+                self.queue.put_nowait((pdf_path, docid, pageno, rot))
+            except Full:
+                return False
+            self.pending.add(key)
+            self._start()
+        return True
+
+    def _work(self):
+        while True:
+            pdf_path, docid, pageno, rot = self.queue.get()
+            try:
+                self.render(pdf_path, docid, pageno, rot)
+            except Exception:
+                logging.exception('Prefetching page %d of %s' % (pageno, pdf_path))
+            with self.lock:
+                self.pending.discard((docid, pageno))
+            self.queue.task_done()
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher():
+    """The prefetcher for this process, or None if prefetching is turned off"""
+    global _prefetcher
+    if not app.config.get('PREFETCH_WORKERS'):
+        return None
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher(app.config['PREFETCH_WORKERS'], app.config['PREFETCH_QUEUE'],
+                                     lambda pdf_path, docid, pageno, rot:
+                                     get_page_cache().get(pdf_path, docid, pageno, app.config['REVIEW_PAGE_WIDTH'],
+                                                          rot=rot, fmt='webp'))
+    return _prefetcher
@@ -3,14 +3,16 @@
 Shikin review page and associated API
 """
 
-from sqlalchemy import func
+import time
 import datetime
-import random
-from flask import render_template, abort, request, jsonify, session
+from flask import render_template, abort, request, jsonify, session, url_for
+from sqlalchemy.orm import joinedload
 
 from . import app, ocrfix
-from .model import DocSegment, DocSegmentReview, User
+from .model import Document, DocSegment, DocSegmentReview, User, ReviewPage, latest_reviews
 from .util import dologin
+from .api import pdf_fullpath
+from .prefetch import get_prefetcher
 
 
 def get_user_or_abort():
@@ -98,49 +100,117 @@ def review_submit(segmentid):
     return jsonify({'status': 'ok', 'id': newrev.id})
 
 
+# Pages at the front of the queue to try for, when other reviewers get there
+# first
+CLAIM_TRIES = 5
+
+
+def claim_review_page(user_id):
+    """
+    Take the page most in need of review which no one else has, for
+    REVIEW_LEASE seconds.  Any page the user had before goes back in the
+    queue.  Returns (docid, page, minviews) with page 0-indexed, or None.
+    """
+    if user_id is None:
+        # A lease no one holds would never be given back
+        raise ValueError("Review pages can only be claimed by a user")
+    session = app.dbobj.session
+    now = int(time.time())
+    session.query(ReviewPage).filter(ReviewPage.lease_user == user_id)\
+                             .update({'lease_until': 0, 'lease_user': None}, synchronize_session=False)
+    for attempt in range(CLAIM_TRIES):
+        q = session.query(ReviewPage.doc_id, ReviewPage.page, ReviewPage.minviews)\
+                   .filter(ReviewPage.lease_until < now)\
+                   .order_by(ReviewPage.minviews, ReviewPage.lease_until)\
+                   .limit(CLAIM_TRIES)
+        candidates = q.all()
+        if not candidates:
+            break
+        for docid, page, minviews in candidates:
+            # Only if it's still free, in case another reviewer just took it
+            claimed = session.query(ReviewPage)\
+                             .filter(ReviewPage.doc_id == docid, ReviewPage.page == page,
+                                     ReviewPage.lease_until < now)\
+                             .update({'lease_until': now + app.config['REVIEW_LEASE'], 'lease_user': user_id},
+                                     synchronize_session=False)
+            session.commit()
+            if claimed:
+                return docid, page, minviews
+    session.commit()
+    return None
+
+
+def upcoming_review_pages(count):
+    """The (docid, page) pages next in the review queue, 0-indexed"""
+    q = app.dbobj.session.query(ReviewPage.doc_id, ReviewPage.page)\
+                         .filter(ReviewPage.lease_until < int(time.time()))\
+                         .order_by(ReviewPage.minviews, ReviewPage.lease_until)\
+                         .limit(count)
+    return q.all()
+
+
+def prefetch_pages(prefetcher, pages):
+    """Start rendering images of (docid, page) pages, 0-indexed"""
+    docs = Document.query.options(joinedload(Document.rotation))\
+                         .filter(Document.id.in_(set(d for d, p in pages)))
+    docs = {doc.id: doc for doc in docs}
+    for docid, page in pages:
+        if docid in docs:
+            doc = docs[docid]
+            prefetcher.submit(pdf_fullpath(doc), docid, page + 1, doc.page_rot(page + 1))
+
+
+def review_image_url(docid, pageno):
+    """Url of the image of a page (1-indexed) for the review page"""
+    return url_for('docpdf', docid=docid, pageno=pageno, w=app.config['REVIEW_PAGE_WIDTH'])
+
+
 @app.route('/api/reviewdata', methods=['GET'])
 def reviewdata():
-    # Find a random early page with lots of unreviewed items.  This way even
-    # with multiple simulteanous users they should get different pages.
-    minviewcount = app.dbobj.session.query(func.min(DocSegment.viewcount)).one()[0]
-
-    q = app.dbobj.session.query(DocSegment.doc_id, DocSegment.page)\
-                 .filter(DocSegment.ocrtext != None)\
-                 .filter(DocSegment.viewcount <= minviewcount)\
-                 .distinct()
+    # Take the page with the least reviewed segments that no one else is
+    # looking at.
+    user = get_user_or_abort()
+    claimed = claim_review_page(user.id)
+    if claimed is None:
+        abort(404)
+    docid, page, minviewcount = claimed
 
-    pages = list(q.all())
+    app.logger.debug("Reviewing page %d of doc %d, segments of only %d views" % (page, docid, minviewcount))
 
-    app.logger.debug("%d pages with segments of only %d views" % (len(pages), minviewcount))
+    prefetcher = get_prefetcher()
+    if prefetcher:
+        # This page, and the ones the next reviewers will get
+        prefetch_pages(prefetcher, [(docid, page)] + upcoming_review_pages(app.config['PREFETCH_AHEAD']))
 
-    # FIXME: this kinda works, but as all the pages get reviewed it will tend
-    # toward giving all users the same page.  not really a problem until I have
-    # more than 1 user.
-    docid, page = random.choice(pages)
     q = DocSegment.query.filter(DocSegment.doc_id == docid)\
                         .filter(DocSegment.page == page)\
+                        .filter(DocSegment.ocrtext != None)\
                         .filter(DocSegment.viewcount <= minviewcount)
 
     segments = q.all()
     if not segments:
         abort(404)
 
+    reviews = latest_reviews(d.id for d in segments)
+    suggestions = ocrfix.suggestions_for([d for d in segments if d.id not in reviews])
+
+    image = review_image_url(docid, page + 1)
     segdata = []
     for d in segments:
-        if d.usertext is None:
+        if d.id not in reviews:
             txt = ocrfix.guess_fix(d.ocrtext)
-            suggests = ocrfix.suggestions(d)
+            suggests = suggestions[d.id]
         else:
-            txt = d.usertext.text
+            txt = reviews[d.id].text
             suggests = []
 
         lines = max(len(d.ocrtext.splitlines()), len(txt.splitlines()))
 
         segdata.append(dict(ocrtext=d.ocrtext, text=txt, segment_id=d.id,
                             x1=d.x1, x2=d.x2, y1=d.y1, y2=d.y2,
-                            textlines=lines, docid=docid, page=page+1, suggests=suggests))
+                            textlines=lines, docid=docid, page=page+1, image=image, suggests=suggests))
 
-    return jsonify(dict(segments=segdata, docid=docid, page=page+1))
+    return jsonify(dict(segments=segdata, docid=docid, page=page+1, image=image))
 
 
 @app.route('/review', methods=['GET', 'POST'])
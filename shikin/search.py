@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Full text search over group names, document notes and segment text.
+
+Everything searchable goes into one SQLite FTS5 table using the trigram
+tokenizer, which works for Japanese without needing word splitting.  Any
+query of 3 or more characters is a straight index lookup, and matches exactly
+the same things as a LIKE '%query%' would.  Shorter queries can't use the
+trigram index, and rather than scan every OCR segment in it they only look
+at group names and document notes, with a LIKE on those tables.
+
+The index is kept up to date by triggers on the source tables.  Segments are
+indexed by their best text - the latest review if there is one, otherwise
+the OCR text.  The rowid of each entry is ref_id * 4 + kind.
+"""
+
+from flask import request, jsonify
+from sqlalchemy import event, DDL, text, select, column, false
+
+from . import app
+from .model import Model, Group, Document, DocSegment
+
+GROUP = 0
+DOCUMENT = 1
+SEGMENT = 2
+
+KIND_NAMES = {GROUP: 'group', DOCUMENT: 'document', SEGMENT: 'segment'}
+
+# Shortest query the trigram index can be used for
+MIN_MATCH_LEN = 3
+
+# The table and column short queries look in, for each kind they search
+_SHORT_SOURCES = {GROUP: ('"group"', 'name'), DOCUMENT: ('document', 'note')}
+
+PAGE_SIZE = 20
+
+_SEGMENT_TEXT = """coalesce((SELECT text FROM doc_segment_review WHERE segment_id = {id}
+                            ORDER BY rev DESC LIMIT 1), {ocrtext})"""
+
+
+def _index(kind, ref_id, value):
+    return """
+    DELETE FROM search_index WHERE rowid = {ref_id} * 4 + {kind};
+    INSERT INTO search_index (rowid, text, kind, ref_id)
+        SELECT {ref_id} * 4 + {kind}, {value}, {kind}, {ref_id} WHERE {value} IS NOT NULL;
+    """.format(kind=kind, ref_id=ref_id, value=value)
+
+
+def _unindex(kind, ref_id):
+    return 'DELETE FROM search_index WHERE rowid = {ref_id} * 4 + {kind};'.format(kind=kind, ref_id=ref_id)
+
+
+_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(text, kind UNINDEXED, ref_id UNINDEXED, "
+    "tokenize='trigram')",
+
+    'CREATE TRIGGER IF NOT EXISTS group_search_insert AFTER INSERT ON "group" BEGIN %s END' %
+    _index(GROUP, 'NEW.id', 'NEW.name'),
+    'CREATE TRIGGER IF NOT EXISTS group_search_update AFTER UPDATE OF name ON "group" BEGIN %s END' %
+    _index(GROUP, 'NEW.id', 'NEW.name'),
+    'CREATE TRIGGER IF NOT EXISTS group_search_delete AFTER DELETE ON "group" BEGIN %s END' %
+    _unindex(GROUP, 'OLD.id'),
+
+    'CREATE TRIGGER IF NOT EXISTS document_search_insert AFTER INSERT ON document BEGIN %s END' %
+    _index(DOCUMENT, 'NEW.id', 'NEW.note'),
+    'CREATE TRIGGER IF NOT EXISTS document_search_update AFTER UPDATE OF note ON document BEGIN %s END' %
+    _index(DOCUMENT, 'NEW.id', 'NEW.note'),
+    'CREATE TRIGGER IF NOT EXISTS document_search_delete AFTER DELETE ON document BEGIN %s END' %
+    _unindex(DOCUMENT, 'OLD.id'),
+
+    'CREATE TRIGGER IF NOT EXISTS segment_search_insert AFTER INSERT ON doc_segment BEGIN %s END' %
+    _index(SEGMENT, 'NEW.id', _SEGMENT_TEXT.format(id='NEW.id', ocrtext='NEW.ocrtext')),
+    'CREATE TRIGGER IF NOT EXISTS segment_search_update AFTER UPDATE OF ocrtext ON doc_segment BEGIN %s END' %
+    _index(SEGMENT, 'NEW.id', _SEGMENT_TEXT.format(id='NEW.id', ocrtext='NEW.ocrtext')),
+    'CREATE TRIGGER IF NOT EXISTS segment_search_delete AFTER DELETE ON doc_segment BEGIN %s END' %
+    _unindex(SEGMENT, 'OLD.id'),
+
+    'CREATE TRIGGER IF NOT EXISTS review_search_insert AFTER INSERT ON doc_segment_review BEGIN %s END' %
+    _index(SEGMENT, 'NEW.segment_id', _SEGMENT_TEXT.format(
+        id='NEW.segment_id', ocrtext='(SELECT ocrtext FROM doc_segment WHERE id = NEW.segment_id)')),
+    'CREATE TRIGGER IF NOT EXISTS review_search_delete AFTER DELETE ON doc_segment_review BEGIN %s END' %
+    _index(SEGMENT, 'OLD.segment_id', _SEGMENT_TEXT.format(
+        id='OLD.segment_id', ocrtext='(SELECT ocrtext FROM doc_segment WHERE id = OLD.segment_id)')),
+]
+
+for ddl in _SEARCH_DDL:
+    event.listen(Model.metadata, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+
+
+def rebuild_search(session):
+    """Fill the search index from scratch"""
+    conn = session.connection()
+    for ddl in _SEARCH_DDL:
+        conn.execute(text(ddl))
+    conn.execute(text('DELETE FROM search_index'))
+    conn.execute(text('INSERT INTO search_index (rowid, text, kind, ref_id) '
+                      'SELECT id * 4 + :kind, name, :kind, id FROM "group"'), {'kind': GROUP})
+    conn.execute(text('INSERT INTO search_index (rowid, text, kind, ref_id) '
+                      'SELECT id * 4 + :kind, note, :kind, id FROM document WHERE note IS NOT NULL'),
+                 {'kind': DOCUMENT})
+    segtext = _SEGMENT_TEXT.format(id='doc_segment.id', ocrtext='doc_segment.ocrtext')
+    conn.execute(text('INSERT INTO search_index (rowid, text, kind, ref_id) '
+                      'SELECT id * 4 + :kind, %s, :kind, id FROM doc_segment WHERE %s IS NOT NULL'
+                      % (segtext, segtext)), {'kind': SEGMENT})
+    conn.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    session.commit()
+
+
+def _match(query):
+    """The MATCH clause and parameters for index entries containing query"""
+    # A quoted string is a phrase, which for trigrams is a substring match
+    return 'search_index MATCH :q', {'q': '"%s"' % query.replace('"', '""')}
+
+
+def _like(query):
+    """A LIKE pattern for values containing query"""
+    return '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def matching_ids(kind, query):
+    """
+    A select of the ids of objects of the given kind whose text contains
+    query, for use in filters like Group.id.in_(matching_ids(GROUP, q)).
+    """
+    query = query.strip()
+    if len(query) < MIN_MATCH_LEN:
+        if kind == GROUP:
+            return select(Group.id).where(Group.name.like(_like(query), escape='\\'))
+        if kind == DOCUMENT:
+            return select(Document.id).where(Document.note.like(_like(query), escape='\\'))
+        # Not segments, which would mean scanning all their text
+        return select(DocSegment.id).where(false())
+    where, params = _match(query)
+    return select(column('ref_id')).select_from(text('search_index'))\
+                                   .where(text('%s AND rowid %% 4 = :kind' % where)
+                                          .bindparams(kind=kind, **params))
+
+
+def search(query, kind=None, offset=0, limit=PAGE_SIZE):
+    """
+    Look for query, returning a list of (kind, ref_id, text) with the best
+    matches first.  Short queries only find groups and documents, groups
+    first, as they can't be ranked.
+    """
+    query = query.strip()
+    params = {'offset': offset, 'limit': limit}
+    if len(query) >= MIN_MATCH_LEN:
+        where, match = _match(query)
+        params.update(match)
+        if kind is not None:
+            where += ' AND rowid % 4 = :kind'
+            params['kind'] = kind
+        sql = 'SELECT rowid % 4, ref_id, text FROM search_index WHERE {0} ORDER BY rank ' \
+              'LIMIT :limit OFFSET :offset'.format(where)
+    else:
+        kinds = [k for k in sorted(_SHORT_SOURCES) if kind is None or k == kind]
+        if not kinds:
+            return []
+        params['q'] = _like(query)
+        union = ' UNION ALL '.join("SELECT {0} AS kind, id, {2} AS text FROM {1} WHERE {2} LIKE :q ESCAPE '\\'"
+                                   .format(k, *_SHORT_SOURCES[k]) for k in kinds)
+        sql = 'SELECT * FROM (%s) ORDER BY kind, length(text) LIMIT :limit OFFSET :offset' % union
+    return app.dbobj.session.execute(text(sql), params).fetchall()
+
+
+@app.route('/api/search')
+def search_all():
+    """
+    Ranked search over everything.  Takes q, and optionally page (from 1) and
+    kind (group, document or segment).
+    """
+    query = (request.args.get('q') or '').strip()
+    page = request.args.get('page', '1')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+    kind = request.args.get('kind')
+    kinds = {v: k for k, v in KIND_NAMES.items()}
+    if kind is not None and kind not in kinds:
+        return jsonify({'status': 'error', 'msg': 'Unknown kind %s' % kind}), 400
+    if not query:
+        return jsonify({'query': query, 'page': page, 'results': [], 'more': False})
+
+    # Get one extra to see if there's another page
+    found = search(query, kinds.get(kind), (page - 1) * PAGE_SIZE, PAGE_SIZE + 1)
+    results = [{'kind': KIND_NAMES[k], 'id': ref_id, 'text': txt} for k, ref_id, txt in found[:PAGE_SIZE]]
+
+    # Say where segments are.  Pages are 1-indexed as for the pdf urls.
+    segids = [x['id'] for x in results if x['kind'] == 'segment']
+    if segids:
+        q = app.dbobj.session.query(DocSegment.id, DocSegment.doc_id, DocSegment.page)\
+                             .filter(DocSegment.id.in_(segids))
+        where = {segid: (docid, page) for segid, docid, page in q.all()}
+        for x in results:
+            if x['kind'] == 'segment' and x['id'] in where:
+                x['doc_id'], x['page'] = where[x['id']][0], where[x['id']][1] + 1
+    return jsonify({'query': query, 'page': page, 'results': results, 'more': len(found) > PAGE_SIZE})
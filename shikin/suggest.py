@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Group name suggestions for the search box typeahead.
+
+All the group names are held in memory, ordered by number of documents, with
+a posting list of groups for each character and each pair of characters in
+the names.  A lookup walks the shortest posting list for the query, in rank
+order, until it has enough names containing the query.  Answers are also kept
+in a small LRU cache, since most typeahead queries are one or two characters.
+
+The index is rebuilt when groups or documents change through this app, and
+otherwise when a cheap check of the db shows something else changed it.
+Rebuilds run in a background thread, and lookups carry on with the old index
+until the new one is ready.  The first request the app gets starts the first
+build, so the index is usually there before anyone types in the search box.
+"""
+
+import time
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+from flask import request, jsonify
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from . import app, cache
+from .model import Group, Document, GroupYearStats, YearStats
+
+MAX_RESULTS = 20
+DEFAULT_RESULTS = 10
+CACHE_SIZE = 4096
+# Seconds between checks for changes made outside this process
+CHECK_INTERVAL = 30
+# Seconds browsers may cache a response
+MAX_AGE = 300
+
+
+def normalise(s):
+    """Fold full/half width and case, so ＡＢＣ finds abc"""
+    return unicodedata.normalize('NFKC', s).lower()
+
+
+class SuggestIndex():
+    def __init__(self, groups):
+        """groups is a list of (id, name, doccount)"""
+        self.groups = sorted(groups, key=lambda x: (-x[2], x[1]))
+        self.names = [normalise(x[1]) for x in self.groups]
+        postings = {}
+        for i, name in enumerate(self.names):
+            keys = set(name)
+            keys.update(name[j:j+2] for j in range(len(name) - 1))
+            for k in keys:
+                postings.setdefault(k, array('i')).append(i)
+        self.postings = postings
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, query, n=DEFAULT_RESULTS):
+        """Top n groups, as (id, name, doccount), with names containing query"""
+        query = normalise(query.strip())
+        if not query:
+            return []
+        key = (query, n)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        if len(query) == 1:
+            keys = [query]
+        else:
+            keys = set(query[j:j+2] for j in range(len(query) - 1))
+        candidates = None
+        for k in keys:
+            posting = self.postings.get(k)
+            if posting is None:
+                candidates = []
+                break
+            if candidates is None or len(posting) < len(candidates):
+                candidates = posting
+
+        found = []
+        for i in candidates:
+            if len(query) <= 2 or query in self.names[i]:
+                found.append(self.groups[i])
+                if len(found) >= n:
+                    break
+
+        with self.lock:
+            self.cache[key] = found
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return found
+
+
+_index = None
+_stamp = None
+_checked = 0
+_dirty = False
+_rebuilder = None
+_index_lock = threading.Lock()
+
+
+def _db_stamp(session):
+    """
+    Something which changes when the groups or their document counts do.
+    The response cache's data version catches renames by other processes.
+    """
+    groups = session.query(func.count(Group.id), func.max(Group.id)).one()
+    docs = session.query(func.sum(YearStats.docs)).scalar()
+    return tuple(groups) + (docs, cache.data_version())
+
+
+def _build(session):
+    counts = session.query(GroupYearStats.group_id, func.sum(GroupYearStats.docs))\
+                    .group_by(GroupYearStats.group_id)
+    counts = dict(counts.all())
+    groups = [(gid, name, counts.get(gid, 0)) for gid, name in session.query(Group.id, Group.name)]
+    return SuggestIndex(groups)
+
+
+def _refresh(force):
+    """Rebuild the index if forced to or the db has changed.  Runs in the rebuild thread."""
+    global _index, _stamp
+    with app.app_context():
+        session = app.dbobj.session
+        stamp = _db_stamp(session)
+        if force or _index is None or stamp != _stamp:
+            index = _build(session)
+            _index, _stamp = index, stamp
+
+
+def _start_rebuild():
+    """Start a rebuild in the background, unless one is running.  Returns its thread."""
+    global _rebuilder, _checked, _dirty
+    with _index_lock:
+        if _rebuilder is None or not _rebuilder.is_alive():
+            # Changes made from here on will need another rebuild
+            force = _dirty
+            _dirty = False
+            _checked = time.time()
+            _rebuilder = threading.Thread(target=_refresh, args=(force,), name='suggest-index', daemon=True)
+            _rebuilder.start()
+        return _rebuilder
+
+
+def wait_for_rebuild():
+    """Wait for any rebuild in progress to finish"""
+    rebuilder = _rebuilder
+    if rebuilder is not None:
+        rebuilder.join()
+
+
+def get_index():
+    if _index is None:
+        # Nothing to use until the first build is done
+        _start_rebuild().join()
+        return _index if _index is not None else SuggestIndex([])
+    if _dirty or time.time() - _checked >= CHECK_INTERVAL:
+        _start_rebuild()
+    return _index
+
+
+@event.listens_for(Session, 'after_flush')
+def _check_changes(session, flush_context):
+    global _dirty
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, (Group, Document)):
+            _dirty = True
+            return
+
+
+@app.before_request
+def _warm_index():
+    if _index is None:
+        _start_rebuild()
+
+
+@app.route('/api/suggest')
+def suggest():
+    """Group names containing q, most documents first.  n is how many (max 20)."""
+    query = request.args.get('q') or ''
+    n = request.args.get('n', '')
+    n = min(int(n), MAX_RESULTS) if n.isdigit() and int(n) > 0 else DEFAULT_RESULTS
+    found = get_index().lookup(query, n)
+    response = jsonify({'query': query,
+                        'values': [{'id': gid, 'name': name, 'doccount': doccount}
+                                   for gid, name, doccount in found]})
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    return response
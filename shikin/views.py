@@ -9,8 +9,11 @@ from sqlalchemy import func
 from datetime import timedelta
 
 from . import app
-from .model import Document, Group, DocType, PubType, AppConfig
+from .model import Document, Group, DocType, PubType, AppConfig, YearStats, GroupYearStats
 from .config import LANGUAGES
+from .search import matching_ids, GROUP
+from .pdf.thumbnails import thumbnail_name
+from .pdf.manifest import ThumbnailManifest
 
 
 @app.babel.localeselector
@@ -45,8 +48,8 @@ def index():
     if request.args.get('q'):
         return search(request.args['q'])
     else:
-        doccount = app.dbobj.session.query(func.count(Document.id), func.sum(Document.pages)).one()
-        return render_template('index.html', doccount=doccount[0], pagecount=doccount[1])
+        doccount = app.dbobj.session.query(func.sum(YearStats.docs), func.sum(YearStats.pages)).one()
+        return render_template('index.html', doccount=doccount[0] or 0, pagecount=doccount[1] or 0)
 
 
 @app.route('/about')
@@ -67,8 +70,10 @@ def pubs():
 
 @app.route('/years')
 def years():
-    q = app.dbobj.session.query(Document.year.distinct(), func.count(Document.id))\
-                         .order_by(Document.year).group_by(Document.year)
+    # Leave out year 0, where undated documents are counted
+    q = app.dbobj.session.query(YearStats.year, YearStats.docs)\
+                         .filter(YearStats.year != 0)\
+                         .order_by(YearStats.year)
     data = dict(q.all())
     return render_template('years.html', year=data, doctypes=doctype_json(), pubtypes=pubtype_json())
 
@@ -77,7 +82,7 @@ def _group_redir(groupid):
     return redirect(url_for('group', groupid=groupid))
 
 
-@app.route('/search/<query>')
+@app.route('/search/<q>')
 def search(q):
     """ Front page """
     # First search for an exact group match
@@ -85,7 +90,7 @@ def search(q):
     if g is not None:
         return _group_redir(g.id)
     q = q.strip()
-    g_query = Group.query.filter(Group.name.like('%' + q + '%'))
+    g_query = Group.query.filter(Group.id.in_(matching_ids(GROUP, q)))
     g_count = g_query.count()
     if g_count == 1:
         return _group_redir(g_query.first().id)
@@ -95,6 +100,37 @@ def search(q):
     return render_template('index.html', nomatch=q)
 
 
+_thumbnail_manifest = None
+
+
+def get_thumbnail_manifest():
+    """The manifest of thumbnails made, or None if there isn't one yet"""
+    global _thumbnail_manifest
+    path = os.path.join(app.root_path, app.config['THUMBNAIL_MANIFEST'])
+    if _thumbnail_manifest is None or _thumbnail_manifest[0] != path:
+        _thumbnail_manifest = (path, ThumbnailManifest(path)) if os.path.exists(path) else None
+    return _thumbnail_manifest[1] if _thumbnail_manifest else None
+
+
+def doc_thumbnail(pdfpath):
+    """
+    The thumbnail of a document for its page, as a dict of src for the
+    image and srcsets of the sizes made in each format.  Documents not in
+    the thumbnail manifest have the src of their old single thumbnail.
+    """
+    base = os.path.join(app.config["THUMBNAIL_DIR"], pdfpath)
+    thumbnail = {'src': base + "_thumb.png"}
+    manifest = get_thumbnail_manifest()
+    made = manifest.get(pdfpath) if manifest else None
+    if made is not None:
+        fmt = 'png' if 'png' in made['formats'] else made['formats'][0]
+        thumbnail['src'] = thumbnail_name(base, made['widths'][-1], fmt)
+        for fmt in made['formats']:
+            thumbnail[fmt] = ', '.join('%s %dw' % (thumbnail_name(base, width, fmt), width)
+                                       for width in made['widths'])
+    return thumbnail
+
+
 @app.route('/doc/<int:docid>')
 def docpage(docid):
     """ Front page """
@@ -105,12 +141,11 @@ def docpage(docid):
     pdfpath = doc.path
     if pdfpath.startswith("/"):
         pdfpath = pdfpath[1:]
-    thumbnailpath = pdfpath + "_thumb.png"
+    thumbnail = doc_thumbnail(pdfpath)
     pdfpath = os.path.join(app.config["PDF_DIR"], pdfpath)
-    thumbnailpath = os.path.join(app.config["THUMBNAIL_DIR"], thumbnailpath)
 
     return render_template('document.html', pdfurl=doc.url, fname=doc.filename,
-                           thumbnail=thumbnailpath, year=doc.year, docid=doc.id,
+                           thumbnail=thumbnail, year=doc.year, docid=doc.id,
                            pubtype=doc.docset.pubtype.name,
                            doctype=doc.docset.doctype.name,
                            published=doc.docset.published,
@@ -125,7 +160,8 @@ def group(groupid):
     if group is None:
         abort(404)
 
-    doccount = Document.query.filter(Document.group_id == groupid).count()
+    doccount = app.dbobj.session.query(func.sum(GroupYearStats.docs))\
+                                .filter(GroupYearStats.group_id == groupid).scalar() or 0
     parentname = None
     if group.parent:
         parentname = group.parent.name
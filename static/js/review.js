@@ -57,28 +57,36 @@ $(function() {
         if (segno < segdata.length-1) {
             segno++;
             var seg = segdata[segno];
-            $(img).css('background', 'url(/doc/cached/' + seg.docid + '/'+ seg.page + ')');
+            $(img).css('background', 'url(' + seg.image + ')');
             $(img).css('background-size', '1170px');
             $(img).css('background-repeat', 'no-repeat');
             setbox(seg);
             highlight.css('display', 'inline');
             overlay.css('display', 'inline');
         }
-        checkfornextpage();
     }
 
-    function checkfornextpage(startup) {
-        if (segno >= segdata.length-1) {
-            // Load up the next page
-            $.get('/api/reviewdata').done(function(data) {
-                segdata = segdata.concat(data.segments);
-                if (startup) {
-                    nextsegment();
-                }
+    var loading = false;
+
+    function loadnextpage() {
+        loading = true;
+        return $.get('/api/reviewdata').done(function(data) {
+            segdata = segdata.concat(data.segments);
+        }).always(function() {
+            loading = false;
+        });
+    }
+
+    function advance(submitted) {
+        if (segno < segdata.length-1) {
+            nextsegment();
+        } else if (!loading) {
+            // Claiming the next page gives this one back, so only once the
+            // last segment of it is in.
+            $.when(submitted).always(function() {
+                loadnextpage().done(nextsegment);
             });
-            return true;
         }
-        return false;
     }
 
     $('#undobutton').click(function(e) {
@@ -96,17 +104,17 @@ $(function() {
 
     $('#skipbutton').click(function(e) {
         lastrevid = null;
-        $.get('/api/review/' + segdata[segno].segment_id, {skip: true}).fail(function() {
+        var submitted = $.get('/api/review/' + segdata[segno].segment_id, {skip: true}).fail(function() {
             // TODO: Handle AJAX error.
         });
-        nextsegment();
+        advance(submitted);
         e.preventDefault();
     });
 
     $('#savebutton').click(function(e) {
         var newtxt = usertext.val();
         segdata[segno].text = newtxt;
-        $.get('/api/review/' + segdata[segno].segment_id, {text: newtxt}).done(function (data) {
+        var submitted = $.get('/api/review/' + segdata[segno].segment_id, {text: newtxt}).done(function (data) {
             if (data.status === 'ok') {
                 lastrevid = data.id;
             } else {
@@ -115,7 +123,7 @@ $(function() {
         }).fail(function() {
             // TODO: Handle AJAX error.
         });
-        nextsegment();
+        advance(submitted);
         e.preventDefault();
     });
 
@@ -129,5 +137,5 @@ $(function() {
         $(document).bind('keydown', kmap.key, function () { $(kmap.btn).click(); return false; });
     });
 
-    checkfornextpage(true);
+    loadnextpage().done(nextsegment);
 });
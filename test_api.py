@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the bulk segment and document apis
+"""
+import threading
+import pytest
+from sqlalchemy import event
+
+import shikin
+from shikin.model import Document, DocSegment, DocRotation
+
+
+@pytest.fixture
+def db(app_db):
+    db = app_db
+    db.session.add(Document(docset_id=1, year=2014, filename='/1.pdf', pages=2, size=10, url='u', srcurl='s'))
+    db.session.commit()
+    return db
+
+
+def segment(page, row, ocrtext=None):
+    return {'doc_id': 1, 'page': page, 'row': row, 'col': 0, 'x1': 0, 'y1': row * 10, 'x2': 10,
+            'y2': row * 10 + 10, 'ocrtext': ocrtext}
+
+
+def post(client, data, **kw):
+    return client.post('/api/raw/doc_segment/bulk', json=data, **kw)
+
+
+def test_bulk_add(db):
+    client = shikin.app.test_client()
+    r = post(client, {'objects': [segment(0, 0, u'1,000'), segment(0, 1), segment(0, 1)]})
+    assert r.status_code == 200
+    assert r.get_json() == {'status': 'ok', 'added': 2, 'ignored': 1}
+
+    # Sending a page again only adds what's new
+    r = post(client, {'objects': [segment(0, 0, u'2,000'), segment(0, 2), segment(1, 0)]})
+    assert r.get_json() == {'status': 'ok', 'added': 2, 'ignored': 1}
+    segs = db.session.query(DocSegment).order_by(DocSegment.page, DocSegment.row).all()
+    assert [(s.page, s.row) for s in segs] == [(0, 0), (0, 1), (0, 2), (1, 0)]
+    assert segs[0].ocrtext == u'1,000'
+
+    assert post(client, {'objects': []}).get_json() == {'status': 'ok', 'added': 0, 'ignored': 0}
+
+
+def test_concurrent_bulk_add(db):
+    batch = {'objects': [segment(p, r) for p in range(2) for r in range(20)]}
+    results = []
+
+    def upload():
+        results.append(post(shikin.app.test_client(), batch).get_json())
+        shikin.app.dbobj.session.remove()
+    threads = [threading.Thread(target=upload) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(r['added'] for r in results) == 40
+    assert sum(r['ignored'] for r in results) == 120
+    assert db.session.query(DocSegment).count() == 40
+
+
+def test_bulk_add_errors(db):
+    client = shikin.app.test_client()
+    r = post(client, {'objects': [segment(0, 0)]}, environ_overrides={'REMOTE_ADDR': '10.0.0.1'})
+    assert r.status_code == 401
+
+    missing = segment(0, 0)
+    del missing['x2']
+    for data in ([segment(0, 0)], {'objects': 'nope'}, {'objects': [missing]},
+                 {'objects': [segment(0, 0), 7]}, {'objects': [dict(segment(0, 0), colour='red')]}):
+        r = post(client, data)
+        assert r.status_code == 400
+        assert r.get_json()['status'] == 'error'
+    assert client.post('/api/raw/doc_segment/bulk', data='{not json').status_code == 400
+
+    # Nothing from a rejected batch is kept
+    assert db.session.query(DocSegment).count() == 0
+
+
+def test_document_list_rotations(db):
+    for d in range(2, 12):
+        db.session.add(Document(docset_id=1, year=2014, filename='/%d.pdf' % d, pages=2, size=10,
+                                url='u%d' % d, srcurl='s'))
+    db.session.flush()
+    for d in range(1, 12, 2):
+        db.session.add(DocRotation(doc_id=d, pages=[0, d % 4 * 90]))
+    db.session.commit()
+    queries = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *a: queries.append(a[2]))
+
+    r = shikin.app.test_client().get('/api/document')
+    assert r.status_code == 200
+    docs = r.get_json()['objects']
+    assert len(docs) == 11
+    assert {d['id']: d['page_rots'] for d in docs if d['page_rots']} == \
+        {d: [0, d % 4 * 90] for d in range(1, 12, 2)}
+    # All the rotations in one query, not one per document
+    assert len([q for q in queries if 'FROM doc_rotation' in q]) == 1
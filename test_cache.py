@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the response cache on the summary and read-only apis
+"""
+import pytest
+from sqlalchemy import event
+
+import shikin
+from shikin import cache
+from shikin.model import Group, Document, DocSegment
+
+
+@pytest.fixture(params=['lru', 'sqlite'])
+def db(request, app_db, tmp_path, monkeypatch):
+    db = app_db
+    monkeypatch.setitem(shikin.app.config, 'RESPONSE_CACHE', request.param)
+    monkeypatch.setitem(shikin.app.config, 'RESPONSE_CACHE_PATH', str(tmp_path / 'cache.db'))
+    db.session.add(Group(id=1, name=u'海賊党', type_id=1))
+    db.session.add(Document(docset_id=1, year=2014, group_id=1, filename='1.pdf', pages=1, size=10,
+                            url='u1', srcurl='s'))
+    db.session.commit()
+    return db
+
+
+def count_queries(db):
+    queries = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *a: queries.append(a[2]))
+    return queries
+
+
+@pytest.mark.parametrize('url', ['/api/summary/stats', '/api/summary/group?start=0&length=10',
+                                 '/api/group', '/api/document/1'])
+def test_cached_until_import(db, url):
+    client = shikin.app.test_client()
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.cache_control.public
+    etag = first.headers['ETag']
+
+    queries = count_queries(db)
+    again = client.get(url)
+    assert again.get_data() == first.get_data()
+    assert [q for q in queries if 'app_config' not in q] == []
+
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    # An import, as the import tool does it, bypassing the orm
+    db.session.execute(Document.__table__.insert(),
+                       [{'docset_id': 1, 'year': 2013, 'group_id': 1, 'path': '2.pdf', 'pages': 2,
+                         'size': 5, 'url': 'u2', 'srcurl': 's'}])
+    db.session.commit()
+    after = client.get(url, headers={'If-None-Match': etag})
+    assert after.status_code == 200
+    assert after.headers['ETag'] != etag
+
+
+def test_not_cached(db):
+    client = shikin.app.test_client()
+    client.get('/api/suggest?q=x')
+    queries = count_queries(db)
+    client.get('/api/raw/group')
+    client.get('/api/raw/group')
+    assert len([q for q in queries if '"group"' in q]) >= 2
+
+
+def test_ocr_keeps_cache(db):
+    client = shikin.app.test_client()
+    etag = client.get('/api/document/1').headers['ETag']
+    version = cache.data_version()
+
+    # Segments an OCR run adds aren't in any cached response
+    db.session.execute(DocSegment.__table__.insert(),
+                       [{'doc_id': 1, 'page': 0, 'row': 0, 'col': 0, 'x1': 0, 'y1': 0, 'x2': 1, 'y2': 1}])
+    db.session.commit()
+    assert cache.data_version() == version
+    r = client.get('/api/document/1', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert 'segments' not in client.get('/api/document/1').get_json()
+
+
+def test_draw_not_in_key(db):
+    client = shikin.app.test_client()
+    first = client.get('/api/summary/group?start=0&length=10&draw=1')
+    assert first.get_json()['draw'] == '1'
+
+    queries = count_queries(db)
+    again = client.get('/api/summary/group?start=0&length=10&draw=2')
+    assert [q for q in queries if 'app_config' not in q] == []
+    assert again.get_json() == dict(first.get_json(), draw='2')
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for paging by id and the streaming export
+"""
+import json
+import datetime
+import pytest
+
+import shikin
+from shikin import export
+from shikin.model import Group, Document, DocSegment, DocSegmentReview, User
+
+
+@pytest.fixture
+def db(app_db):
+    db = app_db
+    db.session.execute(Group.__table__.insert(), [{'id': i, 'name': u'党%d' % i, 'type_id': 1}
+                                                  for i in range(1, 51)])
+    db.session.execute(Document.__table__.insert(),
+                       [{'docset_id': 1, 'year': 2014, 'group_id': i % 50 + 1, 'path': '%d.pdf' % i,
+                         'pages': 1, 'size': 10, 'url': 'u%d' % i, 'srcurl': 's%d' % i} for i in range(230)])
+    db.session.commit()
+    return db
+
+
+def read_ndjson(response):
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_export(db, monkeypatch):
+    monkeypatch.setattr(export, 'CHUNK_SIZE', 7)
+    client = shikin.app.test_client()
+
+    docs = read_ndjson(client.get('/api/export/document'))
+    assert [d['id'] for d in docs] == list(range(1, 231))
+    assert docs[0]['url'] == 'u0'
+
+    docs = read_ndjson(client.get('/api/export/document?after=100&limit=20&columns=url,srcurl'))
+    assert docs == [{'url': 'u%d' % i, 'srcurl': 's%d' % i} for i in range(100, 120)]
+
+    docsets = read_ndjson(client.get('/api/export/doc_set'))
+    assert docsets[0]['published'] == '2015-01-01'
+    groups = read_ndjson(client.get('/api/export/group'))
+    assert groups[2]['name'] == u'党3'
+
+    db.session.add(User(id=1, name='reviewer', pw_hash='x', email='x'))
+    for n in range(20):
+        db.session.add(DocSegment(doc_id=1, page=0, row=n, col=0, x1=0, y1=n, x2=10, y2=n + 1, ocrtext=u'ocr%d' % n))
+    for rev in (1, 2):
+        db.session.add(DocSegmentReview(segment_id=3, rev=rev, timestamp=datetime.datetime.now(), user_id=1,
+                                        text=u'review%d' % rev))
+    db.session.commit()
+    segs = read_ndjson(client.get('/api/export/doc_segment?columns=ocrtext,text'))
+    assert segs[2] == {'ocrtext': u'ocr2', 'text': u'review2'}
+    assert segs[3] == {'ocrtext': u'ocr3', 'text': u'ocr3'}
+
+    assert client.get('/api/export/nothing').status_code == 404
+    assert client.get('/api/export/document?columns=secret').status_code == 400
+
+
+@pytest.mark.parametrize('url', ['/api/raw/document', '/api/document', '/api/group', '/api/raw/group_type'])
+def test_keyset_pages(db, url):
+    client = shikin.app.test_client()
+    table = url.split('/')[-1]
+    expected = [x['id'] for x in read_ndjson(client.get('/api/export/' + table))]
+    ids = []
+    after = 0
+    while after is not None:
+        page = client.get(url, query_string={'after': after, 'results_per_page': 40}).get_json()
+        ids.extend(x['id'] for x in page['objects'])
+        after = page['after']
+    assert ids == expected
+
+    assert client.get(url, query_string={'after': 'x'}).status_code == 400
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for tools/importdocs.py
+"""
+import os
+import sys
+import copy
+import datetime
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+import importdocs
+from toollib import pdfprobe
+
+
+class MemoryBackend():
+    """Just enough of the import backend api, kept in dicts"""
+    def __init__(self):
+        self.tables = {
+            'group_type': [{'id': i + 1, 'name': n} for i, n in
+                           enumerate([u'政党本部', u'政党支部', u'資金管理団体', u'不明'])],
+            'doc_type': [{'id': 1, 'name': u'政治資金収支報告書'}],
+            'pub_type': [{'id': 1, 'name': u'定期公表'}],
+            'group': [],
+            'doc_set': [],
+            'document': [],
+            'doc_rotation': [],
+        }
+
+    def get_all(self, otype):
+        return copy.deepcopy(self.tables[otype])
+
+    def get_doc_sources(self):
+        return {x['url']: x['srcurl'] for x in self.tables['document']}
+
+    def add(self, otype, obj):
+        obj = dict(obj, id=len(self.tables[otype]) + 1)
+        self.tables[otype].append(obj)
+        return copy.deepcopy(obj)
+
+    def update(self, otype, objid, changes):
+        obj = [x for x in self.tables[otype] if x['id'] == objid][0]
+        obj.update(changes)
+        return copy.deepcopy(obj)
+
+    def add_page_rots(self, document, rots):
+        self.add('doc_rotation', {'doc_id': document['id'], 'rots': pdfprobe.pack_rots(rots)})
+
+    def finish(self):
+        pass
+
+
+TITLE = u'平成27年11月27日公表（定期公表）'
+
+
+def make_pdf(root, rel, **meta):
+    path = os.path.join(root, rel)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'wb').write(b'%PDF-1.4')
+    meta.setdefault('url', 'http://example.com/' + rel)
+    meta.setdefault('srcurl', 'http://example.com/' + os.path.dirname(rel))
+    meta.setdefault('docsettype', u'政治資金収支報告書')
+    meta.setdefault('year', u'平成26年分')
+    with open(path + '_meta.txt', 'w', encoding='utf-8') as f:
+        for k, v in meta.items():
+            f.write(u'%s,%s\n' % (k, v))
+
+
+@pytest.fixture
+def pdf_tree(tmp_path, monkeypatch):
+    root = str(tmp_path) + '/'
+    # A branch listed before its head office, which only shows up later
+    make_pdf(root, 'SS1/a.pdf', title=TITLE + u'\t自由党本部', srctitle=u'自由党東京支部')
+    make_pdf(root, 'SS1/b.pdf', title=TITLE, srctitle=u'自由党本部', grouptype=u'政党本部')
+    # Type only known from a later document
+    make_pdf(root, 'SS1/c.pdf', title=TITLE, srctitle=u'自由党東京支部', grouptype=u'政党支部',
+             year=u'平成25年分')
+    make_pdf(root, 'SS2/d.pdf', title=TITLE, srctitle=u'山田会（その１）')
+    make_pdf(root, 'SS2/e.pdf', title=TITLE, srctitle=u'山田会（その２）',
+             grouptype=u'資金管理団体（国会議員関係政治団体を除く。）')
+    # Never gets a type, so ends up unknown in the last pass
+    make_pdf(root, 'SS2/f.pdf', title=TITLE, srctitle=u'謎の会')
+    # Already imported, should be left alone
+    make_pdf(root, 'SS2/g.pdf', title=TITLE, srctitle=u'謎の会', url='http://example.com/old.pdf')
+    # No metadata at all
+    open(os.path.join(root, 'SS2', 'h.pdf'), 'wb').write(b'%PDF-1.4')
+
+    monkeypatch.setattr(pdfprobe, 'probe_pdf', lambda path: (3, [0, 90, 0]))
+    return root
+
+
+OLD_URL = 'http://example.com/old.pdf'
+OLD_SRCURL = 'http://example.com/SS2'
+
+
+def memory_backend():
+    backend = MemoryBackend()
+    backend.tables['document'].append({'id': 1, 'url': OLD_URL, 'srcurl': OLD_SRCURL})
+    return backend
+
+
+@pytest.fixture(params=['memory', 'db'])
+def new_backend(request, tmp_path, monkeypatch):
+    """
+    Makes empty backends but for one old document, either in memory or each
+    in a new SQLite db.
+    """
+    if request.param == 'memory':
+        yield memory_backend
+        return
+
+    import shikin
+    from shikin.model import GroupType, DocType, PubType, DocSet, Document
+    db = shikin.app.dbobj
+    made = []
+
+    def db_backend():
+        made.append(tmp_path / ('import%d.db' % len(made)))
+        monkeypatch.setitem(shikin.app.config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % made[-1])
+        db.session.remove()
+        db.create_all()
+        for row in MemoryBackend().tables['group_type']:
+            db.session.add(GroupType(row['name']))
+        db.session.add(DocType(u'政治資金収支報告書'))
+        db.session.add(PubType(u'定期公表'))
+        db.session.add(DocSet(published=datetime.date(2015, 1, 1), pubtype_id=1, doctype_id=1, path='/old'))
+        db.session.add(Document(docset_id=1, filename='old.pdf', pages=1, size=1, url=OLD_URL, srcurl=OLD_SRCURL))
+        db.session.commit()
+        return importdocs.DbBackend()
+    yield db_backend
+    db.session.remove()
+
+
+def dump(backend):
+    """Everything the import touches, in the same form for any backend"""
+    return {otype: sorted(backend.get_all(otype), key=lambda x: x['id'])
+            for otype in MemoryBackend().tables}
+
+
+def test_single_run_matches_three_runs(pdf_tree, new_backend):
+    three = new_backend()
+    for import_pass in importdocs.IMPORT_PASSES:
+        importdocs.reset_caches()
+        importdocs.run_import(three, pdf_tree, [import_pass], jobs=2, probe_cache=False)
+    three = dump(three)
+
+    importdocs.reset_caches()
+    single = new_backend()
+    importdocs.run_import(single, pdf_tree, importdocs.IMPORT_PASSES, jobs=2, probe_cache=False)
+    single = dump(single)
+
+    assert single == three
+
+    groups = {g['name']: g for g in single['group']}
+    assert groups[u'自由党東京支部']['parent_id'] == groups[u'自由党本部']['id']
+    # Group.type_id is a text column, so comes back from the db as a string
+    assert int(groups[u'謎の会']['type_id']) == 4
+    assert sorted(d['filename'] for d in single['document'][1:]) == \
+        ['a.pdf', 'b.pdf', 'c.pdf', 'd.pdf', 'e.pdf', 'f.pdf']
+    # Each new doc has its page rotations recorded
+    assert sorted(r['doc_id'] for r in single['doc_rotation']) == [d['id'] for d in single['document'][1:]]
+    assert set(r['rots'] for r in single['doc_rotation']) == {'0,90,0'}
+
+
+def test_rerun_adds_nothing(pdf_tree, new_backend):
+    backend = new_backend()
+    importdocs.reset_caches()
+    importdocs.run_import(backend, pdf_tree, importdocs.IMPORT_PASSES, jobs=2, probe_cache=False)
+    before = dump(backend)
+    assert before['doc_rotation']
+
+    importdocs.reset_caches()
+    importdocs.run_import(backend, pdf_tree, importdocs.IMPORT_PASSES, jobs=2, probe_cache=False)
+    assert dump(backend) == before
+
+
+def test_probe_cache(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    old = pdfprobe.sqlite3.connect(os.path.join(root, pdfprobe.CACHE_FILENAME))
+    old.execute('CREATE TABLE pdf_probe (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                'mtime INTEGER NOT NULL, pages INTEGER NOT NULL)')
+    old.commit()
+    old.close()
+    path = os.path.join(root, 'a.pdf')
+    open(path, 'wb').write(b'%PDF-1.4')
+
+    probes = []
+    monkeypatch.setattr(pdfprobe, 'probe_pdf', lambda path: probes.append(path) or (2, [90, 0]))
+    # A cache from before rotations were kept is started afresh
+    cache = pdfprobe.ProbeCache(root)
+    assert pdfprobe.probe_pdfs([path], cache, jobs=1) == {path: (8, 2, [90, 0])}
+    assert pdfprobe.probe_pdfs([path], cache, jobs=1) == {path: (8, 2, [90, 0])}
+    assert probes == [path]
+    cache.close()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for tools/make_thumbnails.py
+"""
+import os
+import sys
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+import make_thumbnails
+from shikin.pdf import pdfimages, thumbnails, manifest
+
+
+def fake_pdf_images(pdf_fullpath, firstpage=1, lastpage=None, rotation=None):
+    if 'empty' not in pdf_fullpath:
+        yield 1, Image.new('1', (400, 600), 1)
+
+
+def fake_optimise_png(path):
+    open(path + '.optimised', 'w').close()
+    return path
+
+
+def make_tree(tmp_path):
+    pdf_root = tmp_path / 'pdf'
+    for rel in ('SS1/a.pdf', 'SS1/b.pdf', 'SS2/c.pdf', 'SS2/empty.pdf', 'SS2/notes.txt'):
+        path = pdf_root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'%PDF-1.4')
+    thumb_root = tmp_path / 'thumbnails'
+    thumb_root.mkdir()
+    return str(pdf_root), str(thumb_root)
+
+
+def test_manifest(tmp_path, monkeypatch):
+    pdf = tmp_path / 'a.pdf'
+    pdf.write_bytes(b'%PDF-1.4 one')
+    thumbs = manifest.ThumbnailManifest(str(tmp_path / 'thumbs.sqlite'))
+    sha1 = manifest.file_sha1(str(pdf))
+    assert thumbs.status('a.pdf', str(pdf), 12, 100, True) == manifest.RENDER
+
+    thumbs.record('a.pdf', 12, 100, sha1)
+    assert thumbs.get('a.pdf')['widths'] == list(thumbnails.THUMBNAIL_WIDTHS)
+    assert thumbs.status('a.pdf', str(pdf), 12, 100, False) == manifest.FRESH
+    assert thumbs.status('a.pdf', str(pdf), 12, 100, True) == manifest.OPTIMISE
+    thumbs.set_optimised('a.pdf')
+    assert thumbs.status('a.pdf', str(pdf), 12, 100, True) == manifest.FRESH
+
+    # Touched but the same
+    assert thumbs.status('a.pdf', str(pdf), 12, 200, True) == manifest.FRESH
+    assert thumbs.get('a.pdf')['mtime'] == 200
+    # Changed
+    pdf.write_bytes(b'%PDF-1.4 two')
+    assert thumbs.status('a.pdf', str(pdf), 12, 300, True) == manifest.RENDER
+    # Other settings
+    monkeypatch.setattr(pdfimages, 'RENDER_DENSITY', 300)
+    assert thumbs.status('a.pdf', str(pdf), 12, 200, True) == manifest.RENDER
+
+
+def test_find_pdfs(tmp_path):
+    pdf_root, thumb_root = make_tree(tmp_path)
+    thumbs = manifest.ThumbnailManifest(str(tmp_path / 'thumbs.sqlite'))
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, [], False, thumbs, True)
+    assert sorted(os.path.relpath(t, thumb_root) for p, t, k in jobs) == \
+        ['SS1/a.pdf_thumb.png', 'SS1/b.pdf_thumb.png', 'SS2/c.pdf_thumb.png', 'SS2/empty.pdf_thumb.png']
+    assert sorted(k for p, t, k in jobs) == ['SS1/a.pdf', 'SS1/b.pdf', 'SS2/c.pdf', 'SS2/empty.pdf']
+    assert to_optimise == []
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, ['b.pdf'], False, thumbs, True)
+    assert [k for p, t, k in jobs] == ['SS1/b.pdf']
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, ['SS2'], False, thumbs, True)
+    assert len(jobs) == 2
+
+
+def made_files(thumb_root):
+    return sorted(os.path.relpath(os.path.join(root, f), thumb_root)
+                  for root, dirs, files in os.walk(thumb_root) for f in files)
+
+
+def test_incremental(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdfimages, 'pdf_images', fake_pdf_images)
+    monkeypatch.setattr(pdfimages, 'optimise_png', fake_optimise_png)
+    pdf_root, thumb_root = make_tree(tmp_path)
+    thumbs = manifest.ThumbnailManifest(str(tmp_path / 'thumbs.sqlite'))
+
+    # A first run without optipng, rendering in parallel
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, [], False, thumbs, False)
+    progress = make_thumbnails.Progress(len(jobs), False, thumbs)
+    make_thumbnails.run_parallel(jobs, to_optimise, progress, 2)
+    assert (progress.rendered, progress.failed, progress.optimised) == (3, 1, 0)
+    made = made_files(thumb_root)
+    assert [x for x in made if x.startswith('SS1/a.pdf')] == \
+        ['SS1/a.pdf_thumb-240.png', 'SS1/a.pdf_thumb-240.webp', 'SS1/a.pdf_thumb-800.png', 'SS1/a.pdf_thumb-800.webp']
+    assert len(made) == 12
+    small = Image.open(os.path.join(thumb_root, 'SS1', 'a.pdf_thumb-240.webp'))
+    assert (small.format, small.size) == ('WEBP', (240, 360))
+    # Not made bigger than the page
+    assert Image.open(os.path.join(thumb_root, 'SS1', 'a.pdf_thumb-800.png')).size == (400, 600)
+    assert thumbs.get('SS1/a.pdf')['optimised'] == 0
+    assert thumbs.get('SS2/empty.pdf') is None
+
+    # Then with optipng, which only needs optimising, besides the one which failed
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, [], False, thumbs, True)
+    assert [k for p, t, k in jobs] == ['SS2/empty.pdf']
+    assert sorted(k for k, pngs in to_optimise) == ['SS1/a.pdf', 'SS1/b.pdf', 'SS2/c.pdf']
+    progress = make_thumbnails.Progress(len(jobs), True, thumbs)
+    make_thumbnails.run_parallel(jobs, to_optimise, progress, 2)
+    assert (progress.rendered, progress.failed, progress.queued, progress.optimised) == (0, 1, 6, 6)
+    assert len(made_files(thumb_root)) == 18
+    assert thumbs.get('SS1/a.pdf')['optimised'] == 1
+
+    # A changed pdf is done again, serially this time
+    with open(os.path.join(pdf_root, 'SS1', 'b.pdf'), 'ab') as f:
+        f.write(b'more')
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, [], False, thumbs, True)
+    assert sorted(k for p, t, k in jobs) == ['SS1/b.pdf', 'SS2/empty.pdf']
+    progress = make_thumbnails.Progress(len(jobs), True, thumbs)
+    make_thumbnails.run_serial(jobs, to_optimise, progress)
+    assert (progress.rendered, progress.failed, progress.optimised) == (1, 1, 2)
+    assert thumbs.get('SS1/b.pdf')['sha1'] == manifest.file_sha1(os.path.join(pdf_root, 'SS1', 'b.pdf'))
+
+
+def test_adopt(tmp_path, monkeypatch):
+    pdf_root, thumb_root = make_tree(tmp_path)
+    for width, fmt, path in thumbnails.thumbnail_names(os.path.join(thumb_root, 'SS1', 'a.pdf')):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+    thumbs = manifest.ThumbnailManifest(str(tmp_path / 'thumbs.sqlite'))
+    jobs, to_optimise = make_thumbnails.find_pdfs(pdf_root, thumb_root, [], False, thumbs, True, adopt=True)
+    assert 'SS1/a.pdf' not in [k for p, t, k in jobs]
+    assert thumbs.get('SS1/a.pdf')['optimised'] == 1
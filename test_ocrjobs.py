@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the OCR progress table in tools/toollib/ocrjobs.py
+"""
+import os
+import sys
+import sqlite3
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+from toollib.ocrjobs import JobTable, PENDING, DONE, FAILED, MAX_ATTEMPTS
+
+
+def test_add_doc(tmp_path):
+    jobs = JobTable(str(tmp_path / 'jobs.db'))
+    assert not jobs.has_doc(1)
+    jobs.add_doc(1, '/1.pdf', 4, done={2, 4})
+    jobs.add_doc(2, '/2.pdf', 2)
+    assert jobs.has_doc(1) and jobs.has_doc(2)
+    assert jobs.pending() == [(1, 1, '/1.pdf'), (1, 3, '/1.pdf'), (2, 1, '/2.pdf'), (2, 2, '/2.pdf')]
+    assert jobs.counts() == {PENDING: 4, DONE: 2}
+
+    # Adding a doc again leaves its pages as they were
+    jobs.add_doc(1, '/1.pdf', 4)
+    assert jobs.counts() == {PENDING: 4, DONE: 2}
+
+
+def test_transitions(tmp_path):
+    jobs = JobTable(str(tmp_path / 'jobs.db'))
+    jobs.add_doc(1, '/1.pdf', 3)
+    jobs.fail(1, 1, 'no such page')
+    jobs.finish(1, 2, 7)
+    assert jobs.counts() == {PENDING: 1, DONE: 1, FAILED: 1}
+    # Failed pages are tried again
+    assert jobs.pending() == [(1, 1, '/1.pdf'), (1, 3, '/1.pdf')]
+    row = jobs.db.execute('SELECT status, segments, error, finished FROM page_job WHERE page = 2').fetchone()
+    assert row[:3] == (DONE, 7, None) and row[3] is not None
+
+    # and succeeding clears the error
+    jobs.finish(1, 1, 0)
+    assert jobs.db.execute('SELECT status, error FROM page_job WHERE page = 1').fetchone() == (DONE, None)
+    assert jobs.pending() == [(1, 3, '/1.pdf')]
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    jobs = JobTable(path)
+    jobs.add_doc(1, '/1.pdf', 3)
+    jobs.add_doc(2, '/2.pdf', 2)
+    for docid, page, _ in jobs.pending()[:3]:
+        if page == 2:
+            jobs.fail(docid, page, 'timeout')
+        else:
+            jobs.finish(docid, page, 1)
+    # The run dies here, without closing anything
+    del jobs
+
+    jobs = JobTable(path)
+    assert jobs.has_doc(1) and jobs.has_doc(2)
+    assert jobs.pending() == [(1, 2, '/1.pdf'), (2, 1, '/2.pdf'), (2, 2, '/2.pdf')]
+    assert jobs.counts() == {PENDING: 2, DONE: 2, FAILED: 1}
+
+
+def test_given_up(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    jobs = JobTable(path)
+    jobs.add_doc(1, '/1.pdf', 2)
+    for attempt in range(MAX_ATTEMPTS):
+        assert jobs.pending() == [(1, 1, '/1.pdf'), (1, 2, '/1.pdf')]
+        assert jobs.given_up() == []
+        jobs.fail(1, 1, 'bad page %d' % attempt)
+    # A page which keeps failing isn't tried again
+    assert jobs.pending() == [(1, 2, '/1.pdf')]
+    assert jobs.given_up() == [(1, 1, 'bad page %d' % (MAX_ATTEMPTS - 1))]
+    assert jobs.counts() == {PENDING: 1, FAILED: 1}
+
+    # unless a later run allows more tries
+    assert JobTable(path, MAX_ATTEMPTS + 1).pending() == [(1, 1, '/1.pdf'), (1, 2, '/1.pdf')]
+
+
+def test_old_job_db(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE page_job (doc_id INTEGER NOT NULL, page INTEGER NOT NULL, path TEXT NOT NULL, "
+               "status TEXT NOT NULL DEFAULT 'pending', segments INTEGER, error TEXT, finished TIMESTAMP, "
+               "PRIMARY KEY (doc_id, page))")
+    with db:
+        db.execute("INSERT INTO page_job (doc_id, page, path, status) VALUES (1, 1, '/1.pdf', 'failed')")
+    db.close()
+
+    jobs = JobTable(path, 1)
+    assert jobs.pending() == [(1, 1, '/1.pdf')]
+    jobs.fail(1, 1, 'again')
+    assert jobs.pending() == []
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the rendered page image cache
+"""
+import io
+import os
+import time
+import threading
+import pytest
+from PIL import Image
+
+import shikin
+from shikin import api
+from shikin.pdf import pagecache
+from shikin.pdf.pagecache import PageCache
+from shikin.pdf.thumbnails import save_image
+from shikin.pdf.manifest import ThumbnailManifest
+from shikin.model import Group, Document, DocRotation
+
+
+class SlowPageCache(PageCache):
+    """Renders plain images slowly, without needing the pdf tools"""
+    def __init__(self, *args):
+        PageCache.__init__(self, *args)
+        self.renders = []
+
+    def rotation(self, pdf_path, pageno, stat):
+        return 0
+
+    def render(self, pdf_path, pageno, dest, rot, width, fmt='png'):
+        self.renders.append((pdf_path, pageno, width, rot))
+        time.sleep(0.2)
+        if pageno > 3:
+            return False
+        save_image(Image.new('L', (width or 1000, 100), pageno * 40), dest, fmt)
+        return True
+
+
+@pytest.fixture
+def pdf(tmp_path):
+    path = tmp_path / 'doc.pdf'
+    path.write_bytes(b'%PDF-1.4 not really')
+    return str(path)
+
+
+def test_single_flight(tmp_path, pdf):
+    cache = SlowPageCache(str(tmp_path / 'cache'), 10 ** 6)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(pdf, 1, 2))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache.renders) == 1
+    assert len(set(results)) == 1
+    path, key = results[0]
+    assert Image.open(path).getpixel((0, 0)) == 80
+
+    # Different sizes and pages are different images
+    assert cache.get(pdf, 1, 2, 400)[1] != key
+    assert cache.get(pdf, 1, 3)[1] != key
+    assert cache.get(pdf, 1, 9) is None
+    assert cache.get(pdf, 1, 2) == (path, key)
+    assert len(cache.renders) == 4
+
+    # A new pdf means new images
+    with open(pdf, 'ab') as f:
+        f.write(b'more')
+    assert cache.get(pdf, 1, 2)[1] != key
+
+
+def test_eviction(tmp_path, pdf):
+    cache = SlowPageCache(str(tmp_path / 'cache'), 10 ** 6)
+    first, key = cache.get(pdf, 1, 1)
+    cache.max_bytes = os.path.getsize(first) * 5 // 2
+    second, _ = cache.get(pdf, 1, 2)
+    os.utime(first, (time.time() + 10, time.time() + 10))
+    third, _ = cache.get(pdf, 1, 3)
+    # The least recently used went
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+
+
+def test_rotations_kept(tmp_path, monkeypatch):
+    read = []
+    monkeypatch.setattr(pagecache, 'get_page_rots', lambda path: read.append(path) or {2: 90})
+    monkeypatch.setattr(pagecache, 'ROTATIONS_KEPT', 2)
+    cache = PageCache(str(tmp_path / 'cache'), 10 ** 6)
+    paths = []
+    for n in range(3):
+        paths.append(str(tmp_path / ('%d.pdf' % n)))
+        with open(paths[-1], 'wb') as f:
+            f.write(b'%PDF-1.4 not really')
+
+    for path in paths[:2] + paths[:1]:
+        assert cache.rotation(path, 2, os.stat(path)) == 90
+        assert cache.rotation(path, 1, os.stat(path)) == 0
+    assert read == paths[:2]
+    # The least recently used pdf goes
+    cache.rotation(paths[2], 1, os.stat(paths[2]))
+    assert len(cache.rots) == 2
+    cache.rotation(paths[0], 1, os.stat(paths[0]))
+    cache.rotation(paths[1], 1, os.stat(paths[1]))
+    assert read == paths + paths[1:2]
+
+
+@pytest.fixture
+def db(app_db, tmp_path, pdf, monkeypatch):
+    db = app_db
+    monkeypatch.setitem(shikin.app.config, 'PDF_DIR', str(tmp_path))
+    monkeypatch.setattr(api, '_page_cache', SlowPageCache(str(tmp_path / 'cache'), 10 ** 6))
+    db.session.add(Document(docset_id=1, year=2014, filename='/doc.pdf', pages=3, size=10, url='u', srcurl='s'))
+    db.session.commit()
+    return db
+
+
+def test_page_view(db):
+    client = shikin.app.test_client()
+    response = client.get('/doc/cached/1/2')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.public
+    etag = response.headers['ETag']
+
+    again = client.get('/doc/cached/1/2', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert len(api._page_cache.renders) == 1
+
+    small = client.get('/doc/cached/1/2?w=400')
+    assert Image.open(io.BytesIO(small.get_data())).width == 400
+    assert small.headers['ETag'] != etag
+    assert client.get('/doc/cached/1/2?w=401').status_code == 400
+    assert client.get('/doc/cached/1/9').status_code == 404
+
+    # Scaled pages are WebP for browsers that take it, full size ones never
+    webp = client.get('/doc/cached/1/2?w=400', headers={'Accept': 'image/webp,*/*'})
+    assert webp.mimetype == 'image/webp'
+    assert Image.open(io.BytesIO(webp.get_data())).format == 'WEBP'
+    assert 'Accept' in webp.vary
+    assert client.get('/doc/cached/1/2', headers={'Accept': 'image/webp,*/*'}).mimetype == 'image/png'
+
+
+def test_recorded_rotation(db):
+    db.session.add(DocRotation(doc_id=1, pages=[0, 90, 270]))
+    db.session.commit()
+    client = shikin.app.test_client()
+    assert client.get('/doc/cached/1/2').status_code == 200
+    assert client.get('/doc/cached/1/3').status_code == 200
+    assert [r[3] for r in api._page_cache.renders] == [90, 270]
+    assert client.get('/api/document/1').get_json()['page_rots'] == [0, 90, 270]
+
+
+def test_doc_thumbnail(db, tmp_path, monkeypatch):
+    db.session.add(Group(id=1, name=u'海賊党', type_id=1))
+    Document.query.get(1).group_id = 1
+    db.session.commit()
+    client = shikin.app.test_client()
+
+    # Made before there were sizes
+    page = client.get('/doc/1').get_data(as_text=True)
+    assert 'src="/static/thumbnails/doc.pdf_thumb.png"' in page
+    assert '<picture>' not in page
+
+    monkeypatch.setitem(shikin.app.config, 'THUMBNAIL_MANIFEST', str(tmp_path / 'thumbs.sqlite'))
+    page = client.get('/doc/1').get_data(as_text=True)
+    assert 'src="/static/thumbnails/doc.pdf_thumb.png"' in page
+
+    # The manifest says which there are
+    ThumbnailManifest(str(tmp_path / 'thumbs.sqlite')).record('doc.pdf', 10, 0, 'x')
+    page = client.get('/doc/1').get_data(as_text=True)
+    assert 'srcset="/static/thumbnails/doc.pdf_thumb-240.webp 240w, /static/thumbnails/doc.pdf_thumb-800.webp 800w"' in page
+    assert 'src="/static/thumbnails/doc.pdf_thumb-800.png"' in page
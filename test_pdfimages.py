@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for picking and turning page images
+"""
+from PIL import Image
+
+from shikin.pdf import pdfimages
+from shikin.pdf.util import parse_page_rots
+
+LISTING = """page   num  type   width height color comp bpc  enc interp  object ID x-ppi y-ppi size ratio
+--------------------------------------------------------------------------------------------
+   1     0 image    2480  3508  gray    1   1  ccitt  no         4  0   300   300 36.2K 3.4%
+   1     1 image     120    80  rgb     3   8  jpeg   no         5  0    72    72 2.1K 7.0%
+   2     2 image     100   100  rgb     3   8  jpeg   no         9  0    72    72 1.1K 3.0%
+   2     3 smask    4000  4000  gray    1   8  image  no         9  0    72    72 1.1K 3.0%
+   2     4 image    3508  2480  gray    1   1  ccitt  no        10  0   300   300 40.0K 3.7%
+   4     5 image     500   500  gray    1   1  ccitt  no        12  0   300   300 1.0K 3.0%
+"""
+
+
+def test_dominant_images():
+    assert pdfimages.dominant_images(LISTING) == {1: 0, 2: 4, 4: 5}
+    assert pdfimages.dominant_images('') == {}
+
+
+def test_image_num():
+    assert pdfimages._image_num('img-012-345.png') == 345
+    assert pdfimages._image_num('junk') == -1
+
+
+def test_rotate_image():
+    img = Image.new('1', (30, 10), 0)
+    img.putpixel((0, 0), 1)
+    assert pdfimages.rotate_image(img, 0) is img
+    turned = pdfimages.rotate_image(img, 90)
+    assert turned.mode == '1'
+    assert turned.size == (10, 30)
+    # Clockwise, so the top left goes to the top right
+    assert turned.getpixel((9, 0))
+    assert pdfimages.rotate_image(img, 180).getpixel((29, 9))
+    assert pdfimages.rotate_image(img, 270).getpixel((0, 29))
+    assert pdfimages.rotate_image(img, 360) is img
+
+
+PDFINFO = """Producer:       scanner
+Pages:          3
+Page    1 size: 595.32 x 841.92 pts (A4)
+Page    1 rot:  0
+Page    2 size: 841.92 x 595.32 pts (A4)
+Page    2 rot:  90
+Page    3 size: 595.32 x 841.92 pts (A4)
+Page    3 rot:  270
+File size:      100 bytes
+"""
+
+
+def test_parse_page_rots():
+    assert parse_page_rots(PDFINFO) == {1: 0, 2: 90, 3: 270}
+    assert parse_page_rots('Pages: 0\n') == {}
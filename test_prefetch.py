@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for rendering review pages ahead of time
+"""
+import time
+import threading
+import pytest
+
+import shikin
+from shikin import prefetch
+from shikin.model import Document, DocSegment, User
+
+
+def test_bounded():
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def render(pdf_path, docid, pageno, rot):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return pageno
+
+    p = prefetch.Prefetcher(2, 4, render)
+    queued = [p.submit('x.pdf', 1, n) for n in range(1, 51)]
+    assert queued.count(False) > 0
+    # Already waiting pages aren't queued twice
+    assert p.submit('x.pdf', 1, 1)
+    p.queue.join()
+    assert running[1] <= 2
+    assert len(p.threads) == 2
+
+
+@pytest.fixture
+def db(app_db, tmp_path, monkeypatch):
+    db = app_db
+    monkeypatch.setitem(shikin.app.config, 'PDF_DIR', str(tmp_path))
+    monkeypatch.setitem(shikin.app.config, 'PREFETCH_AHEAD', 3)
+    rendered = []
+    monkeypatch.setattr(prefetch, '_prefetcher',
+                        prefetch.Prefetcher(1, 16, lambda *page: rendered.append(page) or page))
+    for d in range(1, 4):
+        db.session.add(Document(docset_id=1, year=2014, filename='/%d.pdf' % d, pages=3, size=10,
+                                url='u%d' % d, srcurl='s'))
+    db.session.flush()
+    for d in range(1, 4):
+        for page in range(3):
+            db.session.add(DocSegment(doc_id=d, page=page, row=0, col=0, x1=0, y1=0, x2=10, y2=10,
+                                      ocrtext=u'1,000', viewcount=0))
+    db.session.commit()
+    return rendered
+
+
+def test_reviewdata_prefetches(db):
+    rendered = db
+    clients = []
+    for name in ('first', 'second'):
+        shikin.app.dbobj.session.add(User(name=name, pw_hash='x', email=name))
+        shikin.app.dbobj.session.commit()
+        client = shikin.app.test_client()
+        # The secret key is set up by the first request
+        client.get('/api/reviewcount/%s' % name)
+        with client.session_transaction() as sess:
+            sess['username'] = name
+        clients.append(client)
+    first = clients[0].get('/api/reviewdata').get_json()
+    prefetch._prefetcher.queue.join()
+    assert (first['docid'], first['page']) in [(d, p) for _, d, p, _ in rendered]
+    assert len(rendered) == 4
+
+    # The next page handed out is one that's been rendered already
+    second = clients[1].get('/api/reviewdata').get_json()
+    assert (second['docid'], second['page']) in [(d, p) for _, d, p, _ in rendered]
+    assert (second['docid'], second['page']) != (first['docid'], first['page'])
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the review queue
+"""
+import time
+import random
+import datetime
+import threading
+from collections import Counter
+import pytest
+
+import shikin
+from sqlalchemy import event
+
+from shikin import review, ocrfix
+from shikin.model import Document, DocSegment, DocSegmentReview, User, ReviewPage, rebuild_review_queue, \
+    latest_reviews
+
+
+@pytest.fixture
+def db(app_db, monkeypatch):
+    db = app_db
+    monkeypatch.setitem(shikin.app.config, 'PREFETCH_WORKERS', 0)
+    for d in range(1, 6):
+        db.session.add(Document(docset_id=1, year=2014, filename='/%d.pdf' % d, pages=4, size=10,
+                                url='u%d' % d, srcurl='s'))
+    db.session.commit()
+    rnd = random.Random(6)
+    # As the OCR tool adds them, in bulk
+    db.session.execute(DocSegment.__table__.insert(),
+                       [{'doc_id': d, 'page': p, 'row': r, 'col': 0, 'x1': 0, 'y1': r, 'x2': 10, 'y2': r + 1,
+                         'ocrtext': rnd.choice([u'1,000', None]), 'viewcount': rnd.randint(0, 2)}
+                        for d in range(1, 6) for p in range(4) for r in range(3)])
+    db.session.commit()
+    return db
+
+
+def queue_rows(session):
+    return sorted((x.doc_id, x.page, x.minviews) for x in session.query(ReviewPage))
+
+
+def test_triggers_match_rebuild(db):
+    session = db.session
+    rnd = random.Random(7)
+    for seg in session.query(DocSegment).filter(DocSegment.id % 3 == 0):
+        seg.viewcount += rnd.randint(1, 3)
+    for seg in session.query(DocSegment).filter(DocSegment.id % 5 == 0):
+        seg.ocrtext = None if seg.ocrtext else u'2,000'
+    for seg in session.query(DocSegment).filter(DocSegment.id % 7 == 0):
+        session.delete(seg)
+    session.commit()
+
+    incremental = queue_rows(session)
+    assert incremental
+    rebuild_review_queue(session)
+    assert queue_rows(session) == incremental
+
+
+def test_claims(db, monkeypatch):
+    session = db.session
+    pages = queue_rows(session)
+    with shikin.app.app_context():
+        claims = [review.claim_review_page(user_id=n) for n in range(len(pages))]
+        # Everyone gets a different page, least viewed first
+        assert sorted(c[:2] for c in claims) == [p[:2] for p in pages]
+        assert [c[2] for c in claims] == sorted(p[2] for p in pages)
+        assert review.claim_review_page(user_id=99) is None
+
+        # A reviewer asking again gives back their page
+        again = review.claim_review_page(user_id=0)
+        assert again == claims[0]
+
+        # Abandoned pages come back once the lease is up
+        class Later():
+            @staticmethod
+            def time():
+                return time.time() + shikin.app.config['REVIEW_LEASE'] + 1
+        monkeypatch.setattr(review, 'time', Later)
+        assert review.claim_review_page(user_id=100) is not None
+
+
+def test_concurrent_claims(db):
+    claims = []
+
+    def claim(n):
+        with shikin.app.app_context():
+            claims.append(review.claim_review_page(user_id=n))
+            shikin.app.dbobj.session.remove()
+    threads = [threading.Thread(target=claim, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    claimed = [c[:2] for c in claims if c is not None]
+    assert len(claimed) == len(set(claimed)) == 8
+
+
+def test_suggestions_per_column(db):
+    session = db.session
+    rnd = random.Random(10)
+    # Three columns across the page, each with its own kind of numbers
+    cols = [(0, 10), (200, 300), (600, 700)]
+    session.execute(DocSegment.__table__.insert(),
+                    [{'doc_id': 1, 'page': 0, 'row': r, 'col': c + 1, 'x1': x1, 'y1': 100 + r, 'x2': x2, 'y2': 101 + r,
+                      'ocrtext': u'%d,000' % c}
+                     for r in range(20) for c, (x1, x2) in enumerate(cols)])
+    session.commit()
+    add_reviews(session, rnd)
+    for seg in session.query(DocSegment).filter(DocSegment.x1 == 600):
+        session.add(DocSegmentReview(segment_id=seg.id, rev=9, timestamp=datetime.datetime.now(), user_id=1,
+                                     text=rnd.choice([u'7,000', u'8,000'])))
+    session.commit()
+
+    segs = session.query(DocSegment).filter(DocSegment.page == 0).all()
+    latest = latest_reviews(s.id for s in segs)
+    batch = ocrfix.suggestions_for(segs, 2)
+    for seg in segs:
+        counts = Counter(latest[s.id].text for s in segs if s.id in latest and
+                         s.x1 >= seg.x1 - 50 and s.x2 <= seg.x2 + 50)
+        expected = [t for t, c in sorted(counts.items(), key=lambda x: (-x[1], x[0])) if t != seg.ocrtext][:2]
+        assert batch[seg.id] == expected
+    assert set(batch[segs[-1].id]) <= {u'7,000', u'8,000'}
+
+
+def login(client, name):
+    # The secret key is set up by the first request
+    client.get('/api/reviewcount/%s' % name)
+    with client.session_transaction() as sess:
+        sess['username'] = name
+
+
+def test_reviews_move_pages_back(db):
+    user = User(name='reviewer', pw_hash='x', email='x')
+    db.session.add(user)
+    db.session.commit()
+    client = shikin.app.test_client()
+    login(client, 'reviewer')
+
+    data = client.get('/api/reviewdata').get_json()
+    before = db.session.get(ReviewPage, (data['docid'], data['page'] - 1)).minviews
+    for seg in data['segments']:
+        assert client.get('/api/review/%d' % seg['segment_id'], query_string={'skip': 1}).status_code == 200
+    db.session.expire_all()
+    assert db.session.get(ReviewPage, (data['docid'], data['page'] - 1)).minviews > before
+
+
+def add_reviews(session, rnd):
+    user = User(name='reviewer', pw_hash='x', email='x')
+    session.add(user)
+    session.flush()
+    for seg in session.query(DocSegment).filter(DocSegment.ocrtext != None):
+        for rev in range(1, rnd.randint(0, 3) + 1):
+            session.add(DocSegmentReview(segment_id=seg.id, rev=rev, timestamp=datetime.datetime.now(),
+                                         user_id=user.id, text=rnd.choice([u'1,000', u'2,000', u'3,000'])))
+    session.commit()
+
+
+def test_latest_reviews(db):
+    add_reviews(db.session, random.Random(8))
+    segs = db.session.query(DocSegment).all()
+    latest = latest_reviews(s.id for s in segs)
+    assert latest
+    for seg in segs:
+        usertext = seg.usertext
+        assert latest.get(seg.id) == usertext
+    assert latest_reviews([]) == {}
+
+    batch = ocrfix.suggestions_for(segs)
+    assert set(batch) == set(s.id for s in segs)
+    assert batch[segs[0].id] == ocrfix.suggestions(segs[0])
+    assert all(s.ocrtext not in batch[s.id] for s in segs)
+
+
+def test_reviewdata_queries(db):
+    add_reviews(db.session, random.Random(9))
+    queries = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *a: queries.append(a[2]))
+    client = shikin.app.test_client()
+    login(client, 'reviewer')
+    del queries[:]
+    data = client.get('/api/reviewdata').get_json()
+    assert data['segments']
+    assert len(queries) < 15
+
+
+def test_anonymous_reviewdata(db):
+    client = shikin.app.test_client()
+    assert client.get('/api/reviewdata').status_code == 403
+    assert db.session.query(ReviewPage).filter(ReviewPage.lease_until > 0).count() == 0
+    with shikin.app.app_context():
+        with pytest.raises(ValueError):
+            review.claim_review_page(None)
+
+    # The review page only loads its script for someone logged in
+    assert b'review.js' not in client.get('/review').data
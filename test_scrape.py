@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the crawler in tools/scrape.py, against a local stand-in for the site
+"""
+import os
+import sys
+import time
+import threading
+import hashlib
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+import scrape
+from toollib import metautil
+
+REPORTS = '/senkyo/seiji_s/seijishikin/'
+
+INDEX = u"""<html><head><meta charset="utf-8"></head><body>
+<div id="title">政治資金収支報告書</div>
+<ul>
+<li><a href="/senkyo/seiji_s/seijishikin/reports/KS20150101.html">平成27年1月1日公表（解散分）</a></li>
+<li><a href="/senkyo/seiji_s/seijishikin/reports/KS20150201.html">平成27年2月1日公表（解散分）</a></li>
+</ul>
+</body></html>"""
+
+KAISAN = u"""<html><head><meta charset="utf-8"></head><body>
+<div id="title">解散分 %(n)d</div>
+<span>平成26年分</span>
+<div>
+<p><strong>[政党]</strong><a href="%(base)scontents/%(n)d/a.pdf">あ会</a></p>
+<p><strong>[その他]</strong><a href="%(base)scontents/%(n)d/b.pdf">い会</a></p>
+<p><strong>[その他]</strong><a href="%(base)scontents/%(n)d/c.pdf">う会</a></p>
+<p><strong>[その他]</strong><a href="%(base)scontents/shared.pdf">え会</a></p>
+</div>
+</body></html>"""
+
+
+def pdf_body(path):
+    return b'%PDF-1.4 ' + path.encode('utf-8') * 20
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    Serves INDEX, two KAISAN pages and some pdfs, with a little latency.
+    Supports ETags and simple range requests.
+    """
+    lock = threading.Lock()
+    requests = []
+    responses = []
+    active = 0
+    max_active = 0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(self.path)
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(0.05)
+            if self.path == REPORTS:
+                body = INDEX.encode('utf-8')
+            elif self.path.startswith(REPORTS + 'reports/KS2015'):
+                n = int(self.path[len(REPORTS) + 15])
+                body = (KAISAN % {'n': n, 'base': REPORTS}).encode('utf-8')
+            elif self.path.endswith('.pdf'):
+                body = pdf_body(self.path)
+            else:
+                self.send_error(404)
+                return
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            status = 200
+            if self.headers.get('If-None-Match') == etag:
+                status = 304
+            elif self.headers.get('Range') and self.headers.get('If-Range') == etag:
+                start = int(self.headers['Range'][6:-1])
+                status = 206
+            with cls.lock:
+                cls.responses.append((self.path, status))
+            self.send_response(status)
+            self.send_header('ETag', etag)
+            if status == 304:
+                self.end_headers()
+                return
+            if status == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+                body = body[start:]
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    StandIn.requests = []
+    StandIn.responses = []
+    StandIn.max_active = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    html = tmp_path / 'cache'
+    pdf = tmp_path / 'pdf'
+    html.mkdir()
+    pdf.mkdir()
+    monkeypatch.setattr(scrape, 'html_cache_dir', str(html))
+    monkeypatch.setattr(scrape, 'pdf_cache_dir', str(pdf))
+    monkeypatch.setattr(scrape, '_seen', set())
+    monkeypatch.setattr(scrape, '_revalidate', True)
+    yield 'http://127.0.0.1:%d' % server.server_address[1], str(pdf)
+    server.shutdown()
+
+
+def test_crawl(site):
+    root, pdf_dir = site
+    crawler = scrape.Crawler(workers=6, per_host=2, delay=0)
+    try:
+        scrape.scrape_from(crawler, root + REPORTS, [], False)
+    finally:
+        crawler.close()
+
+    assert crawler.errors == 0
+    pdfs = sorted(p for p in StandIn.requests if p.endswith('.pdf'))
+    assert pdfs == sorted(set(pdfs))
+    assert len(pdfs) == 7
+    assert len(StandIn.requests) == 10
+    assert StandIn.max_active <= 2
+
+    meta = metautil.get_meta(os.path.join(pdf_dir, 'contents', '1', 'a.pdf'))
+    assert meta['srctitle'] == u'あ会'
+    assert meta['grouptype'] == u'政党'
+    assert meta['year'] == u'平成26'
+    assert meta['pagetype'] == 'kaisan'
+
+
+def test_politeness_delay(site):
+    root, pdf_dir = site
+    crawler = scrape.Crawler(workers=4, per_host=4, delay=0.1)
+    start = time.monotonic()
+    try:
+        for n in range(4):
+            crawler.spawn(scrape.save, crawler, root + REPORTS, os.path.join(pdf_dir, 'index%d' % n))
+        crawler.wait()
+    finally:
+        crawler.close()
+    # Four requests, the last can't start until 3 delays after the first
+    assert time.monotonic() - start >= 0.3
+    assert crawler.errors == 0
+
+
+def test_recrawl_revalidates(site, monkeypatch):
+    root, pdf_dir = site
+    for run in range(2):
+        monkeypatch.setattr(scrape, '_seen', set())
+        StandIn.responses = []
+        crawler = scrape.Crawler(workers=4, per_host=4, delay=0)
+        try:
+            scrape.scrape_from(crawler, root + REPORTS, [], False)
+        finally:
+            crawler.close()
+        assert crawler.errors == 0
+
+    # Second time around the pages are all unchanged, and pdfs aren't asked for
+    assert sorted(StandIn.responses) == sorted([
+        (REPORTS, 304),
+        (REPORTS + 'reports/KS20150101.html', 304),
+        (REPORTS + 'reports/KS20150201.html', 304),
+    ])
+
+
+def test_resume_download(site):
+    root, pdf_dir = site
+    url_path = REPORTS + 'contents/big.pdf'
+    path = os.path.join(pdf_dir, 'big.pdf')
+    body = pdf_body(url_path)
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+
+    # As if an earlier download got cut off half way
+    scrape._get_index().put(root + url_path, etag, None, None)
+    open(path + '.part', 'wb').write(body[:50])
+
+    assert scrape.save(scrape.Crawler(), root + url_path, path)
+    assert StandIn.responses == [(url_path, 206)]
+    assert open(path, 'rb').read() == body
+    assert not os.path.exists(path + '.part')
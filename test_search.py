@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the full text search index
+"""
+import datetime
+import pytest
+
+import shikin
+from sqlalchemy import event
+from shikin import search
+from shikin.model import Group, Document, DocSegment, DocSegmentReview, User
+
+NAMES = [u'自由民主党', u'自由民主党東京都支部連合会', u'民主党', u'日本共産党', u'みんなの党',
+         u'海賊党', u'神の党', u'Pirate Party', u'党']
+
+
+@pytest.fixture
+def db(app_db):
+    db = app_db
+    db.session.add(User(name='admin', pw_hash='*', email='admin@example.com'))
+    for n, name in enumerate(NAMES):
+        db.session.add(Group(id=n + 1, name=name, type_id=1))
+    db.session.flush()
+    for n in range(len(NAMES)):
+        db.session.add(Document(docset_id=1, year=2014, group_id=n + 1, filename='%d.pdf' % n, pages=1,
+                                size=10, url='u%d' % n, srcurl='s', note=u'（その%d）' % n if n % 2 else None))
+    db.session.commit()
+    return db
+
+
+def like_groups(q):
+    return sorted(x.id for x in Group.query if q.lower() in x.name.lower())
+
+
+def index_groups(q):
+    return sorted(x.id for x in Group.query.filter(Group.id.in_(search.matching_ids(search.GROUP, q))))
+
+
+@pytest.mark.parametrize('q', [u'党', u'民主', u'民主党', u'自由民主党東京', u'pirate', u'ARTY', u'なし', u'党党党',
+                               u'%', u'_'])
+def test_same_as_like(db, q):
+    assert index_groups(q) == like_groups(q)
+
+
+def test_kept_in_sync(db):
+    session = db.session
+    g = session.get(Group, 6)
+    g.name = u'海賊の会'
+    session.add(Group(id=20, name=u'新しい海賊党', type_id=1))
+    session.delete(session.get(Group, 7))
+    session.commit()
+    assert index_groups(u'海賊党') == [20]
+    assert index_groups(u'海賊') == [6, 20]
+    assert index_groups(u'神の') == []
+
+    seg = DocSegment(doc_id=1, page=0, row=0, col=0, x1=0, y1=0, x2=10, y2=10, ocrtext=u'寄附金 l23,456')
+    session.add(seg)
+    session.commit()
+    assert [x[1] for x in search.search(u'23,456')] == [seg.id]
+
+    # A review replaces the ocr text, taking the review back brings it back
+    review = DocSegmentReview(segment=seg, rev=1, timestamp=datetime.datetime.now(), user_id=1,
+                              text=u'寄附金 123,456')
+    session.add(review)
+    session.commit()
+    assert [x[1] for x in search.search(u'123,456')] == [seg.id]
+    assert search.search(u'l23') == []
+    session.delete(review)
+    session.commit()
+    assert search.search(u'123,456') == []
+    assert [x[1] for x in search.search(u'l23')] == [seg.id]
+
+    session.delete(seg)
+    session.commit()
+    assert search.search(u'l23') == []
+
+
+def test_short_queries(db):
+    session = db.session
+    session.add(DocSegment(doc_id=1, page=0, row=0, col=0, x1=0, y1=0, x2=10, y2=10, ocrtext=u'自由党'))
+    session.commit()
+    queries = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *a: queries.append(a[2]))
+
+    # Too short for the index, so only group names and notes are looked at
+    assert [x[1] for x in search.search(u'由')] == like_groups(u'由')
+    assert [x[1] for x in search.search(u'その', search.DOCUMENT)] == [2, 4, 6, 8]
+    assert search.search(u'由', search.SEGMENT) == []
+    assert index_groups(u'自由') == like_groups(u'自由')
+    assert not any('search_index' in q for q in queries)
+
+    assert [x[0] for x in search.search(u'自由党')] == [search.SEGMENT]
+
+
+def test_rebuild(db):
+    before = db.session.execute('SELECT rowid, text FROM search_index ORDER BY rowid').fetchall()
+    search.rebuild_search(db.session)
+    assert db.session.execute('SELECT rowid, text FROM search_index ORDER BY rowid').fetchall() == before
+
+
+def test_search_api(db, monkeypatch):
+    monkeypatch.setattr(search, 'PAGE_SIZE', 3)
+    client = shikin.app.test_client()
+    first = client.get(u'/api/search?q=党').get_json()
+    assert first['more']
+    assert [x['kind'] for x in first['results']] == ['group'] * 3
+    rest = client.get(u'/api/search?q=党&page=2').get_json()['results'] + \
+        client.get(u'/api/search?q=党&page=3').get_json()['results']
+    ids = [x['id'] for x in first['results'] + rest]
+    assert sorted(ids) == like_groups(u'党')
+
+    notes = client.get(u'/api/search?q=その3&kind=document').get_json()
+    assert [(x['kind'], x['id']) for x in notes['results']] == [('document', 4)]
+    assert client.get(u'/api/search?q=x&kind=nope').status_code == 400
+
+    pager = client.get(u'/api/summary/group?search[value]=民主').get_json()
+    assert pager['recordsFiltered'] == len(like_groups(u'民主')) == 3
+    assert sorted(x['id'] for x in pager['data']) == like_groups(u'民主')
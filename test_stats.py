@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the summary stats tables kept by triggers on the document table
+"""
+import random
+import datetime
+import pytest
+
+import shikin
+from shikin import views
+from shikin.model import Group, DocSet, Document, GroupYearStats, YearStats, DocSetYearStats, rebuild_stats
+
+
+@pytest.fixture
+def db(app_db):
+    db = app_db
+    for i in range(1, 3):
+        db.session.add(DocSet(published=datetime.date(2015, 1, i + 1), pubtype_id=1, doctype_id=1, path='/%d' % i))
+    db.session.add(Group(id=1, name=u'parent', type_id=1))
+    for i in range(2, 8):
+        db.session.add(Group(id=i, name=u'group %d' % i, type_id=1, parent_id=1 if i < 5 else None))
+    db.session.commit()
+    return db
+
+
+def stats_rows(session):
+    return [sorted(tuple(getattr(x, c.key) for c in t.__table__.columns) for x in session.query(t))
+            for t in (GroupYearStats, YearStats, DocSetYearStats)]
+
+
+def random_doc(rnd, n):
+    return {'docset_id': rnd.randint(1, 3), 'year': rnd.choice([2010, 2011, 2012, None]),
+            'group_id': rnd.randint(1, 7), 'filename': 'f%d.pdf' % n, 'pages': rnd.randint(1, 9),
+            'size': rnd.randint(100, 9000), 'url': 'u%d' % n, 'srcurl': 's'}
+
+
+def test_triggers_match_rebuild(db):
+    rnd = random.Random(3)
+    session = db.session
+
+    # Through the orm, as the raw api does
+    for n in range(40):
+        session.add(Document(**random_doc(rnd, n)))
+    session.commit()
+    # Bulk, as the importer does
+    session.bulk_insert_mappings(Document, [random_doc(rnd, n) for n in range(40, 100)])
+    session.commit()
+
+    for doc in session.query(Document).filter(Document.id % 5 == 0):
+        doc.year = rnd.choice([2010, 2013])
+        doc.group_id = rnd.randint(1, 7)
+        doc.pages += 1
+    for doc in session.query(Document).filter(Document.id % 7 == 0):
+        session.delete(doc)
+    session.commit()
+    session.query(Document).filter(Document.id > 90).delete(synchronize_session=False)
+    session.commit()
+
+    incremental = stats_rows(session)
+    assert incremental[0]
+    rebuild_stats(session)
+    assert stats_rows(session) == incremental
+
+
+def test_summaries(db):
+    rnd = random.Random(4)
+    session = db.session
+    session.bulk_insert_mappings(Document, [random_doc(rnd, n) for n in range(50)])
+    session.commit()
+    docs = session.query(Document).all()
+
+    client = shikin.app.test_client()
+    years = client.get('/api/summary/stats').get_json()['years']
+    assert [y['year'] for y in years] == [2010, 2011, 2012]
+    for y in years:
+        ydocs = [d for d in docs if d.year == y['year']]
+        assert y['docs'] == len(ydocs)
+        assert y['groups'] == len(set(d.group_id for d in ydocs))
+        assert y['pages'] == sum(d.pages for d in ydocs)
+        assert y['bytes'] == sum(d.size for d in ydocs)
+
+    byyear = client.get('/api/summary/group/1/stats').get_json()['byyear']
+    assert byyear and all(y['year'] for y in byyear)
+    for y in byyear:
+        children = [d for d in docs if d.year == y['year'] and d.group_id in (2, 3, 4)]
+        assert y.get('child_docs', 0) == len(children)
+        assert y.get('docs', 0) == len([d for d in docs if d.year == y['year'] and d.group_id == 1])
+
+
+def test_undated_docs(db, monkeypatch):
+    rnd = random.Random(5)
+    session = db.session
+    session.bulk_insert_mappings(Document, [random_doc(rnd, n) for n in range(50)])
+    # A docset with only undated docs has no years
+    session.add(DocSet(published=datetime.date(2016, 1, 1), pubtype_id=1, doctype_id=1, path='/undated'))
+    session.add(Document(docset_id=4, year=None, group_id=1, filename='u.pdf', pages=1, size=1, url='undated',
+                         srcurl='s'))
+    session.commit()
+    docs = session.query(Document).all()
+    assert any(d.year is None for d in docs if d.docset_id != 4)
+
+    client = shikin.app.test_client()
+    years = client.get('/api/summary/year').get_json()
+    assert years == {str(y): len([d for d in docs if d.year == y]) for y in (2010, 2011, 2012)}
+    rendered = []
+    monkeypatch.setattr(views, 'render_template', lambda name, **context: rendered.append(context) or '')
+    assert client.get('/years').status_code == 200
+    assert {str(y): n for y, n in rendered[0]['year'].items()} == years
+
+    docsets = client.get('/api/summary/doc_sets').get_json()['objects']
+    for docset in docsets:
+        dsdocs = [d for d in docs if d.docset_id == docset['id']]
+        dated = [d.year for d in dsdocs if d.year is not None]
+        assert docset['doccount'] == len(dsdocs)
+        assert (docset['minyear'], docset['maxyear']) == ((min(dated), max(dated)) if dated else (None, None))
+    assert len(docsets) == 4
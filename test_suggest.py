@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the typeahead suggestions
+"""
+import random
+import sqlite3
+import threading
+import pytest
+
+import shikin
+from shikin import suggest
+from shikin.model import Group, Document
+
+
+def test_lookup_ranked_by_doccount():
+    rnd = random.Random(5)
+    chars = u'自由民主党日本共産会東京都支部ＡBc'
+    groups = [(i, ''.join(rnd.choice(chars) for _ in range(rnd.randint(1, 8))), rnd.randint(0, 50))
+              for i in range(2000)]
+    index = suggest.SuggestIndex(groups)
+    for q in [u'党', u'民主', u'自由民主', u'東京都', u'ab', u'ＡＢ', u'c', u'zz', u'党党']:
+        nq = suggest.normalise(q)
+        expected = sorted([g for g in groups if nq in suggest.normalise(g[1])], key=lambda x: (-x[2], x[1]))
+        assert index.lookup(q, 10) == expected[:10]
+        # and again from the cache
+        assert index.lookup(q, 10) == expected[:10]
+
+
+@pytest.fixture
+def db(app_db, monkeypatch):
+    db = app_db
+    for n, name in enumerate([u'海賊党', u'神の党', u'海の会']):
+        db.session.add(Group(id=n + 1, name=name, type_id=1))
+        for d in range(n):
+            db.session.add(Document(docset_id=1, year=2014, group_id=n + 1, filename='%d.pdf' % d, pages=1,
+                                    size=10, url='u%d-%d' % (n, d), srcurl='s'))
+    db.session.commit()
+    suggest.wait_for_rebuild()
+    monkeypatch.setattr(suggest, '_index', None)
+    return db
+
+
+def test_suggest_api(db):
+    client = shikin.app.test_client()
+    r = client.get(u'/api/suggest?q=党')
+    assert [x['name'] for x in r.get_json()['values']] == [u'神の党', u'海賊党']
+    assert r.cache_control.public and r.cache_control.max_age == suggest.MAX_AGE
+    assert not r.cache_control.no_cache
+
+    # New groups show up once the index has been rebuilt in the background
+    db.session.add(Group(id=4, name=u'新党', type_id=1))
+    db.session.commit()
+    assert [x['name'] for x in client.get(u'/api/suggest?q=党&n=1').get_json()['values']] == [u'神の党']
+    suggest.wait_for_rebuild()
+    assert u'新党' in [x['name'] for x in client.get(u'/api/suggest?q=党').get_json()['values']]
+
+
+def test_rebuilt_in_background(db, monkeypatch):
+    old = suggest.get_index()
+    assert [x[1] for x in old.lookup(u'党')] == [u'神の党', u'海賊党']
+
+    building = threading.Event()
+    release = threading.Event()
+    build = suggest._build
+
+    def slow_build(session):
+        building.set()
+        release.wait(10)
+        return build(session)
+    monkeypatch.setattr(suggest, '_build', slow_build)
+    db.session.add(Group(id=4, name=u'新党', type_id=1))
+    db.session.commit()
+
+    # The old index is used until the new one is ready
+    client = shikin.app.test_client()
+    assert len(client.get(u'/api/suggest?q=党').get_json()['values']) == 2
+    assert building.wait(10)
+    assert suggest.get_index() is old
+    release.set()
+    suggest.wait_for_rebuild()
+    assert len(suggest.get_index().lookup(u'党')) == 3
+
+    # Nothing changed, so a later check keeps the index it has
+    new = suggest.get_index()
+    monkeypatch.setattr(suggest, '_checked', 0)
+    suggest.get_index()
+    suggest.wait_for_rebuild()
+    assert suggest.get_index() is new
+
+
+def test_renamed_elsewhere(db, monkeypatch):
+    monkeypatch.setitem(shikin.app.config, 'RESPONSE_CACHE_VERSION_TTL', 0)
+    assert suggest.get_index().lookup(u'海賊')
+    # Another process renames a group, with the same number of groups and documents
+    conn = sqlite3.connect(shikin.app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):])
+    with conn:
+        conn.execute(u'UPDATE "group" SET name = ? WHERE name = ?', (u'山賊党', u'海賊党'))
+    conn.close()
+
+    monkeypatch.setattr(suggest, '_checked', 0)
+    suggest.get_index()
+    suggest.wait_for_rebuild()
+    assert [x[1] for x in suggest.get_index().lookup(u'賊')] == [u'山賊党']
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the table splitter in tools/tableocr.py
+"""
+import os
+import sys
+import random
+import threading
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+import tableocr
+from tableocr import Box, MAX_LINE_DRIFT
+
+
+# Reference versions of the line detection, as they were before the numpy
+# engine.  These walk the image through PIL's pixel accessor, and are what the
+# new engine has to match.
+
+def ref_get_vblocks(pix, w, h, thresh):
+    colthresh = 255 * 6
+    colsums = [sum(255-pix[x, y] for y in range(h)) for x in range(w)]
+
+    minx = 0
+    maxx = w - 1
+    while colsums[minx] < colthresh:
+        minx += 1
+    while colsums[maxx] < colthresh:
+        maxx -= 1
+
+    rowthresh = 255 * 6
+    rowsums = [sum(255-pix[x, y] for x in range(minx, maxx)) for y in range(h)]
+
+    whiteruns = []
+    whitestart = 0
+    y = 0
+    while y < h:
+        if rowsums[y] > rowthresh:
+            if y - whitestart > 1:
+                whiteruns.append((whitestart, y))
+            whitestart = y
+        y += 1
+    if y - whitestart > 1:
+        whiteruns.append((whitestart, y))
+
+    y0 = 0
+    if whiteruns[0][0] == 0:
+        y0 = whiteruns[0][1]
+        whiteruns.pop(0)
+
+    for run in filter(lambda x: x[1] - x[0] >= thresh, whiteruns):
+        yield Box(minx, y0, maxx, run[0])
+        y0 = run[1]
+
+    if h - y0 > thresh:
+        yield Box(minx, y0, maxx, h)
+
+
+def ref_get_hlines(pix, w, h, thresh):
+    lines = []
+    for y in range(h):
+        thisy = y
+        x1, x2 = (None, None)
+        best_x1, best_x2 = (None, None)
+        black = 0
+        run = 0
+        for x in range(w):
+            if black > 20 and pix[x, thisy] != 0 and abs(y - thisy) < MAX_LINE_DRIFT:
+                if thisy > 0 and pix[x, thisy-1] == 0:
+                    thisy -= 1
+                elif thisy < h-1 and pix[x, thisy+1] == 0:
+                    thisy += 1
+
+            if pix[x, thisy] == 0:
+                black += 1
+                if x1 is None:
+                    x1 = x
+                x2 = x
+            else:
+                if black > run:
+                    run = black
+                    best_x1 = x1
+                    best_x2 = x2
+                    x1, x2 = (None, None)
+                black = 0
+        if black > run:
+            run = black
+            best_x1 = x1
+            best_x2 = x2
+        if run > thresh:
+            lines.append(Box(best_x1, min(y, thisy), best_x2, max(y, thisy)))
+    return lines
+
+
+def ref_get_vlines(pix, w, h, thresh):
+    lines = []
+    for x in range(w):
+        thisx = x
+        y1, y2 = (None, None)
+        best_y1, best_y2 = (None, None)
+        black = 0
+        run = 0
+        for y in range(h):
+            if black > 20 and pix[thisx, y] != 0 and abs(x - thisx) < MAX_LINE_DRIFT:
+                if thisx > 0 and pix[thisx-1, y] == 0:
+                    thisx -= 1
+                elif thisx < w-1 and pix[thisx+1, y] == 0:
+                    thisx += 1
+
+            if pix[thisx, y] == 0:
+                black += 1
+                if y1 is None:
+                    y1 = y
+                y2 = y
+            else:
+                if black > run:
+                    run = black
+                    best_y1 = y1
+                    best_y2 = y2
+                    y1, y2 = (None, None)
+                black = 0
+        if black > run:
+            run = black
+            best_y1 = y1
+            best_y2 = y2
+        if run > thresh:
+            lines.append(Box(min(x, thisx), best_y1, max(x, thisx), best_y2))
+    return lines
+
+
+def make_table(w, h, seed, slope=0, blocks=1):
+    """Draw a synthetic scanned table: grid lines, some slope, text-ish noise"""
+    rnd = random.Random(seed)
+    im = Image.new('1', (w, h), 255)
+    draw = ImageDraw.Draw(im)
+    block_h = h // blocks
+    for b in range(blocks):
+        top = b * block_h + 30
+        bottom = (b + 1) * block_h - 40
+        left, right = 15, w - 15
+        ys = list(range(top, bottom, rnd.randint(35, 60))) + [bottom]
+        xs = sorted(rnd.sample(range(left + 40, right - 40), 4)) + [left, right]
+        for y in ys:
+            draw.line((left, y, right, y + slope), fill=0, width=rnd.choice([1, 2, 3]))
+        for x in xs:
+            draw.line((x, top, x + slope, bottom), fill=0, width=rnd.choice([1, 2]))
+        # Fake characters in the cells
+        for _ in range(80):
+            cx = rnd.randint(left, right - 12)
+            cy = rnd.randint(top, bottom - 12)
+            draw.rectangle((cx, cy, cx + rnd.randint(2, 10), cy + rnd.randint(2, 10)), fill=0)
+    # Speckles, including a few broken line fragments
+    for _ in range(300):
+        draw.point((rnd.randrange(w), rnd.randrange(h)), fill=0)
+    for _ in range(5):
+        y = rnd.randrange(h)
+        draw.line((rnd.randrange(w // 2), y, rnd.randrange(w // 2, w), y), fill=0)
+    return im
+
+
+def boxes(lines):
+    return [b.tup for b in lines]
+
+
+@pytest.mark.parametrize('seed,slope,blocks', [(1, 0, 1), (2, 4, 1), (3, 9, 2), (4, -6, 2), (5, 15, 1)])
+def test_lines_match_reference(seed, slope, blocks):
+    im = make_table(640, 480, seed, slope, blocks)
+    pix = im.load()
+    black = tableocr.load_bitmap(im)
+    w, h = im.size
+
+    ref_blocks = list(ref_get_vblocks(pix, w, h, 20))
+    new_blocks = list(tableocr.get_vblocks(black, 20))
+    assert boxes(new_blocks) == boxes(ref_blocks)
+
+    found = 0
+    for box in ref_blocks:
+        crop = im.crop(box.tup)
+        croppix = crop.load()
+        cropw, croph = crop.size
+        cropblack = black[box.y1:box.y2, box.x1:box.x2]
+        hthresh = int(cropw * tableocr.H_THRESH)
+        vthresh = int(croph * tableocr.V_THRESH)
+
+        ref_h = ref_get_hlines(croppix, cropw, croph, hthresh)
+        ref_v = ref_get_vlines(croppix, cropw, croph, vthresh)
+        assert boxes(tableocr.get_hlines(cropblack, hthresh)) == boxes(ref_h)
+        assert boxes(tableocr.get_vlines(cropblack, vthresh)) == boxes(ref_v)
+        found += len(ref_h) + len(ref_v)
+    # Make sure the images actually exercised the line finders.
+    assert found > 10
+
+
+def test_longest_runs():
+    black = tableocr.load_bitmap(Image.new('1', (10, 3), 255))
+    black[0, 2:5] = True
+    black[0, 6:10] = True
+    black[2, :] = True
+    assert tableocr._longest_runs(black).tolist() == [4, 0, 10]
+
+
+def test_parse_doc_ids():
+    assert tableocr.parse_doc_ids([]) == []
+    assert tableocr.parse_doc_ids(['5']) == [5]
+    assert tableocr.parse_doc_ids(['100-103', '7', '9-9']) == [100, 101, 102, 103, 7, 9]
+    assert tableocr.parse_doc_ids(['5-3']) == []
+    for bad in (['x'], ['1-2-3'], ['1-']):
+        with pytest.raises(ValueError):
+            tableocr.parse_doc_ids(bad)
+
+
+class FakeEngine():
+    """Gives back the queued answers in turn, remembering what it was asked"""
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = []
+
+    def ocr(self, region, psm=None):
+        self.calls.append((region.size, psm))
+        return self.answers.pop(0)
+
+
+def cell_image(black):
+    """One 60x30 cell with a black box of the given size in the middle"""
+    im = Image.new('L', (60, 30), 255)
+    bw, bh = black
+    if bw and bh:
+        ImageDraw.Draw(im).rectangle([30 - bw // 2, 15 - bh // 2, 30 + bw // 2 - 1, 15 + bh // 2 - 1],
+                                     fill=0)
+    return im, [[Box(0, 0, 60, 30)]]
+
+
+def test_get_ocr_engine(monkeypatch):
+    made = []
+    monkeypatch.setattr(tableocr, 'OCR_ENGINES', {name: lambda lang, name=name: made.append(name) or FakeEngine()
+                                                  for name in ('tesserocr', 'cli')})
+    monkeypatch.setattr(tableocr, 'tesserocr', None)
+    monkeypatch.setattr(tableocr, 'OCR_ENGINE', 'auto')
+    monkeypatch.setattr(tableocr, '_thread_engine', threading.local())
+    engine = tableocr.get_ocr_engine()
+    assert tableocr.get_ocr_engine() is engine
+    assert made == ['cli']
+
+    # One per thread
+    others = []
+    thread = threading.Thread(target=lambda: others.append(tableocr.get_ocr_engine()))
+    thread.start()
+    thread.join()
+    assert others[0] is not engine
+    assert made == ['cli', 'cli']
+
+    monkeypatch.setattr(tableocr, 'OCR_ENGINE', 'tesserocr')
+    monkeypatch.setattr(tableocr, '_thread_engine', threading.local())
+    tableocr.get_ocr_engine()
+    assert made[-1] == 'tesserocr'
+
+
+def test_ocr_cell(monkeypatch, tmp_path):
+    monkeypatch.setattr(tableocr, 'DEBUG', False)
+    engine = FakeEngine([u'1,000', u'円'])
+    monkeypatch.setattr(tableocr, 'get_ocr_engine', lambda: engine)
+    im, cells = cell_image((20, 10))
+    assert tableocr.ocr_cell(im, cells, 0, 0, str(tmp_path / 'page')) == u'1,000\n円'
+    assert engine.calls == [((60, 30), None)]
+
+    # Nothing there, so not worth asking
+    im, cells = cell_image((0, 0))
+    assert tableocr.ocr_cell(im, cells, 0, 0, str(tmp_path / 'page')) is None
+    assert len(engine.calls) == 1
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_ocr_cell_retries(monkeypatch, tmp_path):
+    monkeypatch.setattr(tableocr, 'DEBUG', True)
+    # Mostly black, so it might be noise: filtered, then tried as one word
+    engine = FakeEngine([], [], [u'123'])
+    monkeypatch.setattr(tableocr, 'get_ocr_engine', lambda: engine)
+    im, cells = cell_image((40, 20))
+    pngfname = str(tmp_path / 'page')
+    assert tableocr.ocr_cell(im, cells, 0, 0, pngfname) == u'123'
+    assert [psm for size, psm in engine.calls] == [None, None, tableocr.PSM_SINGLE_WORD]
+
+    # Debug files are named from the cell, with the page name only once
+    assert sorted(os.listdir(str(tmp_path))) == \
+        sorted('page-0-0' + x for x in ('-preerode.tif', '.tif', '.txt', '.tif-filtered.tif',
+                                         '.txt-filtered.txt', '.txt-psm8.txt'))
+    with open(pngfname + '-0-0.txt-psm8.txt', 'rb') as f:
+        assert f.read() == b'123'
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the group pager api (/api/summary/group).
+
+Fills a scratch database with lots of groups and documents, then pages through
+the group list the way the frontend does, reporting the number of sql queries
+and the time taken per page.  The pager as it was before, with its queries per
+row, is run as well for comparison.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+import datetime
+from argparse import ArgumentParser
+
+
+def make_db(dbfile, ngroups, docs_per_group):
+    cfg = dbfile + '.cfg'
+    with open(cfg, 'w') as f:
+        f.write("SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n" % dbfile)
+    os.environ['SHIKIN_SETTINGS'] = cfg
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import shikin
+    from shikin import model
+
+    db = shikin.app.dbobj
+    db.create_all()
+    session = db.session
+
+    rnd = random.Random(1)
+    types = [model.GroupType(u'type%d' % i) for i in range(10)]
+    session.add_all(types)
+    session.add(model.DocType(u'doctype'))
+    session.add(model.PubType(u'pubtype'))
+    session.flush()
+    session.add(model.DocSet(published=datetime.date(2015, 1, 1), pubtype_id=1, doctype_id=1, path='/x'))
+    session.flush()
+
+    logging.info('Making %d groups..' % ngroups)
+    session.execute(model.Group.__table__.insert(),
+                    [{'id': i, 'name': u'group %06d' % i, 'type_id': rnd.randint(1, 10),
+                      'parent_id': rnd.randint(1, 100) if i > 100 else None}
+                     for i in range(1, ngroups + 1)])
+    logging.info('Making %d documents..' % (ngroups * docs_per_group))
+    docs = []
+    for i in range(ngroups * docs_per_group):
+        docs.append({'docset_id': 1, 'year': rnd.randint(2008, 2015), 'group_id': rnd.randint(1, ngroups),
+                     'path': 'f%d.pdf' % i, 'pages': 3, 'size': 1000, 'url': 'u%d' % i, 'srcurl': 's'})
+        if len(docs) >= 50000:
+            session.execute(model.Document.__table__.insert(), docs)
+            docs = []
+    if docs:
+        session.execute(model.Document.__table__.insert(), docs)
+    session.commit()
+    return shikin
+
+
+def legacy_group_pager(parentid=None):
+    """The group pager as it was, one query per group per column"""
+    from flask import request, jsonify
+    from sqlalchemy import func
+    from shikin.model import Group, Document, GroupType
+    from shikin.pageapi import _group_order_funcs
+
+    args = request.args
+    count = int(args.get('length') or '10')
+    start = int(args.get('start') or '0')
+
+    allgroupquery = Group.query
+    if parentid is not None:
+        allgroupquery = allgroupquery.filter(Group.parent_id == parentid)
+    allgroupcount = allgroupquery.count()
+
+    q = Group.query.join(Document).join(GroupType).add_columns(func.count(Document.id)).group_by(Group.id)
+    if parentid is not None:
+        q = q.filter(Group.parent_id == parentid)
+    for i in range(100):
+        odir_s = 'order[%d][dir]' % i
+        ocol_s = 'order[%d][column]' % i
+        if not (odir_s in args and ocol_s in args):
+            break
+        cname = args['columns[%d][data]' % int(args[ocol_s])]
+        q = q.order_by(_group_order_funcs[cname](args[odir_s] == 'desc'))
+    sval = args.get('search[value]')
+    if sval:
+        q = q.filter(Group.name.like('%'+sval+'%'))
+
+    data = list([{'id': x.id, 'name': x.name, 'typename': x.type.name,
+                  'doccount': c, 'minyear': x.minyear,
+                  'maxyear': x.maxyear} for x, c in q.offset(start).limit(count).all()])
+    return jsonify({'draw': args.get('draw'), 'recordsTotal': allgroupcount,
+                    'recordsFiltered': q.count(), 'data': data})
+
+
+def main():
+    p = ArgumentParser(description='Benchmark the group pager api')
+    p.add_argument('--groups', '-g', type=int, default=100000, help='number of groups (default 100000)')
+    p.add_argument('--docs', '-d', type=int, default=3, help='documents per group (default 3)')
+    p.add_argument('--length', '-l', type=int, default=100, help='rows per page (default 100)')
+    p.add_argument('--pages', '-p', type=int, default=5, help='pages to fetch per case (default 5)')
+    p.add_argument('--db', help='database file to use (default: a temp file)')
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.db:
+        dbfile = os.path.abspath(args.db)
+    else:
+        fd, dbfile = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(dbfile)
+
+    start = time.time()
+    shikin = make_db(dbfile, args.groups, args.docs)
+    logging.info('Made db in %.1fs' % (time.time() - start))
+
+    from sqlalchemy import event
+    from shikin import pageapi
+
+    queries = [0]
+
+    def count_query(*a):
+        queries[0] += 1
+    event.listen(shikin.app.dbobj.engine, 'before_cursor_execute', count_query)
+
+    # Rows which tie on the sort column can come back in any order, so only
+    # compare whole rows when sorting by name.
+    def rows(results):
+        return [(r['recordsFiltered'], r['data']) for r in results]
+
+    def column(key):
+        return lambda results: [(r['recordsFiltered'], [x[key] for x in r['data']]) for r in results]
+
+    cases = [
+        ('name', {'order[0][column]': '0', 'order[0][dir]': 'asc'}, rows),
+        ('typename', {'order[0][column]': '1', 'order[0][dir]': 'asc'}, column('typename')),
+        ('doccount desc', {'order[0][column]': '2', 'order[0][dir]': 'desc'}, column('doccount')),
+        ('search', {'order[0][column]': '0', 'order[0][dir]': 'asc', 'search[value]': '12'}, rows),
+    ]
+    columns = {'columns[0][data]': 'name', 'columns[1][data]': 'typename', 'columns[2][data]': 'doccount'}
+
+    print('%-16s %-8s %10s %10s' % ('case', 'pager', 'queries', 'ms/page'))
+    for name, order, compare in cases:
+        for pname, pager in (('new', pageapi.group_pager), ('legacy', legacy_group_pager)):
+            queries[0] = 0
+            elapsed = 0
+            results = []
+            for page in range(args.pages):
+                qs = dict(columns, start=str(page * args.length), length=str(args.length), **order)
+                with shikin.app.test_request_context('/api/summary/group', query_string=qs):
+                    shikin.app.dbobj.session.remove()
+                    t0 = time.time()
+                    results.append(pager().get_json())
+                    elapsed += time.time() - t0
+            if pname == 'new':
+                expected = results
+            elif compare(results) != compare(expected):
+                print('  !! results differ from the new pager')
+            print('%-16s %-8s %10.1f %10.1f' % (name, pname, queries[0] / float(args.pages),
+                                              elapsed * 1000 / args.pages))
+
+    if not args.db:
+        os.unlink(dbfile)
+        os.unlink(dbfile + '.cfg')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
 import json
 import re
 import logging
 import requests
-import subprocess
-from datetime import date
+from multiprocessing import cpu_count
+from datetime import date, datetime
 from argparse import ArgumentParser
 
-from toollib import metautil, DATE_RE, YEAR_RE, year_to_western
+from toollib import metautil, pdfprobe, DATE_RE, YEAR_RE, year_to_western
 
 # Note the full-width brackets and slash.
 MULTIPART_RE = re.compile(u'^(.*)(（.*／.*）.*|（その.*）)')
@@ -41,13 +42,156 @@ def makefilter(field, val, op='=='):
     return fparams
 
 
-def _get_all(s, api_root, otype):
-    LIST_ALL_PARAM = {'results_per_page': '50000'}
-    objs = s.get(api_root + otype, params=LIST_ALL_PARAM, verify=False).json()
-
-    # FIXME: This may break eventually..
-    assert objs['total_pages'] <= 1
-    return objs['objects']
+class ApiBackend():
+    """Import through the raw REST api of a running site."""
+    def __init__(self, api_root):
+        self.api_root = api_root
+        self.session = requests.session()
+        self.session.headers['Content-Type'] = 'application/json'
+
+    def iter_all(self, otype, columns=None):
+        """Stream all the objects of a type from the export, one at a time"""
+        params = {'columns': ','.join(columns)} if columns else {}
+        export_root = self.api_root.rstrip('/').rsplit('/', 1)[0] + '/export/'
+        result = self.session.get(export_root + otype, params=params, verify=False, stream=True)
+        result.raise_for_status()
+        for line in result.iter_lines():
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+    def get_all(self, otype):
+        return list(self.iter_all(otype))
+
+    def get_doc_sources(self):
+        """Map of url: srcurl for all the documents already imported"""
+        return {x['url']: x['srcurl'] for x in self.iter_all('document', ['url', 'srcurl'])}
+
+    def add(self, otype, obj):
+        result = self.session.post(self.api_root + otype, data=json.dumps(obj), verify=False).json()
+        if 'id' not in result:
+            raise ValueError('%s add: got back %s' % (otype, result))
+        return result
+
+    def update(self, otype, objid, changes):
+        return self.session.patch(self.api_root + '%s/%d' % (otype, objid),
+                                  data=json.dumps(changes)).json()
+
+    def add_page_rots(self, document, rots):
+        """Record the rotation of each page of a document just added"""
+        return self.add('doc_rotation', {'doc_id': document['id'], 'rots': pdfprobe.pack_rots(rots)})
+
+    def finish(self):
+        pass
+
+
+class DbBackend():
+    """
+    Import straight into the database using the site's models.  Much faster
+    than the api for big imports, but has to run where it can open the db.
+
+    Objects come in and go out in the same form as for the api.  Documents are
+    not needed again once made, so they are saved in batches.
+    """
+    BATCH_SIZE = 5000
+
+    def __init__(self, db_uri=None):
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        import shikin
+        from shikin import model
+
+        if db_uri:
+            shikin.app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+            # The session binds to an engine when it's made, so start afresh
+            shikin.app.dbobj.session.remove()
+        self.session = shikin.app.dbobj.session
+        self.tables = {
+            'group_type': model.GroupType,
+            'doc_type': model.DocType,
+            'pub_type': model.PubType,
+            'group': model.Group,
+            'doc_set': model.DocSet,
+            'document': model.Document,
+            'doc_rotation': model.DocRotation,
+        }
+        self.new_docs = []
+        # Page rotations of new documents, by url until they have ids
+        self.new_rots = {}
+
+    @staticmethod
+    def _columns(table):
+        return [(p.key, p.columns[0].type) for p in table.__mapper__.column_attrs]
+
+    def _to_json(self, table, values):
+        obj = {}
+        for (key, ctype), val in zip(self._columns(table), values):
+            if isinstance(val, date):
+                val = val.isoformat()
+            obj[key] = val
+        return obj
+
+    def _from_json(self, table, obj):
+        from sqlalchemy import Date
+        values = dict(obj)
+        for key, ctype in self._columns(table):
+            if isinstance(ctype, Date) and isinstance(values.get(key), str):
+                values[key] = datetime.strptime(values[key][:10], '%Y-%m-%d').date()
+        return values
+
+    def get_all(self, otype):
+        table = self.tables[otype]
+        q = self.session.query(*[getattr(table, k) for k, _ in self._columns(table)])
+        return [self._to_json(table, x) for x in q]
+
+    def get_doc_sources(self):
+        Document = self.tables['document']
+        q = self.session.query(Document.url, Document.srcurl)\
+                        .execution_options(stream_results=True)\
+                        .yield_per(10000)
+        return dict(q)
+
+    def add(self, otype, obj):
+        table = self.tables[otype]
+        values = self._from_json(table, obj)
+        if otype == 'document':
+            self.new_docs.append(values)
+            if len(self.new_docs) >= self.BATCH_SIZE:
+                self._save_docs()
+            return obj
+        new = table()
+        for k, v in values.items():
+            setattr(new, k, v)
+        self.session.add(new)
+        self.session.flush()
+        return self._to_json(table, [getattr(new, k) for k, _ in self._columns(table)])
+
+    def update(self, otype, objid, changes):
+        table = self.tables[otype]
+        self.session.query(table).filter(table.id == objid).update(self._from_json(table, changes))
+        result = dict(changes)
+        result['id'] = objid
+        return result
+
+    def add_page_rots(self, document, rots):
+        self.new_rots[document['url']] = rots
+
+    def _save_docs(self):
+        if self.new_docs:
+            logging.debug("saving %d documents" % len(self.new_docs))
+            self.session.bulk_insert_mappings(self.tables['document'], self.new_docs)
+            self.new_docs = []
+        if self.new_rots:
+            Document = self.tables['document']
+            urls = list(self.new_rots)
+            rows = []
+            for i in range(0, len(urls), 500):
+                q = self.session.query(Document.id, Document.url).filter(Document.url.in_(urls[i:i + 500]))
+                rows.extend({'doc_id': docid, 'rots': pdfprobe.pack_rots(self.new_rots[url])} for docid, url in q)
+            self.session.bulk_insert_mappings(self.tables['doc_rotation'], rows)
+            self.new_rots = {}
+        self.session.commit()
+
+    def finish(self):
+        self._save_docs()
 
 
 _group_cache = {}
@@ -57,10 +201,15 @@ _doctype_cache = {}
 _pubtype_cache = {}
 
 
-def get_existing_types(s, api_root):
-    grouptype = _get_all(s, api_root, 'group_type')
-    doctype = _get_all(s, api_root, 'doc_type')
-    pubtype = _get_all(s, api_root, 'pub_type')
+def reset_caches():
+    for cache in (_group_cache, _docset_cache, _grouptype_cache, _doctype_cache, _pubtype_cache):
+        cache.clear()
+
+
+def get_existing_types(backend):
+    grouptype = backend.get_all('group_type')
+    doctype = backend.get_all('doc_type')
+    pubtype = backend.get_all('pub_type')
 
     for r in (grouptype, doctype, pubtype):
         assert len(r) > 0
@@ -71,24 +220,22 @@ def get_existing_types(s, api_root):
     _pubtype_cache.update({x['name']: x['id'] for x in pubtype})
 
 
-def fill_caches(s, api_root, groups=True, docsets=True):
+def fill_caches(backend, groups=True, docsets=True):
     if groups:
-        groups = _get_all(s, api_root, 'group')
+        groups = backend.get_all('group')
         for g in groups:
             _group_cache[g['name']] = g
     if docsets:
-        docsets = _get_all(s, api_root, 'doc_set')
+        docsets = backend.get_all('doc_set')
         for d in docsets:
             assert d['pubtype_id'] in _pubtype_cache.values()
             assert d['doctype_id'] in _doctype_cache.values()
-            _docset_cache[(d['published'], d['pubtype_id'], d['doctype_id'])] = d
-
-
-def get_existing_docs(s, api_root):
-    return _get_all(s, api_root, 'document')
+            # Key by date, as get_or_make_docset does
+            published = datetime.strptime(d['published'][:10], '%Y-%m-%d').date()
+            _docset_cache[(published, d['pubtype_id'], d['doctype_id'])] = d
 
 
-def get_or_make_group(s, api_root, name, gtype, parent):
+def get_or_make_group(backend, name, gtype, parent):
     if parent == name:
         # don't make circular links, it makes me sad.
         parent = None
@@ -106,8 +253,7 @@ def get_or_make_group(s, api_root, name, gtype, parent):
                 # update name of parent
                 parentid = _group_cache[parent]['id']
                 cached_group['parent_id'] = parentid
-                result = s.patch(api_root + 'group/%d' % cached_group['id'],
-                                 data=json.dumps({'parent_id': parentid})).json()
+                result = backend.update('group', cached_group['id'], {'parent_id': parentid})
                 assert result['parent_id']
                 return cached_group
             else:
@@ -136,14 +282,12 @@ def get_or_make_group(s, api_root, name, gtype, parent):
         return
 
     obj = {'name': name, 'type_id': _grouptype_cache[gtype], 'parent_id': parent_id}
-    result = s.post(api_root + 'group', data=json.dumps(obj), verify=False).json()
-    if 'id' not in result:
-        raise ValueError('Group add: got back %s' % result)
+    result = backend.add('group', obj)
     _group_cache[name] = result
     return result
 
 
-def get_or_make_docset(s, api_root, title, docset_type, docdir):
+def get_or_make_docset(backend, title, docset_type, docdir):
     docset_date = title_date(title)
 
     if docset_date is None:
@@ -180,31 +324,24 @@ def get_or_make_docset(s, api_root, title, docset_type, docdir):
         return _docset_cache[key]
 
     obj = {'published': str(docset_date), 'pubtype_id': docset_pubtype, 'doctype_id': docset_type, 'path': docdir}
-    result = s.post(api_root + 'doc_set', data=json.dumps(obj), verify=False).json()
-    if 'id' not in result:
-        raise ValueError('Docset add: got back %s' % result)
+    result = backend.add('doc_set', obj)
     _docset_cache[key] = result
 
     return result
 
 
-def make_doc(s, api_root, docsetid, year, groupid, docfname, url, srcurl, fsize, pagecount, note):
+def make_doc(backend, docsetid, year, groupid, docfname, url, srcurl, fsize, pagecount, note):
     m = YEAR_RE.match(year)
     if not m:
         raise ValueError("Year %s in metadata for %s doesn't look like a year." % (year, docfname))
     year = year_to_western(*m.groups())
     obj = {'docset_id': docsetid, 'year': year, 'group_id': groupid, 'filename': docfname,
            'url': url, 'srcurl': srcurl, 'size': fsize, 'pages': pagecount, 'note': note}
-    result = s.post(api_root + 'document', data=json.dumps(obj), verify=False).json()
-    if 'id' not in result:
-        raise ValueError('Document add: got back %s' % result)
-
-    return result
+    return backend.add('document', obj)
 
 
-def check_pdf(s, pdf_path, pdf_root, api_root, docs_by_url, nodefer, groupsonly):
+def check_pdf(backend, pdf_path, meta, pdf_root, docs_by_url, nodefer, groupsonly, pdf_info=None):
     relative_path = pdf_path[len(pdf_root):]
-    meta = metautil.get_meta(pdf_path)
 
     if meta is None:
         logging.warning("Skip %s which has no metadata!" % relative_path)
@@ -217,12 +354,14 @@ def check_pdf(s, pdf_path, pdf_root, api_root, docs_by_url, nodefer, groupsonly)
     url = meta['url']
     if url in docs_by_url:
         # Verify the contents.. should be the same source
-        record = docs_by_url[url]
-        if record['srcurl'] != meta['srcurl']:
+        srcurl = docs_by_url[url]
+        if srcurl != meta['srcurl']:
             logging.warning('Difference sources for %s at %s and in db: %s vs %s'
-                         % (url, relative_path, record['srcurl'], meta['srcurl']))
+                         % (url, relative_path, srcurl, meta['srcurl']))
         return
     else:
+        # The same metadata is checked again in later passes, so leave it be
+        meta = dict(meta)
         gname = meta['srctitle']
 
         note = None
@@ -273,14 +412,14 @@ def check_pdf(s, pdf_path, pdf_root, api_root, docs_by_url, nodefer, groupsonly)
             if len(parent) <= 1:
                 parent = None
 
-        group = get_or_make_group(s, api_root, gname, gtype, parent)
+        group = get_or_make_group(backend, gname, gtype, parent)
         if group is None:
             logging.debug('skipping %s because group is not clear' % pdf_path)
             # Something went wrong.. unknown type?
             return
 
         docdir, docfname = os.path.split(relative_path)
-        docset = get_or_make_docset(s, api_root, title, meta['docsettype'], docdir)
+        docset = get_or_make_docset(backend, title, meta['docsettype'], docdir)
 
         if groupsonly:
             return
@@ -289,22 +428,88 @@ def check_pdf(s, pdf_path, pdf_root, api_root, docs_by_url, nodefer, groupsonly)
             logging.debug('skipping %s because docset is not clear' % pdf_path)
             return
 
-        # Collect pdf stats - size and pages
-        fsize = os.stat(pdf_path).st_size
-        pagesre = re.compile('Pages:\s+(\d+)')
-        p1 = subprocess.Popen(['pdfinfo', pdf_path], stdout=subprocess.PIPE)
-        (stdoutdata, stderrdata) = p1.communicate()
-        pagecount = 0
-        m = pagesre.search(str(stdoutdata))
-        if not m:
-            import pdb; pdb.set_trace()
+        # Collect pdf stats - size, pages and their rotations
+        if pdf_info is not None and pdf_path in pdf_info:
+            fsize, pagecount, rots = pdf_info[pdf_path]
         else:
-            pagecount = int(m.groups()[0])
+            fsize = os.stat(pdf_path).st_size
+            pagecount, rots = pdfprobe.probe_pdf(pdf_path)
+        if pagecount is None:
+            logging.error('skipping %s because pdfinfo could not read it' % pdf_path)
+            return
 
         # finally.. make the doc.
-        document = make_doc(s, api_root, docset['id'], meta['year'],
+        document = make_doc(backend, docset['id'], meta['year'],
                             group['id'], docfname, meta['url'], meta['srcurl'],
                             fsize, pagecount, note)
+        backend.add_page_rots(document, rots)
+        docs_by_url[url] = meta['srcurl']
+
+
+# The passes of a full import, as (nodefer, groupsonly).  Groups first so
+# parents can be filled in, then documents whose group type is known, then
+# everything left over with unknown groups.
+IMPORT_PASSES = [(False, True), (False, False), (True, False)]
+
+
+def read_pdf_tree(pdf_root):
+    """List of (path, metadata) for all the pdfs under pdf_root"""
+    records = []
+    for root, dirs, files in os.walk(pdf_root):
+        for f in sorted(files):
+            if f.endswith('.pdf'):
+                pdf_file = os.path.join(root, f)
+                records.append((pdf_file, metautil.get_meta(pdf_file)))
+    return records
+
+
+def run_import(backend, pdf_root, passes, jobs=None, probe_cache=True):
+    """
+    Import everything under pdf_root, making one or more passes over the
+    metadata.  Metadata and the existing db contents are only read once, and
+    the caches are kept up to date between passes, so running all of
+    IMPORT_PASSES here does the same as running the tool once for each.
+    """
+    get_existing_types(backend)
+    logging.info('%d group types, %d doc types, %d pub types.' %
+                 (len(_grouptype_cache), len(_doctype_cache), len(_pubtype_cache)))
+
+    fill_caches(backend)
+    logging.info('%d groups, %d docsets.' %
+                 (len(_group_cache), len(_docset_cache)))
+
+    # Note: currently we don't have a huge number of docs, so just pulling all
+    # the data works fine.  If this gets too slow we could pull each docset and
+    # just get the count of documents in it, and compare that to the metadata
+    # on-disk.  Then we could also add a --recheck option or something.
+    logging.info("Getting all docs in db...")
+    docs_by_url = backend.get_doc_sources()
+
+    logging.info("Reading metadata for pdfs...")
+    records = read_pdf_tree(pdf_root)
+
+    pdf_info = None
+    if not all(groupsonly for (nodefer, groupsonly) in passes):
+        # Only new docs need sizes and page counts
+        to_probe = [pdf_file for (pdf_file, meta) in records
+                    if meta is not None and meta.get('url') not in docs_by_url]
+        logging.info("Probing %d new pdfs..." % len(to_probe))
+        cache = pdfprobe.ProbeCache(pdf_root) if probe_cache else None
+        pdf_info = pdfprobe.probe_pdfs(to_probe, cache, jobs)
+        if cache:
+            cache.close()
+
+    for (nodefer, groupsonly) in passes:
+        logging.info("Checking pdfs (nodefer %s, groupsonly %s)..." % (nodefer, groupsonly))
+        checked = 0
+        for (pdf_file, meta) in records:
+            check_pdf(backend, pdf_file, meta, pdf_root, docs_by_url, nodefer, groupsonly, pdf_info)
+            checked += 1
+            if (checked % 1000) == 0:
+                logging.info(".. %d pdfs checked." % checked)
+
+    backend.finish()
+    logging.info("FINISHED. %d pdfs checked." % len(records))
 
 
 def main():
@@ -317,10 +522,20 @@ def main():
     p.add_argument('--api-url',
                    help='Root URL of api (default: http://localhost:5000/api/raw)',
                    default='http://127.0.0.1:5000/api/raw')
+    p.add_argument('--direct', '-D', action='store_true',
+                   help='Write straight to the database instead of using the api')
+    p.add_argument('--db-uri',
+                   help='Database to use with --direct (default: as configured for the site)')
     p.add_argument('--nodefer', '-n', action='store_true',
                    help='Do not defer unknown group parents and types - record as unknown')
     p.add_argument('--groupsonly', '-g', action='store_true',
                    help='Only make groups, no doc records')
+    p.add_argument('--all', '-a', action='store_true',
+                   help='Do all the passes of a full import (-g, default, then -n) in one run')
+    p.add_argument('--jobs', '-j', type=int, default=cpu_count(),
+                   help='Number of pdfs to probe at once (default: number of cpus)')
+    p.add_argument('--no-probe-cache', action='store_true',
+                   help='Ignore the cache of pdf page counts kept in the pdf root')
     p.add_argument('--verbose', '-v', help='be more verbose',
                    action='store_true')
     p.add_argument('--quiet', '-q', help='be more quiet', action='store_true')
@@ -335,43 +550,20 @@ def main():
     if not os.path.isdir(args.pdf_root):
         p.error('pdf root is not a directory.')
 
-    s = requests.session()
-    s.headers['Content-Type'] = 'application/json'
-
-    apiroot = args.api_url
-    if not apiroot.endswith('/'):
-        apiroot += '/'
-
-    get_existing_types(s, apiroot)
-    logging.info('%d group types, %d doc types, %d pub types.' %
-                 (len(_grouptype_cache), len(_doctype_cache), len(_pubtype_cache)))
-
-    fill_caches(s, apiroot)
-    logging.info('%d groups, %d docsets.' %
-                 (len(_group_cache), len(_docset_cache)))
+    if args.direct:
+        backend = DbBackend(args.db_uri)
+    else:
+        apiroot = args.api_url
+        if not apiroot.endswith('/'):
+            apiroot += '/'
+        backend = ApiBackend(apiroot)
 
-    # Note: currently we don't have a huge number of docs, so just pulling all
-    # the data works fine.  If this gets too slow we could pull each docset and
-    # just get the count of documents in it, and compare that to the metadata
-    # on-disk.  Then we could also add a --recheck option or something.
-    logging.info("Getting all docs in db...")
-    docs = get_existing_docs(s, apiroot)
-    docs_by_url = {x['url']: x for x in docs}
-
-    logging.info("Collecting metadata for pdfs...")
-    checked = 0
-    for root, dirs, files in os.walk(args.pdf_root):
-        pdf_files = filter(lambda x: x.endswith('.pdf'), files)
-        if not pdf_files:
-            continue
-        for f in pdf_files:
-            pdf_file = os.path.join(root, f)
-            check_pdf(s, pdf_file, args.pdf_root, apiroot, docs_by_url, args.nodefer, args.groupsonly)
-            checked += 1
-            if (checked % 1000) == 0:
-                logging.info(".. %d pdfs checked." % checked)
+    if args.all:
+        passes = IMPORT_PASSES
+    else:
+        passes = [(args.nodefer, args.groupsonly)]
 
-    logging.info("FINISHED. %d pdfs checked." % checked)
+    run_import(backend, args.pdf_root, passes, args.jobs, not args.no_probe_cache)
 
 
 if __name__ == '__main__':
@@ -1,47 +1,282 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+Make thumbnails of the first page of each pdf, in the sizes and formats of
+shikin.pdf.thumbnails.
+
+Making thumbnails is in two stages: rendering them, which is quick, and
+running optipng on the PNGs, which is slow.  With --jobs the pdfs are rendered on a
+pool of processes, and each thumbnail is usable as soon as it is rendered.
+optipng runs on a second pool at low priority, and replaces each thumbnail
+with its smaller version as it finishes.
+
+What has been made is kept in a manifest (see shikin.pdf.manifest), so a run
+only renders pdfs which are new or changed, or were done with other settings,
+and only optimises PNGs which haven't been.
+"""
 import os
 import sys
+import time
 import logging
+import threading
 from argparse import ArgumentParser
+from multiprocessing import cpu_count, Pool
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
-from shikin.pdf import pdfimages
+from PIL import Image
+
+from shikin import app
+from shikin.pdf import pdfimages, thumbnails, manifest
+
+# Seconds between progress reports
+REPORT_INTERVAL = 10
 
 
-def check_pdf(pdfdir, pdffile, pdf_root, thumbnail_root, force_regen, optimise):
+def thumbnail_path(pdfdir, pdffile, pdf_root, thumbnail_root):
     assert pdfdir.startswith(pdf_root)
 
     pdf_relative = pdfdir[len(pdf_root)+1:]
     thumbnailname = pdffile + '_thumb.png'
-    thumbnaildir = os.path.join(thumbnail_root, pdf_relative)
-    thumbnailpath = os.path.join(thumbnaildir, thumbnailname)
+    return os.path.join(thumbnail_root, pdf_relative, thumbnailname)
 
-    if (not force_regen) and os.path.exists(thumbnailpath):
-        return
 
+def first_page_image(pdf_fullpath, tmppath):
+    """The first page of a pdf as a PIL image, or None"""
+    if 'main_content' in pdf_fullpath:
+        # these have text content that needs rendering
+        logging.debug("%s (render)" % pdf_fullpath)
+        pdfimages.render_page(pdf_fullpath, 1, tmppath, optimise=False)
+        if not os.path.exists(tmppath) or not os.path.getsize(tmppath):
+            return None
+        img = Image.open(tmppath)
+        img.load()
+        return img
+    # these are just images in a file
+    for pageno, img in pdfimages.pdf_images(pdf_fullpath, firstpage=1, lastpage=1):
+        return img
+    return None
+
+
+def thumbnail_pngs(thumbnailpath):
+    return [path for width, fmt, path in thumbnails.thumbnail_names(thumbnails.thumbnail_base(thumbnailpath))
+            if fmt == 'png']
+
+
+def render_thumbnail(job):
+    """
+    Render the thumbnails for a (pdf_fullpath, thumbnailpath, key) job,
+    without optimising them.  Returns (key, made), where made is (size,
+    mtime, sha1, pngs) of the pdf and the PNGs made, or None if nothing was.
+    """
+    (pdf_fullpath, thumbnailpath, key) = job
+    thumbnaildir = os.path.dirname(thumbnailpath)
     if not os.path.exists(thumbnaildir):
         logging.debug("Make dir %s" % thumbnaildir)
-        os.makedirs(thumbnaildir)
+        os.makedirs(thumbnaildir, exist_ok=True)
 
-    pdf_fullpath = os.path.join(pdfdir, pdffile)
+    tmppath = '%s.%d.tmp.png' % (thumbnailpath, os.getpid())
+    try:
+        # Before rendering, so a pdf changed meanwhile is done again next time
+        st = os.stat(pdf_fullpath)
+        sha1 = manifest.file_sha1(pdf_fullpath)
+        img = first_page_image(pdf_fullpath, tmppath)
+        if img is None:
+            logging.warning("No thumbnail made for %s" % pdf_fullpath)
+            return key, None
+        logging.debug("%s -> %s" % (pdf_fullpath, thumbnailpath))
+        written = thumbnails.write_thumbnails(img, thumbnails.thumbnail_base(thumbnailpath))
+    except Exception:
+        logging.exception("Making thumbnail for %s" % pdf_fullpath)
+        return key, None
+    finally:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+    return key, (st.st_size, int(st.st_mtime), sha1, [x for x in written if x.endswith('.png')])
 
-    if 'main_content' in pdf_fullpath:
-        # these have text content that needs rendering
-        logging.debug("%s -> %s (render)" % (pdf_fullpath, thumbnailpath))
-        pdfimages.render_page(pdf_fullpath, 1, thumbnailpath)
-    else:
-        # these are just images in a file
-        for pngpath in pdfimages.extract_images(pdf_fullpath, firstpage=1, lastpage=1):
-            logging.debug("%s -> %s" % (pngpath, thumbnailpath))
-            os.rename(pngpath, thumbnailpath)
+
+def optimise_thumbnail(task):
+    """Run optipng on a (key, png) task"""
+    (key, thumbnailpath) = task
+    try:
+        pdfimages.optimise_png(thumbnailpath)
+    except Exception:
+        logging.exception("Optimising %s" % thumbnailpath)
+    return task
+
+
+def _low_priority():
+    """Start an optipng worker, which should only get cpu nothing else wants"""
+    os.nice(19)
+
+
+def find_pdfs(pdf_root, thumbnail_root, patterns, force_regen, thumbs, optimise, adopt=False):
+    """
+    Find the pdfs whose thumbnails need making or optimising, according to
+    the manifest thumbs.  Returns a list of (pdf_fullpath, thumbnailpath, key)
+    render jobs and a list of (key, pngs) of those only needing optipng.
+    Keys are the pdfs' paths under pdf_root.  With adopt, pdfs not in the
+    manifest whose thumbnails are all there already are recorded as they are.
+    """
+    jobs = []
+    to_optimise = []
+    fresh = 0
+    adopted = 0
+    for root, dirs, files in os.walk(pdf_root):
+        pdf_files = [x for x in files if x.endswith('.pdf')]
+        if patterns:
+            matches = set()
+            for p in patterns:
+                if p in root:
+                    # directory match.. put them all in
+                    matches = pdf_files
+                    break
+                matches.update(x for x in pdf_files if p in x)
+            pdf_files = sorted(matches)
+        for f in pdf_files:
+            pdf_fullpath = os.path.join(root, f)
+            thumbnailpath = thumbnail_path(root, f, pdf_root, thumbnail_root)
+            key = os.path.relpath(pdf_fullpath, pdf_root)
+            st = os.stat(pdf_fullpath)
+            status = manifest.RENDER if force_regen else \
+                thumbs.status(key, pdf_fullpath, st.st_size, int(st.st_mtime), optimise)
+            if status == manifest.RENDER and adopt and not force_regen and thumbs.get(key) is None:
+                names = thumbnails.thumbnail_names(thumbnails.thumbnail_base(thumbnailpath))
+                if all(os.path.exists(path) for width, fmt, path in names):
+                    # Assume they were made like this run makes them
+                    thumbs.record(key, st.st_size, int(st.st_mtime), manifest.file_sha1(pdf_fullpath), optimise)
+                    adopted += 1
+                    continue
+            if status == manifest.RENDER:
+                jobs.append((pdf_fullpath, thumbnailpath, key))
+            elif status == manifest.OPTIMISE:
+                to_optimise.append((key, thumbnail_pngs(thumbnailpath)))
+            else:
+                fresh += 1
+    logging.info("%d pdfs to render, %d to optimise, %d up to date%s." %
+                 (len(jobs), len(to_optimise), fresh, ', %d adopted' % adopted if adopt else ''))
+    return jobs, to_optimise
+
+
+class Progress():
+    """
+    Counts of thumbnails through each stage, logged every so often, and the
+    manifest kept up to date as each pdf's are made and optimised.
+    """
+    def __init__(self, total, optimise, thumbs):
+        self.total = total
+        self.optimise = optimise
+        self.thumbs = thumbs
+        # PNGs of each pdf still to optimise
+        self.waiting = {}
+        self.rendered = 0
+        self.failed = 0
+        # PNGs to optimise, and done
+        self.queued = 0
+        self.optimised = 0
+        self.start = time.time()
+        self.render_end = None
+        self.reported = self.start
+        # Optimised thumbnails are counted from the pool's result thread
+        self.lock = threading.Lock()
+
+    def render_done(self, key, made):
+        """Count and record a render_thumbnail result.  Returns the (key, png) optimise tasks for it."""
+        with self.lock:
+            if made is None:
+                self.failed += 1
+            else:
+                self.rendered += 1
+            if self.rendered + self.failed == self.total:
+                self.render_end = time.time()
+        if made is None:
+            self.thumbs.forget(key)
+            self.report()
+            return []
+        size, mtime, sha1, pngs = made
+        self.thumbs.record(key, size, mtime, sha1, optimised=self.optimise and not pngs)
+        self.report()
+        return self.optimise_tasks(key, pngs)
+
+    def optimise_tasks(self, key, pngs):
+        """(key, png) tasks for optimising the PNGs of a pdf, none if not optimising"""
+        if not self.optimise or not pngs:
+            return []
+        with self.lock:
+            self.queued += len(pngs)
+            self.waiting[key] = len(pngs)
+        return [(key, png) for png in pngs]
+
+    def optimise_done(self, task):
+        key, path = task
+        with self.lock:
+            self.optimised += 1
+            self.waiting[key] -= 1
+            finished = not self.waiting[key]
+            if finished:
+                del self.waiting[key]
+        if finished:
+            self.thumbs.set_optimised(key)
+        self.report()
+
+    def report(self, force=False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.reported < REPORT_INTERVAL:
+                return
+            self.reported = now
+        render_time = (self.render_end or now) - self.start
+        msg = ".. %d/%d rendered (%d failed), %.2f pdfs/sec" % \
+            (self.rendered, self.total, self.failed, (self.rendered + self.failed) / max(render_time, 0.001))
+        if self.optimise:
+            msg += "; %d/%d pngs optimised, %.2f/sec" % \
+                (self.optimised, self.queued, self.optimised / max(now - self.start, 0.001))
+        logging.info(msg)
+
+
+def run_serial(jobs, to_optimise, progress):
+    for key, pngs in to_optimise:
+        for task in progress.optimise_tasks(key, pngs):
+            progress.optimise_done(optimise_thumbnail(task))
+    for job in jobs:
+        for task in progress.render_done(*render_thumbnail(job)):
+            progress.optimise_done(optimise_thumbnail(task))
+
+
+def run_parallel(jobs, to_optimise, progress, workers):
+    """
+    Render on one pool of workers and optimise on another at low priority.
+    Each rendered PNG is queued for optimising as soon as it's made.
+    """
+    optimise = progress.optimise
+    render_pool = Pool(workers)
+    optimise_pool = Pool(workers, initializer=_low_priority) if optimise else None
+
+    def queue(tasks):
+        for task in tasks:
+            optimise_pool.apply_async(optimise_thumbnail, (task,), callback=progress.optimise_done)
+
+    try:
+        for key, pngs in to_optimise:
+            queue(progress.optimise_tasks(key, pngs))
+        for key, made in render_pool.imap_unordered(render_thumbnail, jobs, chunksize=4):
+            queue(progress.render_done(key, made))
+        render_pool.close()
+        logging.info("All thumbnails rendered, waiting for optipng on %d." %
+                     (progress.queued - progress.optimised if optimise else 0))
+        if optimise_pool is not None:
+            optimise_pool.close()
+            optimise_pool.join()
+    finally:
+        render_pool.terminate()
+        if optimise_pool is not None:
+            optimise_pool.terminate()
 
 
 def main():
     pdf_root_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf')
     thumbnail_root_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static', 'thumbnails')
 
-    p = ArgumentParser(description='Import scraped documents into the database')
+    p = ArgumentParser(description='Make thumbnails of the first page of each pdf')
     p.add_argument('--pdf-root',
                    help='Root directory of PDF files to make thumbnails for (default: ../pdf)',
                    default=pdf_root_default)
@@ -49,11 +284,19 @@ def main():
                    help='Root directory to put thumbnails in (default: ../static/thumbnails',
                    default=thumbnail_root_default)
     p.add_argument('--force-regen', '-f',
-                   help='Regenerate all thumbnails, even those that already exist.',
+                   help='Regenerate all thumbnails, even those that are up to date.',
                    action='store_true')
+    p.add_argument('--manifest',
+                   help='Manifest of the thumbnails made (default: THUMBNAIL_MANIFEST in the site config)',
+                   default=os.path.join(app.root_path, app.config['THUMBNAIL_MANIFEST']))
+    p.add_argument('--adopt', action='store_true',
+                   help='Record thumbnails made before there was a manifest instead of remaking them')
     p.add_argument('--no-optipng', '-n',
                    help='Do not use optipng on the output (much faster, larger pngs)',
                    action='store_true')
+    p.add_argument('--jobs', '-j', type=int, default=1,
+                   help='Number of pdfs to render at once, and of optipng runs at low priority '
+                        '(default: 1, %d cpus here)' % cpu_count())
     p.add_argument('--verbose', '-v', help='be more verbose',
                    action='store_true')
     p.add_argument('--quiet', '-q', help='be more quiet', action='store_true')
@@ -65,38 +308,34 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
     elif args.quiet:
         logging.basicConfig(level=logging.WARN)
+    else:
+        logging.basicConfig(level=logging.INFO)
 
     if not os.path.isdir(args.pdf_root):
         p.error('pdf root is not a directory.')
     if not os.path.isdir(args.thumbnail_root):
         p.error('thumbnail root is not a directory.')
 
-    logging.info("Generating thumbnails for pdfs...")
-    checked = 0
-
     pdf_root = os.path.abspath(args.pdf_root)
     thumbnail_root = os.path.abspath(args.thumbnail_root)
 
-    for root, dirs, files in os.walk(pdf_root):
-        pdf_files = filter(lambda x: x.endswith('.pdf'), files)
-        if args.pattern:
-            matches = set()
-            for p in args.pattern:
-                if p in root:
-                    # directory match.. put them all in
-                    matches = pdf_files
-                    break
-                matches.update(filter(lambda x: p in x, pdf_files))
-            pdf_files = list(matches)
-        if not pdf_files:
-            continue
-        for f in pdf_files:
-            check_pdf(root, f, pdf_root, thumbnail_root, args.force_regen, not args.no_optipng)
-            checked += 1
-            if (checked % 1000) == 0:
-                logging.info(".. %d pdfs checked." % checked)
+    optimise = not args.no_optipng
+    thumbs = manifest.ThumbnailManifest(args.manifest)
+
+    logging.info("Looking for pdfs without up to date thumbnails...")
+    jobs, to_optimise = find_pdfs(pdf_root, thumbnail_root, args.pattern, args.force_regen,
+                                  thumbs, optimise, args.adopt)
+    logging.info("Generating thumbnails for %d pdfs..." % len(jobs))
+
+    progress = Progress(len(jobs), optimise, thumbs)
+    if args.jobs > 1:
+        run_parallel(jobs, to_optimise, progress, args.jobs)
+    else:
+        run_serial(jobs, to_optimise, progress)
 
-    logging.info("FINISHED. %d pdfs checked." % checked)
+    progress.report(force=True)
+    thumbs.close()
+    logging.info("FINISHED. %d pdfs got thumbnails." % progress.rendered)
 
 
 if __name__ == '__main__':
@@ -2,16 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import requests
+import requests.adapters
 import logging
 import os
+import time
+import threading
+import contextlib
 from hashlib import md5
 import re
 import urllib.parse
 import datetime
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 
-from toollib import metautil, get_nenbun
+from toollib import metautil, httpcache, get_nenbun
 
 SITE = 'https://www.soumu.go.jp'
 
@@ -20,38 +25,200 @@ _BLOCK_SIZE = 4096
 
 # Remember URLs we have seen so that we only check each page once
 _seen = set()
+_seen_lock = threading.Lock()
 
 _downloaded = 0
+_downloaded_lock = threading.Lock()
 
 # Hacky globals so i can reprocess metadata
 _nowrite = False
 _redo_meta = False
 
+# Ask the server whether cached pages changed, rather than trusting them
+_revalidate = True
+
+_http_index = None
+_http_index_lock = threading.Lock()
+
 
 html_cache_dir = None
 pdf_cache_dir = None
 
 
-def save(session, url, path):
+class Crawler():
+    """
+    Runs a crawl on a pool of threads.  This is passed around in place of a
+    requests session: get() goes through a shared connection pool, and
+    requests made while holding slot() are limited to per_host at a time to
+    each host and spaced out by at least delay seconds.  spawn() queues up
+    more work for the pool.
+    """
+    def __init__(self, workers=4, per_host=2, delay=0.5):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.per_host = per_host
+        self.delay = delay
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        # host -> [semaphore, time the next request may start]
+        self._hosts = {}
+
+    def _host(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = [threading.Semaphore(self.per_host), 0.0]
+            return self._hosts[host]
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """Hold one of the request slots for url's host"""
+        slot = self._host(url)
+        with slot[0]:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, slot[1])
+                slot[1] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def spawn(self, fn, *args, **kwargs):
+        with self._lock:
+            self._pending += 1
+        self.pool.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            # args are always (session, url, ...)
+            logging.exception('Error crawling %s' % (args[1],))
+            with self._lock:
+                self.errors += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def wait(self):
+        """Block until everything spawned, and everything they spawned, is done"""
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+
+    def close(self):
+        self.pool.shutdown()
+        self.session.close()
+
+
+def _spawn(session, fn, *args, **kwargs):
+    """Run fn on the crawler's pool if there is one, otherwise right away"""
+    if isinstance(session, Crawler):
+        session.spawn(fn, session, *args, **kwargs)
+    else:
+        fn(session, *args, **kwargs)
+
+
+def _slot(session, url):
+    if isinstance(session, Crawler):
+        return session.slot(url)
+    return contextlib.nullcontext()
+
+
+def _get_index():
+    """The index of http validators for the current html cache dir"""
+    global _http_index
+    path = os.path.join(html_cache_dir, httpcache.INDEX_FILENAME)
+    with _http_index_lock:
+        if _http_index is None or _http_index.path != path:
+            _http_index = httpcache.HttpIndex(path)
+        return _http_index
+
+
+def _claim(url):
+    """Mark url as seen.  Returns False if it already was."""
+    with _seen_lock:
+        if url in _seen:
+            return False
+        _seen.add(url)
+        return True
+
+
+def save(session, url, path, revalidate=False):
+    """
+    Download url to path.  The file is written as path.part and renamed when
+    complete, so path only ever holds a whole download.  If an earlier
+    download was cut off it is resumed with a range request where the server
+    allows it.  With revalidate, an existing complete file is only fetched
+    again if the server says it has changed.
+
+    Returns True if path was written.
+    """
     global _downloaded
-    logging.debug('save url %s -> %s' % (url, path))
-    r = session.get(url)
-    if r.status_code != 200:
-        raise Exception('%d fetching %s' % (r.status_code, url))
-    try:
-        if _nowrite:
-            logging.debug("not writing %s because of _nowrite global" % path)
-            return
-        with open(path, 'wb') as fd:
-            for chunk in r.iter_content(4096):
-                fd.write(chunk)
-    except Exception:
-        import pdb
-        pdb.set_trace()
-
-        os.unlink(path)
-        raise
-    _downloaded += 1
+    index = _get_index()
+    entry = index.get(url)
+    part = path + '.part'
+    headers = {}
+    offset = 0
+    if entry and (entry['etag'] or entry['last_modified']):
+        if revalidate and entry['size'] is not None and \
+                os.path.exists(path) and os.path.getsize(path) == entry['size']:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        elif os.path.exists(part):
+            offset = os.path.getsize(part)
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = entry['etag'] or entry['last_modified']
+
+    logging.debug('save url %s -> %s%s' % (url, path, ' from %d' % offset if offset else ''))
+    with _slot(session, url):
+        r = session.get(url, headers=headers, stream=True)
+        try:
+            if r.status_code == 304:
+                logging.debug('%s not modified' % url)
+                return False
+            if r.status_code == 206 and offset and \
+                    r.headers.get('Content-Range', '').startswith('bytes %d-' % offset):
+                mode = 'ab'
+                etag = entry['etag']
+                last_modified = entry['last_modified']
+            elif r.status_code == 200:
+                mode = 'wb'
+                etag = r.headers.get('ETag')
+                last_modified = r.headers.get('Last-Modified')
+            else:
+                raise Exception('%d fetching %s' % (r.status_code, url))
+
+            if _nowrite:
+                logging.debug("not writing %s because of _nowrite global" % path)
+                return False
+
+            # Record the validators first, so a partial file can be resumed
+            index.put(url, etag, last_modified, None)
+            with open(part, mode) as fd:
+                for chunk in r.iter_content(_BLOCK_SIZE):
+                    fd.write(chunk)
+        finally:
+            r.close()
+
+    os.replace(part, path)
+    index.put(url, etag, last_modified, os.path.getsize(path))
+    with _downloaded_lock:
+        _downloaded += 1
+    return True
 
 
 def normalise(url, base):
@@ -106,14 +273,13 @@ def parse_page(data):
 def cache_page(session, url, srcurl):
     """ Get a page with caching """
     url = normalise(url, srcurl)
-    if url in _seen:
+    if not _claim(url):
         logging.warning("ALREADY SEEN PAGE %s" % url)
         return None
     key = md5(bytes(url, "utf-8")).hexdigest()
     path = os.path.join(html_cache_dir, key)
-    if not os.path.exists(path):
-        save(session, url, path)
-    _seen.add(url)
+    if _revalidate or not os.path.exists(path):
+        save(session, url, path, revalidate=True)
     return open(path, 'rb').read()
 
 
@@ -123,7 +289,7 @@ def cache_pdf(session, url, srcurl, site_base_url, ptype, title, srctitle, group
     more_meta is an optional list of additional metadata k,v pairs
     """
     url = normalise(url, srcurl)
-    if url in _seen:
+    if not _claim(url):
         logging.warning("ALREADY SEEN PDF %s" % url)
         return
 
@@ -132,8 +298,7 @@ def cache_pdf(session, url, srcurl, site_base_url, ptype, title, srctitle, group
         pdf_cache_file = pdf_cache_file[1:]
     pdf_cache_file = os.path.join(pdf_cache_dir, pdf_cache_file)
     pdf_dir = os.path.dirname(pdf_cache_file)
-    if not os.path.isdir(pdf_dir):
-        os.makedirs(pdf_dir)
+    os.makedirs(pdf_dir, exist_ok=True)
     meta_file = metautil.meta_path(pdf_cache_file)
 
     if (not _redo_meta) and os.path.exists(pdf_cache_file) and os.path.exists(meta_file):
@@ -264,7 +429,7 @@ def _pdf_list_page(session, url, site_base_url, ptype, title, srcurl, data, repu
                 pdb.set_trace()
             year = get_nenbun(previous.text)
 
-        cache_pdf(session, purl, url, site_base_url, ptype, title, ptitle, grouptype, year, pagetitle)
+        _spawn(session, cache_pdf, purl, url, site_base_url, ptype, title, ptitle, grouptype, year, pagetitle)
 
 
 # Processor functions all take the same arguments:
@@ -333,11 +498,11 @@ def _page_with_children(session, url, title, ptype, base_url, data, repurls, enc
         suburl = normalise(suburl, url)
         logging.debug('   %s, %s %s' % (suburl, linktitle, grouptype))
         if suburl.endswith('.pdf'):
-            cache_pdf(session, suburl, url, base_url, ptype, title, linktitle, grouptype, year, pagetitle)
+            _spawn(session, cache_pdf, suburl, url, base_url, ptype, title, linktitle, grouptype, year, pagetitle)
         else:
             combined_title = '%s\t%s' % (title, linktitle)
             sub_ptype = ptype + 'sub'
-            page_auto(session, suburl, base_url, sub_ptype, combined_title, url, data=None, grouptype=grouptype, year=year)
+            _spawn(session, page_auto, suburl, base_url, sub_ptype, combined_title, url, data=None, grouptype=grouptype, year=year)
 
 
 def kaisan(session, url, title, base_url):
@@ -392,7 +557,7 @@ def kanpo(session, url, title, base_url):
     title = title + ' (官報)'
 
     for href, links in linkdata.items():
-        cache_pdf(session, href, base_url, SITE, ptype, title, srctitle, grouptype, year, docsettype, more_meta=links)
+        _spawn(session, cache_pdf, href, base_url, SITE, ptype, title, srctitle, grouptype, year, docsettype, more_meta=links)
 
 
 def summary_pdf_downloader(session, href, text, base_url, node):
@@ -448,16 +613,14 @@ def check_dir(data_dir, create=False):
             raise Exception("Data dir %s doesn't exist - use --mkdirs to create it." % data_dir)
 
 
-def scrape_from(base_url, pattern, is_summary):
+def scrape_from(session, base_url, pattern, is_summary):
     logging.info("Starting at %s" % base_url)
-    session = requests.Session()
-
-    today = str(datetime.date.today())
-    cache_key = [x for x in base_url.split('/') if x][-1] + '-' + today
-    path = os.path.join(html_cache_dir, cache_key)
-    if not os.path.exists(path):
-        save(session, base_url, path)
-    _seen.add(base_url)
+
+    # Always check the top page, that's where new publications show up
+    key = md5(bytes(base_url, "utf-8")).hexdigest()
+    path = os.path.join(html_cache_dir, key)
+    save(session, base_url, path, revalidate=True)
+    _claim(base_url)
     data = open(path, 'rb').read()
     # data = open('test.html').read()
 
@@ -476,11 +639,13 @@ def scrape_from(base_url, pattern, is_summary):
         href = normalise(href, base_url)
         for k, p in list(processors.items()):
             if k in text:
-                p(session, href, text, base_url)
+                _spawn(session, p, href, text, base_url)
         if is_summary and href.endswith('.pdf'):
             # Sepecial case for the junk linked off the main summary page..
             #summary_pdf_downloader(session, href, text, base_url, node)
             continue
+    if isinstance(session, Crawler):
+        session.wait()
 
 
 def recheck_meta(base_url):
@@ -498,7 +663,10 @@ def recheck_meta(base_url):
     cache_data = {}
     cache_files = os.listdir(html_cache_dir)
     for f in cache_files:
-        cache_data[f] = open(os.path.join(html_cache_dir, f), 'rb').read()
+        path = os.path.join(html_cache_dir, f)
+        if f.startswith(httpcache.INDEX_FILENAME) or f.endswith('.part') or not os.path.isfile(path):
+            continue
+        cache_data[f] = open(path, 'rb').read()
 
     logging.info("checking cached pdf files..")
     for root, dirs, files in os.walk(pdf_cache_dir):
@@ -536,27 +704,36 @@ def recheck_meta(base_url):
 
 
 def main():
+    global SITE
     tooldir = os.path.dirname(os.path.abspath(__file__))
 
     CACHE_DIR = os.path.abspath(os.path.join(tooldir, '..', 'cache'))
     PDF_DIR = os.path.abspath(os.path.join(tooldir, '..', 'pdf'))
 
-    BASE_URL = SITE + '/senkyo/seiji_s/seijishikin/'
-    BASE_URL_DATA = SITE + '/senkyo/seiji_s/data_seiji/'
-
     from argparse import ArgumentParser
 
     p = ArgumentParser(description="Script to scrape contribution data from 総務省.")
+    p.add_argument("--site", help="site to scrape (default: %s)" % SITE, default=SITE)
+    p.add_argument("--workers", "-w", type=int, default=4, help="number of pages to work on at once (default 4)")
+    p.add_argument("--per-host", type=int, default=2, help="max requests at once to any one host (default 2)")
+    p.add_argument("--delay", type=float, default=0.5,
+                   help="min seconds between starting requests to the same host (default 0.5)")
     p.add_argument("--pdfdir", "-p", help="PDF file cache path", default=PDF_DIR)
     p.add_argument("--cachedir", "-c", help="html file cache path", default=CACHE_DIR)
     p.add_argument("--mkdirs", "-m", action="store_true", help="create cache and pdf dir if they don't exist")
     p.add_argument("--verbose", "-v", action="store_true", help="be more verbose")
+    p.add_argument("--no-revalidate", "-N", action="store_true",
+                   help="use cached html pages without checking if they changed (the top pages are still checked)")
     p.add_argument("--recheck-meta", "-r", action="store_true", help="recheck metadata by reparsing html")
     p.add_argument("--data-only", "-d", action="store_true", help="only check the 'data' page")
     p.add_argument('pattern', nargs='*', help='page pattern')
 
     args = p.parse_args()
 
+    SITE = args.site.rstrip('/')
+    BASE_URL = SITE + '/senkyo/seiji_s/seijishikin/'
+    BASE_URL_DATA = SITE + '/senkyo/seiji_s/data_seiji/'
+
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -573,11 +750,20 @@ def main():
     global pdf_cache_dir
     pdf_cache_dir = args.pdfdir
 
+    global _revalidate
+    _revalidate = not args.no_revalidate
+
     if not args.recheck_meta:
-        if not args.data_only:
-            scrape_from(BASE_URL, args.pattern, False)
-        scrape_from(BASE_URL_DATA, args.pattern, True)
+        crawler = Crawler(args.workers, args.per_host, args.delay)
+        try:
+            if not args.data_only:
+                scrape_from(crawler, BASE_URL, args.pattern, False)
+            scrape_from(crawler, BASE_URL_DATA, args.pattern, True)
+        finally:
+            crawler.close()
         logging.debug("Downloaded %d files." % _downloaded)
+        if crawler.errors:
+            logging.error("%d pages or files failed, see above." % crawler.errors)
     else:
         recheck_meta(BASE_URL)
 
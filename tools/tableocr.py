@@ -6,22 +6,42 @@ Original table splitter from:
 http://craiget.com/blog/extracting-table-data-from-pdfs-with-ocr/
 """
 
-from PIL import Image
+from PIL import Image, ImageFilter
 # from PIL import ImageOps
+import numpy
 import subprocess
 import sys
 import os
 import json
 import logging
 import requests
-import shutil
+import threading
+import time
+from itertools import groupby
+from tempfile import TemporaryDirectory
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
 from requests.exceptions import ConnectionError
 
+from toollib import ocrjobs
+
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from shikin.pdf import pdfimages
 
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 DEBUG = False
 
+# Which OCR engine to use: 'tesserocr', 'cli' or 'auto' to use tesserocr if
+# it is installed.
+OCR_ENGINE = 'auto'
+OCR_LANG = 'jpn+eng'
+# Tesseract page segmentation mode for a single word
+PSM_SINGLE_WORD = 8
+
 # minimum run of adjacent pixels to call something a line
 H_THRESH = 0.6
 H_MIN_PX = 200
@@ -76,13 +96,103 @@ class Box():
         return '(%d,%d)-(%d,%d)' % (self.x1, self.y1, self.x2, self.y2)
 
 
-def get_vblocks(pix, w, h, thresh):
+def load_bitmap(im):
+    """
+    Load a bitmap image into a boolean numpy array indexed [y, x], where True
+    is a black pixel.
+    """
+    return numpy.asarray(im) == 0
+
+
+def _longest_runs(black):
+    """Length of the longest run of True values in each row of a 2D array"""
+    n, w = black.shape
+    padded = numpy.zeros((n, w + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = black
+    edges = numpy.diff(padded, axis=1)
+    # nonzero() returns row-major order, so starts and ends pair up.
+    start_rows, start_cols = numpy.nonzero(edges == 1)
+    _, end_cols = numpy.nonzero(edges == -1)
+    runs = numpy.zeros(n, dtype=numpy.int64)
+    numpy.maximum.at(runs, start_rows, end_cols - start_cols)
+    return runs
+
+
+def _drift_band(black, drift):
+    """
+    For each row, mark the pixels which are black in any row within drift rows
+    of it - a line followed from that row can only ever touch those pixels.
+    """
+    band = black.copy()
+    for d in range(1, drift + 1):
+        band[d:] |= black[:-d]
+        band[:-d] |= black[d:]
+    return band
+
+
+def _scan_lines(black, thresh):
+    """
+    Find runs of at least thresh black pixels along each row of black,
+    following lines which slope by up to MAX_LINE_DRIFT rows.
+
+    Only rows where a long enough run is possible at all get walked pixel by
+    pixel, the rest are ruled out with array operations.  Yields (row,
+    endrow, start, end) for each line found.
+    """
+    h, w = black.shape
+    candidates = numpy.nonzero(_longest_runs(_drift_band(black, MAX_LINE_DRIFT)) > thresh)[0]
+    rows = {}
+
+    def row(y):
+        if y not in rows:
+            rows[y] = black[y].tolist()
+        return rows[y]
+
+    for y in candidates.tolist():
+        thisy = y
+        line = row(y)
+        x1, x2 = (None, None)
+        best_x1, best_x2 = (None, None)
+        black_px = 0
+        run = 0
+        for x in range(w):
+            if black_px > 20 and not line[x] and abs(y - thisy) < MAX_LINE_DRIFT:
+                # ran off a good line - tweak y to see if it is sloped
+                if thisy > 0 and row(thisy-1)[x]:
+                    thisy -= 1
+                    line = row(thisy)
+                elif thisy < h-1 and row(thisy+1)[x]:
+                    thisy += 1
+                    line = row(thisy)
+
+            if line[x]:
+                black_px += 1
+                if x1 is None:
+                    x1 = x
+                x2 = x
+            else:
+                if black_px > run:
+                    run = black_px
+                    best_x1 = x1
+                    best_x2 = x2
+                    x1, x2 = (None, None)
+                black_px = 0
+        if black_px > run:
+            run = black_px
+            best_x1 = x1
+            best_x2 = x2
+        if run > thresh:
+            yield (y, thisy, best_x1, best_x2)
+
+
+def get_vblocks(black, thresh):
     """
     Get vertical blocks separated by large segments of white.
     """
+    h, w = black.shape
     # allow a few black pixels per row..
-    colthresh = 255 * 6
-    colsums = [sum(255-pix[x, y] for y in range(h)) for x in range(w)]
+    colthresh = 6
+    colsums = numpy.count_nonzero(black, axis=0)
 
     minx = 0
     maxx = w - 1
@@ -91,15 +201,15 @@ def get_vblocks(pix, w, h, thresh):
     while colsums[maxx] < colthresh:
         maxx -= 1
 
-    rowthresh = 255 * 6
-    rowsums = [sum(255-pix[x, y] for x in range(minx, maxx)) for y in range(h)]
+    rowthresh = 6
+    blackrows = (numpy.count_nonzero(black[:, minx:maxx], axis=1) > rowthresh).tolist()
 
     whiteruns = []
 
     whitestart = 0
     y = 0
     while y < h:
-        if rowsums[y] > rowthresh:
+        if blackrows[y]:
             # Black row
             if y - whitestart > 1:
                 whiteruns.append((whitestart, y))
@@ -121,89 +231,27 @@ def get_vblocks(pix, w, h, thresh):
         yield Box(minx, y0, maxx, h)
 
 
-def get_hlines(pix, w, h, thresh):
+def get_hlines(black, thresh):
     """
     Get start/end pixels of lines containing horizontal runs of at least THRESH
     black pix
     """
-    lines = []
-    for y in range(h):
-        thisy = y
-        x1, x2 = (None, None)
-        best_x1, best_x2 = (None, None)
-        black = 0
-        run = 0
-        for x in range(w):
-            if black > 20 and pix[x, thisy] != 0 and abs(y - thisy) < MAX_LINE_DRIFT:
-                # ran off a good line - tweak y to see if it is sloped
-                if thisy > 0 and pix[x, thisy-1] == 0:
-                    thisy -= 1
-                elif thisy < h-1 and pix[x, thisy+1] == 0:
-                    thisy += 1
-
-            if pix[x, thisy] == 0:
-                black += 1
-                if x1 is None:
-                    x1 = x
-                x2 = x
-            else:
-                if black > run:
-                    run = black
-                    best_x1 = x1
-                    best_x2 = x2
-                    x1, x2 = (None, None)
-                black = 0
-        if black > run:
-            run = black
-            best_x1 = x1
-            best_x2 = x2
-        if run > thresh:
-            lines.append(Box(best_x1, min(y, thisy), best_x2, max(y, thisy)))
-    return lines
+    return [Box(x1, min(y, thisy), x2, max(y, thisy))
+            for (y, thisy, x1, x2) in _scan_lines(black, thresh)]
 
 
-def get_vlines(pix, w, h, thresh, printlog=False):
+def get_vlines(black, thresh, printlog=False):
     """
     Get start/end pixels of lines containing vertical runs of at least THRESH
     black pix
     """
-    lines = []
     if printlog:
-        print('get_vlines: %d, %d, %d' % (w, h, thresh))
-    for x in range(w):
-        thisx = x
-        y1, y2 = (None, None)
-        best_y1, best_y2 = (None, None)
-        black = 0
-        run = 0
-        for y in range(h):
-            if black > 20 and pix[thisx, y] != 0 and abs(x - thisx) < MAX_LINE_DRIFT:
-                # ran off a good line - tweak x to see if it is sloped
-                if thisx > 0 and pix[thisx-1, y] == 0:
-                    thisx -= 1
-                elif thisx < w-1 and pix[thisx+1, y] == 0:
-                    thisx += 1
-
-            if pix[thisx, y] == 0:
-                black += 1
-                if y1 is None:
-                    y1 = y
-                y2 = y
-            else:
-                if black > run:
-                    run = black
-                    best_y1 = y1
-                    best_y2 = y2
-                    y1, y2 = (None, None)
-                black = 0
-        if black > run:
-            run = black
-            best_y1 = y1
-            best_y2 = y2
-        if run > thresh:
-            lines.append(Box(min(x, thisx), best_y1, max(x, thisx), best_y2))
+        print('get_vlines: %d, %d, %d' % (black.shape[1], black.shape[0], thresh))
+    lines = []
+    for (x, thisx, y1, y2) in _scan_lines(numpy.ascontiguousarray(black.T), thresh):
+        lines.append(Box(min(x, thisx), y1, max(x, thisx), y2))
         if printlog:
-            print('(%d,%s)-(%d,%s): %d > %d?' % (x, best_y1, thisx, best_y2, run, thresh))
+            print('(%d,%s)-(%d,%s) > %d' % (x, y1, thisx, y2, thresh))
     return lines
 
 
@@ -223,7 +271,7 @@ def get_cols(vlines, w, h):
     # Area after last vline
     if w - vlines[-1].midx > 1:
         cols.append(Box(vlines[-1].midx, 0, w, h))
-    cols = filter(lambda x: x.width > MIN_COL_WIDTH, cols)
+    cols = [x for x in cols if x.width > MIN_COL_WIDTH]
     return cols
 
 
@@ -244,7 +292,7 @@ def get_rows(hlines, w, h):
     if h - hlines[-1].y2 > 1:
         rows.append(Box(0, hlines[-1].midy, w, h))
 
-    rows = filter(lambda x: x.height > MIN_ROW_HEIGHT, rows)
+    rows = [x for x in rows if x.height > MIN_ROW_HEIGHT]
     return rows
 
 
@@ -300,12 +348,86 @@ def erode_edges(region, bgcol):
             pix[x, y] = bgcol
 
 
-def ocr_cell(im, cells, x, y, tmpdir, pngfname):
+class TesseractCli():
+    """
+    OCR engine which runs the tesseract command on each image.  Slow, as the
+    language data gets loaded every time, but needs nothing extra installed.
+    """
+    def __init__(self, lang):
+        self.lang = lang
+
+    def ocr(self, region, psm=None):
+        with TemporaryDirectory() as tmpdir:
+            fbase = os.path.join(tmpdir, 'cell')
+            ftif = fbase + '.tif'
+            region.save(ftif, "TIFF")
+            cmd = ["tesseract", "-l", self.lang]
+            if psm is not None:
+                cmd += ["-psm", str(psm)]
+            cmd += [ftif, fbase]
+            (stdout, stderr) = subprocess.Popen(cmd, stderr=subprocess.PIPE).communicate()
+            if stderr:
+                logging.debug(stderr)
+            with open(fbase + '.txt', 'rb') as f:
+                return _text_lines(f.read().decode('utf-8'))
+
+
+class TesserocrEngine():
+    """
+    OCR engine which keeps tesseract loaded in-process using tesserocr, so the
+    language data is only loaded once.  Not thread safe - use one per thread.
+    """
+    def __init__(self, lang):
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+
+    def ocr(self, region, psm=None):
+        self.api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else psm)
+        self.api.SetImage(region)
+        return _text_lines(self.api.GetUTF8Text())
+
+
+OCR_ENGINES = {
+    'tesserocr': TesserocrEngine,
+    'cli': TesseractCli,
+}
+
+_thread_engine = threading.local()
+
+
+def _text_lines(text):
+    return [l.strip() for l in text.splitlines() if l.strip()]
+
+
+def get_ocr_engine():
+    """
+    Get the OCR engine for the current thread, creating it on first use.
+    """
+    engine = getattr(_thread_engine, 'engine', None)
+    if engine is None:
+        name = OCR_ENGINE
+        if name == 'auto':
+            name = 'cli' if tesserocr is None else 'tesserocr'
+        logging.debug("starting %s ocr engine" % name)
+        engine = OCR_ENGINES[name](OCR_LANG)
+        _thread_engine.engine = engine
+    return engine
+
+
+def close_filter(region):
+    """Fill small gaps - same as ImageMagick's -morphology close square:1"""
+    region = region.convert('L')
+    return region.filter(ImageFilter.MaxFilter(3)).filter(ImageFilter.MinFilter(3))
+
+
+def _debug_text(fname, lines):
+    with open(fname, 'wb') as f:
+        f.write('\n'.join(lines).encode('utf-8'))
+
+
+def ocr_cell(im, cells, x, y, pngfname):
     """Return OCRed text from this cell"""
-    fbase = os.path.join("%s/%d-%d" % (tmpdir, x, y))
-    ftif = "%s.tif" % fbase
-    ftxt = "%s.txt" % fbase
-    cmd = ["tesseract", "-l", "jpn+eng", ftif, fbase]
+    engine = get_ocr_engine()
+    debugbase = "%s-%d-%d" % (pngfname, x, y)
     # extract cell from whole image, grayscale (1-color channel), monochrome
     region = im.crop(cells[x][y].tup)
     # region = ImageOps.grayscale(region)
@@ -317,7 +439,7 @@ def ocr_cell(im, cells, x, y, tmpdir, pngfname):
     bgcolor = 0 if histo[0] > histo[255] else 255
 
     if DEBUG:
-        region.save(pngfname + '-preerode-' + os.path.split(ftif)[1], "TIFF")
+        region.save(debugbase + '-preerode.tif', "TIFF")
 
     # trim remaining borders by finding first white pixel going in from edge
     erode_edges(region, bgcolor)
@@ -327,71 +449,82 @@ def ocr_cell(im, cells, x, y, tmpdir, pngfname):
         logging.debug("ocr cell %d %d seems empty." % (x, y))
         return None
 
-    # save as TIFF and extract text with Tesseract OCR
+    # extract text with Tesseract OCR
     logging.debug("ocr cell %d %d (bg %d) %dx%d" % (x, y, bgcolor, region.size[0], region.size[1]))
-    region.save(ftif, "TIFF")
     if DEBUG:
-        region.save(pngfname + '-' + os.path.split(ftif)[1], "TIFF")
+        region.save(debugbase + '.tif', "TIFF")
 
-    (stdout, stderr) = subprocess.Popen(cmd, stderr=subprocess.PIPE).communicate()
-    if stderr:
-        logging.debug(stderr)
-    lines = filter(lambda x: x, [l.strip() for l in open(ftxt).readlines()])
+    lines = engine.ocr(region)
 
     if DEBUG:
-        shutil.copyfile(ftxt, pngfname + '-' + os.path.split(ftxt)[1])
+        _debug_text(debugbase + '.txt', lines)
 
     if maybe_noisy and not lines:
         logging.debug("Got nothing on noisy img: filter and run again")
-        filtertif = ftif+'-filtered.tif'
-        cmd2 = ["convert", ftif, "-morphology", "close", "square:1", filtertif]
-        (stdout, stderr) = subprocess.Popen(cmd2, stderr=subprocess.PIPE).communicate()
-        if stderr:
-            logging.debug(stderr)
-        ftif = filtertif
-        cmd = ["tesseract", "-l", "jpn+eng", ftif, fbase]
+        region = close_filter(region)
         if DEBUG:
-            shutil.copyfile(ftif, pngfname + '-' + os.path.split(ftif)[1])
-        (stdout, stderr) = subprocess.Popen(cmd, stderr=subprocess.PIPE).communicate()
-        if stderr:
-            logging.debug(stderr)
-        lines = filter(lambda x: x, [l.strip() for l in open(ftxt).readlines()])
+            region.save(debugbase + '.tif-filtered.tif', "TIFF")
+        lines = engine.ocr(region)
         if DEBUG:
-            shutil.copyfile(ftxt, pngfname + '-' + os.path.split(ftxt)[1] + '-filtered.txt')
+            _debug_text(debugbase + '.txt-filtered.txt', lines)
 
     if not lines:
         logging.debug("Retrying with PSM 8")
-        cmd = ["tesseract", "-l", "jpn+eng", "-psm", "8", ftif, fbase]
-        (stdout, stderr) = subprocess.Popen(cmd, stderr=subprocess.PIPE).communicate()
-        if stderr:
-            logging.debug(stderr)
+        lines = engine.ocr(region, psm=PSM_SINGLE_WORD)
         if DEBUG:
-            shutil.copyfile(ftxt, pngfname + '-' + os.path.split(ftxt)[1] + '-psm8.txt')
+            _debug_text(debugbase + '.txt-psm8.txt', lines)
 
     return '\n'.join(lines)
 
 
-def get_image_data(filename):
-    """Extract textual data[rows][cols] from spreadsheet-like image file"""
-    tmpdir, pngfname = os.path.split(filename)
+def _ocr_cell_task(task):
+    """Run ocr_cell for one cell queued by get_image_data"""
+    (crop, cells, row, col, pngfname, blockno, box) = task
+    text = ocr_cell(crop, cells, row, col, pngfname)
+    if text is None:
+        return None
+    return (blockno, row, col, cells[row][col].offset(box.x1, box.y1), text)
+
+
+def get_image_data(image, pool=None, name=None):
+    """
+    Extract textual data[rows][cols] from spreadsheet-like image, a PIL image
+    or image file.  name is used in log messages and debug files.
+
+    If a pool is given, cells are OCRed on it concurrently.  Results still come
+    out in (block, row, col) order.
+    """
+    if not isinstance(image, Image.Image):
+        name = name or os.path.basename(image)
+        image = Image.open(image)
+    tasks = _cell_tasks(image, name or 'image')
+    if pool is not None:
+        results = pool.imap(_ocr_cell_task, tasks)
+    else:
+        results = (_ocr_cell_task(t) for t in tasks)
+    for result in results:
+        if result is not None:
+            yield result
+
+
+def _cell_tasks(im, pngfname):
+    """Split the image into cells, and generate an OCR task for each one"""
     logging.debug("processing %s" % pngfname)
-    im = Image.open(filename)
-    allpix = im.load()
     assert im.mode == '1'
-    totwidth, totheight = im.size
+    black = load_bitmap(im)
     blockno = 0
-    for box in get_vblocks(allpix, totwidth, totheight, 20):
+    for box in get_vblocks(black, 20):
         crop = im.crop(box.tup)
         if DEBUG:
             crop.save('%s-%d-%s.png' % (pngfname, blockno, box.tostr))
-        pix = crop.load()
+        cropblack = black[box.y1:box.y2, box.x1:box.x2]
 
         (cropw, croph) = crop.size
         logging.info("%s:%d: %s" % (pngfname, blockno, box))
         hthresh = max(H_MIN_PX, int((cropw) * H_THRESH))
-        hlines = get_hlines(pix, cropw, croph, hthresh)
+        hlines = get_hlines(cropblack, hthresh)
         vthresh = max(V_MIN_PX, int((croph) * V_THRESH))
-        vlines = get_vlines(pix, cropw, croph, vthresh)
+        vlines = get_vlines(cropblack, vthresh)
         logging.debug("%s block %d: hlines: %d  vlines: %d" % (pngfname, blockno, len(hlines), len(vlines)))
 
         rows = get_rows(hlines, cropw, croph)
@@ -401,28 +534,215 @@ def get_image_data(filename):
 
         for row in range(len(rows)):
             for col in range(len(cols)):
-                text = ocr_cell(crop, cells, row, col, tmpdir, '%s-%d' % (pngfname, blockno))
-                if text is not None:
-                    c = cells[row][col]
-                    yield (blockno, row, col, c.offset(box.x1, box.y1), text)
+                yield (crop, cells, row, col, '%s-%d' % (pngfname, blockno), blockno, box)
         blockno += 1
 
 
-def extract_pdf(filename, pageno):
-    """Extract table data from pdf"""
+def extract_pdf(filename, pageno, pool=None, rotation=None):
+    """
+    Extract table data from pdf.  Yields (pageno, blockno, row, col, location,
+    text) tuples, with 0-indexed page numbers.  rotation is as for
+    pdfimages.pdf_images, eg from page_rotation.
+    """
     # extract table data from each page
     logging.debug("extracting images from %s" % filename)
-    fileno = 0
 
     firstpage = pageno or 1
     lastpage = pageno
+    basename = os.path.basename(filename)
 
-    for pngfile in pdfimages.pdf_images(filename, optimise=False, firstpage=firstpage, lastpage=lastpage):
-        # TODO: Maybe run unpaper on the PNG file to remove skew, rotation, and
+    for pdfpage, img in pdfimages.pdf_images(filename, firstpage=firstpage, lastpage=lastpage,
+                                             rotation=rotation):
+        # TODO: Maybe run unpaper on the image to remove skew, rotation, and
         # noise.
-        for (blockno, row, col, location, text) in get_image_data(pngfile):
-            yield (fileno, blockno, row, col, location, text)
-        fileno += 1
+        name = '%s-%03d' % (basename, pdfpage)
+        for (blockno, row, col, location, text) in get_image_data(img, pool, name):
+            yield (pdfpage - 1, blockno, row, col, location, text)
+
+
+class SiteApi():
+    """Access to the site's API for fetching docs and adding segments"""
+    def __init__(self, site, username=None, password=None):
+        api_base = 'http://%s/api/' % site
+        self.doc_api = api_base + 'document/%d'
+        self.segment_bulk_api = api_base + 'raw/doc_segment/bulk'
+        self.login_api = api_base + 'login'
+        self.username = username
+        self.password = password
+        self.session = requests.session()
+
+    def login(self):
+        if self.username:
+            result = self.session.post(self.login_api, data={'username': self.username,
+                                                             'password': self.password},
+                                       headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            if result:
+                j = result.json()
+                if j.get('status') != 'ok':
+                    logging.error('Loging failed: %s' % str(j))
+                    return False
+        self.session.headers['Content-Type'] = 'application/json'
+        return True
+
+    def get_doc(self, docid):
+        return self.session.get(self.doc_api % docid).json()
+
+    def upload(self, docid, segments, existing_segments):
+        """
+        Upload segments from extract_pdf in one request, skipping any already
+        in the DB
+        """
+        objs = []
+        for (pageno, blockno, row, col, loc, text) in segments:
+            if (pageno, loc.x1, loc.y1, loc.x2, loc.y2) in existing_segments:
+                logging.info("Already in DB, skipping")
+                continue
+            objs.append({'doc_id': docid, 'page': pageno, 'row': row, 'col': col,
+                         'x1': loc.x1, 'y1': loc.y1, 'x2': loc.x2,
+                         'y2': loc.y2, 'ocrtext': text})
+        if not objs:
+            return
+        data = json.dumps({'objects': objs})
+        try:
+            result = self.session.post(self.segment_bulk_api, data=data)
+        except ConnectionError:
+            if self.username:
+                # Maybe need to log in again.
+                self.login()
+                result = self.session.post(self.segment_bulk_api, data=data)
+            else:
+                raise
+        try:
+            result = result.json()
+        except ValueError:
+            result = None
+        if not result or result.get('status') != 'ok':
+            raise ValueError('Segment add: got back %s' % result)
+        logging.debug("doc %d: added %d segments, %d already there" % (docid, result['added'], result['ignored']))
+
+
+def doc_filename(docdata):
+    """Path to the pdf for a doc from the API"""
+    path = docdata['docset']['path']
+    if path[0] == '/':
+        path = path[1:]
+    return os.path.join('..', 'pdf', path, docdata['filename'])
+
+
+def page_rotation(page_rots, pageno=None):
+    """
+    Rotation for extract_pdf from the page_rots of a doc from the API: for
+    just pageno if given, else all the pages.  None if they weren't recorded,
+    so pdfinfo is asked instead.
+    """
+    if page_rots is None:
+        return None
+    if pageno is None:
+        return dict(enumerate(page_rots, 1))
+    return page_rots[pageno - 1] if pageno <= len(page_rots) else None
+
+
+def existing_segment_keys(docdata):
+    return set((seg['page'], seg['x1'], seg['y1'], seg['x2'], seg['y2'])
+               for seg in docdata['segments'])
+
+
+def parse_doc_ids(specs):
+    """Doc ids from a list of ids and ranges like 100-200 (inclusive)"""
+    docids = []
+    for spec in specs:
+        if '-' in spec:
+            first, last = spec.split('-')
+            docids.extend(range(int(first), int(last) + 1))
+        else:
+            docids.append(int(spec))
+    return docids
+
+
+_worker_pool = None
+
+
+def _init_worker(debug, ocr_engine, jobs):
+    global DEBUG, OCR_ENGINE, _worker_pool
+    DEBUG = debug
+    OCR_ENGINE = ocr_engine
+    if jobs > 1:
+        _worker_pool = ThreadPool(jobs)
+
+
+def _ocr_page(job):
+    """OCR one page in a worker process.  Returns (docid, page, segments, error)"""
+    (docid, pageno, filename, rot) = job
+    try:
+        segments = list(extract_pdf(filename, pageno, _worker_pool, rot))
+    except Exception as e:
+        logging.exception("OCR failed on doc %d page %d" % (docid, pageno))
+        return (docid, pageno, None, str(e))
+    return (docid, pageno, segments, None)
+
+
+def _log_given_up(jobs):
+    for (docid, pageno, error) in jobs.given_up():
+        logging.warning("Gave up on doc %d page %d after %d attempts: %s" % (docid, pageno, jobs.max_attempts, error))
+
+
+def run_scheduled(api, args):
+    """
+    OCR pages from the given docs across a pool of worker processes, keeping
+    track of finished pages in a job db so an interrupted run can carry on.
+    """
+    jobs = ocrjobs.JobTable(args.jobdb, args.max_attempts)
+    existing = {}
+    page_rots = {}
+
+    for docid in parse_doc_ids(args.pdf):
+        if jobs.has_doc(docid):
+            continue
+        docdata = api.get_doc(docid)
+        filename = doc_filename(docdata)
+        if not os.path.exists(filename):
+            logging.error("File %s for doc %d doesn't exist." % (filename, docid))
+            continue
+        done = set()
+        if docdata['segments'] and not args.force:
+            logging.info("Doc %d already has segments in DB, skipping those pages." % docid)
+            done = set(seg['page'] + 1 for seg in docdata['segments'])
+        jobs.add_doc(docid, filename, docdata['pages'], done)
+        existing[docid] = existing_segment_keys(docdata)
+        page_rots[docid] = docdata.get('page_rots')
+
+    pending = jobs.pending()
+    logging.info("%d pages to OCR (%s)" % (len(pending), jobs.counts()))
+    if not pending:
+        _log_given_up(jobs)
+        return
+
+    # Docs queued by an earlier run may have some segments uploaded already.
+    for docid in set(x[0] for x in pending) - set(existing):
+        docdata = api.get_doc(docid)
+        existing[docid] = existing_segment_keys(docdata)
+        page_rots[docid] = docdata.get('page_rots')
+    pending = [(docid, pageno, path, page_rotation(page_rots[docid], pageno))
+               for (docid, pageno, path) in pending]
+
+    pool = Pool(args.workers, initializer=_init_worker,
+                initargs=(DEBUG, OCR_ENGINE, max(1, args.jobs // args.workers)))
+    start = time.time()
+    finished = 0
+    for (docid, pageno, segments, error) in pool.imap_unordered(_ocr_page, pending):
+        if error is not None:
+            jobs.fail(docid, pageno, error)
+        else:
+            api.upload(docid, segments, existing[docid])
+            jobs.finish(docid, pageno, len(segments))
+        finished += 1
+        if finished % 10 == 0 or finished == len(pending):
+            elapsed = time.time() - start
+            logging.info(".. %d/%d pages, %.2f pages/sec" % (finished, len(pending), finished / elapsed))
+    pool.close()
+    pool.join()
+    logging.info("FINISHED. %s" % jobs.counts())
+    _log_given_up(jobs)
 
 
 def main():
@@ -433,6 +753,17 @@ def main():
     p.add_argument("--verbose", "-v", action="store_true", help="be more verbose")
     p.add_argument("--debug", "-d", action="store_true", help="dump debug images and ocr output")
     p.add_argument("--page", "-p", type=int, help="single page number to run")
+    p.add_argument("--jobs", "-j", type=int, default=cpu_count(),
+                   help="number of cells to OCR at once (default=%d)" % cpu_count())
+    p.add_argument("--ocr-engine", "-e", choices=['auto'] + sorted(OCR_ENGINES), default='auto',
+                   help="OCR engine to use (default=auto: tesserocr if installed)")
+    p.add_argument("--jobdb", "-J",
+                   help="sqlite file to track progress in. Runs doc ids (or ranges like 100-200) page "
+                        "by page over --workers processes, and skips pages finished by earlier runs")
+    p.add_argument("--workers", "-w", type=int, default=cpu_count(),
+                   help="number of pages to OCR at once with --jobdb (default=%d)" % cpu_count())
+    p.add_argument("--max-attempts", type=int, default=ocrjobs.MAX_ATTEMPTS,
+                   help="times to try a page with --jobdb before giving up on it (default=%d)" % ocrjobs.MAX_ATTEMPTS)
     p.add_argument("--force", "-f", action="store_true", help="continue even if segments already in db (identical ones will be ignored)")
     p.add_argument("--site", "-s", default=SITE_DEFAULT, help="site for api urls (default=%s)" % SITE_DEFAULT)
     p.add_argument("--username", "-u", help="username for API login (default=no login)")
@@ -441,82 +772,60 @@ def main():
 
     args = p.parse_args()
 
-    api_base = 'http://%s/api/' % args.site
-    doc_api = api_base + 'document/%d'
-    segment_api = api_base + 'raw/doc_segment'
-    login_api = api_base + 'login'
-
     global DEBUG
     DEBUG = args.debug
+    global OCR_ENGINE
+    OCR_ENGINE = args.ocr_engine
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
 
-    s = requests.session()
+    api = SiteApi(args.site, args.username, args.password)
+    if not api.login():
+        return
 
-    if args.username:
-        result = s.post(login_api, data={'username': args.username,
-                                         'password': args.password})
-        if result:
-            j = result.json()
-            if j.get('status') != 'ok':
-                logging.error('Loging failed: %s' % str(j))
-                return
+    if args.jobs > 1 or args.jobdb:
+        # Tesseract can multithread each run too, which only fights with the
+        # pool for cores.
+        os.environ.setdefault('OMP_THREAD_LIMIT', '1')
 
-    s.headers['Content-Type'] = 'application/json'
+    if args.jobdb:
+        run_scheduled(api, args)
+        return
+
+    pool = None
+    if args.jobs > 1:
+        pool = ThreadPool(args.jobs)
 
     logging.debug("pdfs are: %s" % args.pdf)
     for filename in args.pdf:
         # split target pdf into pages
         docid = None
-        existing_segments = {}
+        existing_segments = set()
+        rotation = None
         if filename.isdigit():
-            docdata = s.get(doc_api % int(filename)).json()
+            docdata = api.get_doc(int(filename))
             if len(docdata['segments']):
                 if not args.force:
                     logging.error("Doc already has segments in DB.  Use --force to continue.")
                     continue
-                segments = docdata['segments']
-                for seg in segments:
-                    existing_segments[(seg['page'], seg['x1'], seg['y1'], seg['x2'], seg['y2'])] = seg
-            path = docdata['docset']['path']
+                existing_segments = existing_segment_keys(docdata)
             docid = docdata['id']
-            if path[0] == '/':
-                path = path[1:]
-            fname = docdata['filename']
-            filename = os.path.join('..', 'pdf', path, fname)
+            filename = doc_filename(docdata)
+            rotation = page_rotation(docdata.get('page_rots'))
         if not os.path.exists(filename):
             logging.error("File %s doesn't exist." % filename)
             continue
 
         # print('pageno\tblockno\trow\tcol\ttext')
-        for (pageno, blockno, row, col, loc, text) in extract_pdf(filename, args.page):
-            print("%d\t%d\t%d\t%d\t%s\t%s" % (pageno, blockno, row, col, loc, 'text'))
+        for (pageno, segments) in groupby(extract_pdf(filename, args.page, pool, rotation), key=lambda x: x[0]):
+            segments = list(segments)
+            for (pageno, blockno, row, col, loc, text) in segments:
+                print("%d\t%d\t%d\t%d\t%s\t%s" % (pageno, blockno, row, col, loc, 'text'))
             if docid:
-                if (pageno, loc.x1, loc.y1, loc.x2, loc.y2) in existing_segments:
-                    logging.info("Already in DB, skipping")
-                    continue
-                obj = {'doc_id': docid, 'page': pageno, 'row': row, 'col': col,
-                       'x1': loc.x1, 'y1': loc.y1, 'x2': loc.x2,
-                       'y2': loc.y2, 'ocrtext': text}
-                try:
-                    result = s.post(segment_api, data=json.dumps(obj))
-                except ConnectionError:
-                    if args.username:
-                        # Maybe need to log in again.
-                        result = s.post(login_api, data={'username': args.username,
-                                                         'password': args.password})
-                        result = s.post(segment_api, data=json.dumps(obj))
-                    else:
-                        raise
-                try:
-                    result.json()
-                except ValueError:
-                    import pdb
-                    pdb.set_trace()
-                    pass
+                api.upload(docid, segments, existing_segments)
 
 
 if __name__ == '__main__':
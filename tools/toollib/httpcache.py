@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Index of what we know about downloaded urls.
+
+For each url we keep the ETag and Last-Modified the server gave us, and the
+size of the complete file.  That's enough to ask the server whether a page
+changed, and to resume a download which got cut off.  A size of None means
+the download was started but never finished.
+"""
+
+import sqlite3
+import datetime
+import threading
+
+INDEX_FILENAME = '_index.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS http_cache (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER,
+    fetched TIMESTAMP
+);
+"""
+
+
+class HttpIndex():
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            cur = self.db.execute('SELECT etag, last_modified, size FROM http_cache WHERE url = ?', (url,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'size': row[2]}
+
+    def put(self, url, etag, last_modified, size):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO http_cache (url, etag, last_modified, size, fetched) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (url, etag, last_modified, size, datetime.datetime.now()))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Progress tracking for OCR runs.
+
+Each page of each document is a job, kept in a local SQLite db so that an
+interrupted run can pick up where it left off.  Page numbers here are
+1-indexed, as for pdf tools.  Failed pages are tried again on later runs, up
+to max_attempts times.
+"""
+
+import sqlite3
+import datetime
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS page_job (
+    doc_id INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    segments INTEGER,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished TIMESTAMP,
+    PRIMARY KEY (doc_id, page)
+);
+CREATE INDEX IF NOT EXISTS page_job_status ON page_job (status);
+"""
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Times a page is tried before it's given up on
+MAX_ATTEMPTS = 3
+
+
+class JobTable():
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        self.max_attempts = max_attempts
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(page_job)')]
+        if 'attempts' not in columns:
+            # A job db from before attempts were counted
+            with self.db:
+                self.db.execute('ALTER TABLE page_job ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+
+    def has_doc(self, doc_id):
+        cur = self.db.execute('SELECT 1 FROM page_job WHERE doc_id = ? LIMIT 1', (doc_id,))
+        return cur.fetchone() is not None
+
+    def add_doc(self, doc_id, path, pages, done=()):
+        """Queue up all the pages of a doc, marking those in done as finished"""
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO page_job (doc_id, page, path, status) VALUES (?, ?, ?, ?)',
+                                [(doc_id, p, path, DONE if p in done else PENDING)
+                                 for p in range(1, pages + 1)])
+
+    def pending(self):
+        """
+        All the pages which still need doing, as (doc_id, page, path).  Pages
+        which failed last time are tried again, unless they have failed
+        max_attempts times.
+        """
+        cur = self.db.execute('SELECT doc_id, page, path FROM page_job WHERE status != ? AND attempts < ? '
+                              'ORDER BY doc_id, page', (DONE, self.max_attempts))
+        return cur.fetchall()
+
+    def given_up(self):
+        """The pages which failed max_attempts times, as (doc_id, page, error)"""
+        cur = self.db.execute('SELECT doc_id, page, error FROM page_job WHERE status = ? AND attempts >= ? '
+                              'ORDER BY doc_id, page', (FAILED, self.max_attempts))
+        return cur.fetchall()
+
+    def finish(self, doc_id, page, segments):
+        with self.db:
+            self.db.execute('UPDATE page_job SET status = ?, segments = ?, error = NULL, finished = ? '
+                            'WHERE doc_id = ? AND page = ?',
+                            (DONE, segments, datetime.datetime.now(), doc_id, page))
+
+    def fail(self, doc_id, page, error):
+        with self.db:
+            self.db.execute('UPDATE page_job SET status = ?, error = ?, attempts = attempts + 1 '
+                            'WHERE doc_id = ? AND page = ?', (FAILED, error, doc_id, page))
+
+    def counts(self):
+        """Number of pages in each status"""
+        return dict(self.db.execute('SELECT status, count(*) FROM page_job GROUP BY status').fetchall())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Size, page count and page rotation probing for pdf files.
+
+Page counts and the rotation of each page come from one run of pdfinfo,
+which is slow to start, so the probes run on a pool and the results are kept
+in a small SQLite index next to the pdfs.  The index is keyed on path, size
+and mtime, so a file is only probed again if it changes on disk.
+"""
+
+import os
+import re
+import sys
+import sqlite3
+import logging
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from shikin.pdf.util import parse_page_rots, ALL_PAGES
+
+PAGES_RE = re.compile(r'Pages:\s+(\d+)')
+
+CACHE_FILENAME = '.pdfprobe.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pdf_probe (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    pages INTEGER NOT NULL,
+    rots TEXT NOT NULL
+);
+"""
+
+
+def probe_pdf(pdf_path):
+    """
+    Page count of a pdf and the rotation of each page according to pdfinfo,
+    as (pages, rots) where rots is a list with page 1 first.  pages is None
+    if pdfinfo couldn't say.
+    """
+    p1 = subprocess.Popen(['pdfinfo', '-f', '1', '-l', str(ALL_PAGES), pdf_path],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdoutdata, stderrdata) = p1.communicate()
+    info = stdoutdata.decode('utf-8', 'replace')
+    m = PAGES_RE.search(info)
+    if not m:
+        return None, []
+    pages = int(m.groups()[0])
+    rots = parse_page_rots(info)
+    return pages, [rots.get(page, 0) for page in range(1, pages + 1)]
+
+
+def pack_rots(rots):
+    return ','.join(str(x) for x in rots)
+
+
+def unpack_rots(rots):
+    return [int(x) for x in rots.split(',')] if rots else []
+
+
+class ProbeCache():
+    """
+    Previous probe results for the pdfs under root.  Paths are stored relative
+    to root so the index stays good if the tree is moved.
+    """
+    def __init__(self, root, filename=CACHE_FILENAME):
+        self.root = root
+        self.db = sqlite3.connect(os.path.join(root, filename))
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(pdf_probe)')]
+        if columns and 'rots' not in columns:
+            # From before rotations were probed, so it all has to be done again
+            self.db.execute('DROP TABLE pdf_probe')
+        self.db.executescript(_SCHEMA)
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root)
+
+    def get(self, path, size, mtime):
+        """(pages, rots) from an earlier probe, or None"""
+        cur = self.db.execute('SELECT pages, rots FROM pdf_probe WHERE path = ? AND size = ? AND mtime = ?',
+                              (self._key(path), size, mtime))
+        row = cur.fetchone()
+        return (row[0], unpack_rots(row[1])) if row else None
+
+    def put_many(self, results):
+        """Save a list of (path, size, mtime, pages, rots)"""
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO pdf_probe (path, size, mtime, pages, rots) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                [(self._key(path), size, mtime, pages, pack_rots(rots))
+                                 for (path, size, mtime, pages, rots) in results])
+
+    def close(self):
+        self.db.close()
+
+
+def _stat(pdf_path):
+    st = os.stat(pdf_path)
+    return (pdf_path, st.st_size, int(st.st_mtime))
+
+
+def _probe(job):
+    (pdf_path, size, mtime) = job
+    return (pdf_path, size, mtime) + probe_pdf(pdf_path)
+
+
+def probe_pdfs(pdf_paths, cache=None, jobs=None):
+    """
+    Get the size, page count and page rotations of all the given pdfs, as a
+    dict of path -> (size, pages, rots).  pages is None for files pdfinfo
+    could not read.
+    Anything not already in the cache is probed on a pool of jobs workers.
+    """
+    if jobs is None:
+        jobs = cpu_count()
+
+    pool = ThreadPool(jobs)
+    try:
+        stats = pool.map(_stat, pdf_paths, chunksize=64)
+
+        info = {}
+        todo = []
+        for (path, size, mtime) in stats:
+            cached = cache.get(path, size, mtime) if cache else None
+            if cached is None:
+                todo.append((path, size, mtime))
+            else:
+                info[path] = (size,) + cached
+
+        if todo:
+            logging.info('Probing %d of %d pdfs (%d cached).' % (len(todo), len(stats), len(stats) - len(todo)))
+        probed = []
+        for (path, size, mtime, pages, rots) in pool.imap_unordered(_probe, todo):
+            info[path] = (size, pages, rots)
+            if pages is not None:
+                probed.append((path, size, mtime, pages, rots))
+            else:
+                logging.warning('Could not get page count for %s' % path)
+            if len(probed) >= 1000:
+                if cache:
+                    cache.put_many(probed)
+                probed = []
+    finally:
+        pool.close()
+        pool.join()
+
+    if cache and probed:
+        cache.put_many(probed)
+
+    return info